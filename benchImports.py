@@ -0,0 +1,74 @@
+import os
+import re
+import sys
+import time
+import tarfile
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+# Modules of the command line scripts, imported the way "python <script>.py --help" does before parsing arguments
+ENTRY_POINTS = ("selectionPlots", "runSamples", "skim", "cutScan", "nnTrain", "nnPredict", "kFold", "kFoldCutting",
+                "plotting")
+
+# Heavy packages reported separately, with their cumulative import time
+HEAVY_PACKAGES = ("ROOT", "keras", "tensorflow", "shap", "matplotlib", "sklearn", "uproot", "pandas")
+
+def importTime(module, directory, repeat):
+  ### Median wall time of "python -c 'import module'" run in directory over repeat runs, and the cumulative import
+  #   time of every heavy package of the last run (python -X importtime). Returns (seconds, packages, error) ###
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], cwd = directory,
+                            capture_output = True, text = True)
+    times.append(time.perf_counter() - start)
+    if result.returncode != 0:
+      return None, {}, result.stderr.strip().splitlines()[-1]
+  packages = {}
+  # import time: self [us] | cumulative | imported package, with the package indented by its import depth
+  for line in result.stderr.splitlines():
+    match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)", line)
+    if match and match.group(3) in HEAVY_PACKAGES:
+      packages[match.group(3)] = packages.get(match.group(3), 0) + int(match.group(1))/1e6
+  return float(np.median(times)), packages, None
+
+def exportRevision(revision, directory):
+  # the python files of a git revision, to time the imports of an older version of the scripts
+  archive = subprocess.run(["git", "archive", "--format=tar", revision], capture_output = True, check = True).stdout
+  with tempfile.TemporaryFile() as tarFile:
+    tarFile.write(archive)
+    tarFile.seek(0)
+    with tarfile.open(fileobj = tarFile) as tar:
+      tar.extractall(directory, members = [member for member in tar.getmembers() if member.name.endswith(".py")])
+
+def report(label, directory, modules, repeat, interpreter):
+  print("\n" + label + " (interpreter start up %.3f s subtracted)" % interpreter)
+  for module in modules:
+    seconds, packages, error = importTime(module, directory, repeat)
+    if error:
+      print("  %-16s %s" % (module, error))
+      continue
+    heavy = ", ".join("%s %.3f s" % (package, packages[package]) for package in HEAVY_PACKAGES if package in packages)
+    print("  %-16s %.3f s  %s" % (module, seconds - interpreter, heavy))
+
+def main(args):
+  interpreter, _, _ = importTime("sys", ".", args.repeat)
+  if args.revision:
+    with tempfile.TemporaryDirectory() as directory:
+      exportRevision(args.revision, directory)
+      report("Before (" + args.revision + ")", directory, args.modules, args.repeat, interpreter)
+  report("Working tree", os.getcwd(), args.modules, args.repeat, interpreter)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Start up cost of the scripts: wall time of importing each entry "
+    "point in a fresh interpreter, and the import time of the heavy packages it pulls in (ROOT, keras, shap, ...)")
+  parser.add_argument("modules", nargs = "*", default = list(ENTRY_POINTS), help = "modules to import")
+  parser.add_argument("-r", "--repeat", type = int, dest = "repeat", default = 5,
+    help = "imports per module, the median wall time is reported")
+  parser.add_argument("--revision", metavar = "REVISION", type = str, dest = "revision", default = None,
+    help = "git revision timed as well for a before and after comparison, e.g. HEAD")
+  args = parser.parse_args()
+
+  main(args)
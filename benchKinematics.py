@@ -0,0 +1,79 @@
+import math
+import time
+import argparse
+import numpy as np
+import ROOT
+from kinematics import fromPtEtaPhiM, pairFeatures
+
+def getDeltaPhill(Zlep1, Zlep2):
+  if (Zlep1.Eta() > Zlep2.Eta()):
+    return (Zlep1.DeltaPhi(Zlep2))
+  else:
+    return (Zlep2.DeltaPhi(Zlep1))
+
+def eventFeatures(tau1, tauOrLep, Zlep1, Zlep2, met_p4, nJets, mmc):
+  # Features of one event with the TLorentzVector methods, as the per-event loop computed them before the kinematics
+  # module: the reference of kinematics.pairFeatures
+  tauPair = tau1 + tauOrLep
+  zPair = Zlep1 + Zlep2
+  fillers = {}
+
+  fillers["tauPtSum"] = tau1.Pt() + tauOrLep.Pt()
+  fillers["zMassSum"] = zPair.M()
+  fillers["metPt"] = (met_p4)
+  fillers["deltaRll"] = (Zlep1.DeltaR(Zlep2))
+  fillers["deltaRtt"] = (tau1.DeltaR(tauOrLep))
+  fillers["deltaEtall"] = (math.fabs(Zlep1.Eta() - Zlep2.Eta()))
+  fillers["deltaEtatt"] = (math.fabs(tau1.Eta() - tauOrLep.Eta()))
+  fillers["deltaRttll"] = (tauPair.DeltaR(zPair))
+  fillers["nJets"] = (nJets)
+  fillers["deltaPhill"] = getDeltaPhill(Zlep1, Zlep2)
+  fillers["deltaPhitt"] = (tau1.DeltaPhi(tauOrLep))
+  fillers["deltaPhilltt"] = (zPair.DeltaPhi(tauPair))
+  fillers["mmc"] = (mmc)
+  return fillers
+
+def randomVectors(rng, n, mass):
+  return fromPtEtaPhiM(rng.uniform(20, 150, n), rng.uniform(-2.5, 2.5, n), rng.uniform(-np.pi, np.pi, n),
+                       np.full(n, mass))
+
+def main(args):
+  rng = np.random.default_rng(args.seed)
+  # tau1, tauOrLep, Zlep1, Zlep2
+  vectors = [randomVectors(rng, args.events, mass) for mass in (1.777, 1.777, 0.106, 0.106)]
+
+  lorentzVectors = []
+  for v in vectors:
+    lorentzVectors.append([])
+    for px, py, pz, e in zip(*v[4:]):
+      lorentzVector = ROOT.TLorentzVector()
+      lorentzVector.SetPxPyPzE(px, py, pz, e)
+      lorentzVectors[-1].append(lorentzVector)
+
+  # TLorentzVector path, one event at a time (the rdf engine computes the features the same way in C++)
+  start = time.perf_counter()
+  perEvent = [eventFeatures(*objects, 0., 0, 0.) for objects in zip(*lorentzVectors)]
+  perEventTime = time.perf_counter() - start
+
+  # Batched numpy path (the columnar engine)
+  start = time.perf_counter()
+  for _ in range(args.repeat):
+    batched = pairFeatures(*vectors)
+  batchedTime = (time.perf_counter() - start)/args.repeat
+
+  print("%d events: TLorentzVector %.3f s (%.2f us/event), numpy %.4f s (%.3f us/event), speed up x%.0f"
+    % (args.events, perEventTime, 1e6*perEventTime/args.events, batchedTime, 1e6*batchedTime/args.events,
+       perEventTime/batchedTime))
+  for key in batched:
+    reference = np.array([features[key] for features in perEvent])
+    print("  %-13s max abs difference %.2e" % (key, np.max(np.abs(reference - batched[key]))))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Benchmark of the kinematics module against TLorentzVector")
+  parser.add_argument("-n", "--events", type = int, dest = "events", default = 100000, help = "number of events")
+  parser.add_argument("-r", "--repeat", type = int, dest = "repeat", default = 10,
+    help = "repetitions of the numpy pass")
+  parser.add_argument("-s", "--seed", type = int, dest = "seed", default = 0, help = "random seed")
+  args = parser.parse_args()
+
+  main(args)
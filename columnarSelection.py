@@ -0,0 +1,228 @@
+import os
+import re
+import hashlib
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import awkward as ak
+import uproot
+from selectionPlots import MMC_LEPTON_BRANCHES, SELECTION_BRANCHES, fillOutputs
+from kinematics import fromCartesian
+from cutFlow import SELECTIONS, CutFlow, selectColumns
+from weightVariations import variationBranches
+from runMetrics import stage, timedIterate
+
+# Bump whenever the selection, the features or the weights change: every cached partial result is then rebuilt
+SELECTION_VERSION = 1
+
+# Order of the derived features, matching the keys of the histogram dictionaries in selectionPlots
+FEATURES = ("tauPtSum", "zMassSum", "metPt", "deltaRll", "deltaRtt", "deltaEtall", "deltaEtatt", "deltaRttll",
+            "nJets", "deltaPhill", "deltaPhitt", "deltaPhilltt", "mmc")
+
+def padded(jagged, n, fill = 0):
+  ### Pads (or clips) a jagged array to exactly n entries per event and returns a 2D numpy array ###
+  return ak.to_numpy(ak.fill_none(ak.pad_none(jagged, n, clip = True), fill))
+
+def fourVectors(p4, n):
+  ### Four-vectors (kinematics.fromCartesian) as 2D numpy arrays of shape (nEvents, n) from a jagged TLorentzVector
+  #   branch ###
+  p4 = ak.pad_none(p4, n, clip = True)
+  return fromCartesian(*(ak.to_numpy(ak.fill_none(component, 0.)).astype(np.float64)
+                         for component in (p4.fP.fX, p4.fP.fY, p4.fP.fZ, p4.fE)))
+
+def chunkColumns(arrays, luminosity, sumAllMC, variations = ()):
+  ### Flat numpy columns of a chunk (the columns of cutFlow.selectColumns), with the object branches padded to 2 taus
+  #   and 3 leptons, and a weight column per weight variation ###
+  met = arrays["met_p4"]
+  columns = {
+    "nTaus": ak.to_numpy(ak.num(arrays["taus_p4"])),
+    "nLeptons": ak.to_numpy(ak.num(arrays["leptons_p4"])),
+    "tauP4": fourVectors(arrays["taus_p4"], 2),
+    "leptonP4": fourVectors(arrays["leptons_p4"], 3),
+    "metPt": np.hypot(ak.to_numpy(met.fP.fX).astype(np.float64), ak.to_numpy(met.fP.fY).astype(np.float64)),
+    "nJets": ak.to_numpy(arrays["n_jets_30"]),
+    "flavour": padded(arrays["leptons"], 3),
+    "charge": padded(arrays["leptons_q"], 3),
+    "tauCharge": padded(arrays["taus_q"], 2),
+    "rnnID": padded(arrays["taus_jet_rnn_medium"], 2),
+    "idTight": padded(arrays["leptons_id_tight"], 3),
+    "tauBdt": padded(arrays["taus_ele_bdt_loose_retuned"], 2),
+    "eIso": padded(arrays["leptons_iso_FCLoose"], 3),
+    "muIso": padded(arrays["leptons_iso_TightTrackOnly_FixedRad"], 3),
+    "mmcTauTau": ak.to_numpy(arrays["mmc_tau0_tau1_mmc_mlm_m"]).astype(np.float64),
+    "mmcLeptons": np.stack([ak.to_numpy(arrays[branch]).astype(np.float64) for branch in MMC_LEPTON_BRANCHES],
+                           axis = 1),
+    # calculates weight for each event, in double precision and the same order as the per-event loop
+    "weight": (ak.to_numpy(arrays["cross_section"]).astype(np.float64) * luminosity
+      * ak.to_numpy(arrays["pu_NOMINAL_pileup_combined_weight"]).astype(np.float64)
+      * ak.to_numpy(arrays["weight_mc"]).astype(np.float64))/sumAllMC
+  }
+  for variation in variations:
+    columns[variation.column] = variation.evaluate({branch: ak.to_numpy(arrays[branch]).astype(np.float64)
+                                                    for branch in variation.branches}, luminosity, sumAllMC)
+  return columns
+
+def selectChunk(arrays, luminosity, sumAllMC, cutFlows = None, variations = ()):
+  ### Runs the cut flows of cutFlow.SELECTIONS on a chunk of events, filling cutFlows[region] if given.
+  #   Returns a dictionary per region with the features, the event weights and whether the variable cuts passed ###
+  with stage("event read"): # unpacking the jagged arrays into flat columns
+    columns = chunkColumns(arrays, luminosity, sumAllMC, variations)
+  return selectColumns(columns, cutFlows, variations)
+
+def runColumnar(fileNames, luminosity, sumAllMC, outputs, chunkSize = 100000, cutFlows = None, variations = ()):
+  ### Columnar event loop: reads the branches in chunks of jagged arrays and fills outputs[region] =
+  #   (ntupleWriter, treeName, histograms, variationHistograms) for the 2lep and 3lep regions, and cutFlows[region]
+  #   if given ###
+  nEvents = 0
+  branches = variationBranches(variations, SELECTION_BRANCHES)
+  for fileName in fileNames:
+    with stage("file open"):
+      inputFile = uproot.open(fileName)
+    with inputFile:
+      for arrays in timedIterate(inputFile["NOMINAL"].iterate(branches, step_size = chunkSize), "event read"):
+        nEvents += len(arrays)
+        for region, selected in selectChunk(arrays, luminosity, sumAllMC, cutFlows, variations).items():
+          fillOutputs(selected, *outputs[region])
+  return nEvents
+
+def concatenateColumns(parts):
+  ### Concatenates the selected arrays of several chunks/files, keeping their order ###
+  return {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+
+def selectFiles(fileNames, luminosity, sumAllMC, chunkSize = 100000, variations = ()):
+  ### Runs the selection over a list of files and returns (number of events, selected arrays per region,
+  #   cut flow per region), with the selected events in file and entry order ###
+  nEvents = 0
+  parts = {region: [] for region in SELECTIONS}
+  cutFlows = {region: CutFlow() for region in SELECTIONS}
+  branches = variationBranches(variations, SELECTION_BRANCHES)
+  for fileName in fileNames:
+    with stage("file open"):
+      inputFile = uproot.open(fileName)
+    with inputFile:
+      for arrays in timedIterate(inputFile["NOMINAL"].iterate(branches, step_size = chunkSize), "event read"):
+        nEvents += len(arrays)
+        for region, selected in selectChunk(arrays, luminosity, sumAllMC, cutFlows, variations).items():
+          parts[region].append(selected)
+  return nEvents, {region: concatenateColumns(parts[region]) for region in parts if parts[region]}, cutFlows
+
+def splitShards(fileNames, nShards):
+  ### Splits the file list into at most nShards contiguous shards of similar total size ###
+  sizes = [os.path.getsize(fileName) for fileName in fileNames]
+  target = sum(sizes)/nShards
+  shards = [[]]
+  total = 0
+  for fileName, size in zip(fileNames, sizes):
+    if shards[-1] and total >= target*len(shards) and len(shards) < nShards:
+      shards.append([])
+    shards[-1].append(fileName)
+    total += size
+  return shards
+
+def runSharded(fileNames, luminosity, sumAllMC, outputs, nShards, chunkSize = 100000, cutFlows = None,
+               variations = ()):
+  ### Processes the files of a sample in nShards parallel worker processes. The selected events of each shard are
+  #   filled in file order as soon as the shard and the ones before it are done, then released, so the histograms
+  #   (Sumw2 included), the ntuples and the yields are the same as a single process run ###
+  nEvents = 0
+  shards = splitShards(fileNames, nShards) if fileNames else []
+  with ProcessPoolExecutor(max(len(shards), 1), mp_context = multiprocessing.get_context("spawn")) as pool:
+    # the stages of the workers are not seen here, the wait for each shard is counted as its selection
+    for shardEvents, selected, shardCutFlows in timedIterate(pool.map(selectFiles, shards, [luminosity]*len(shards),
+        [sumAllMC]*len(shards), [chunkSize]*len(shards), [variations]*len(shards)), "shard selection"):
+      nEvents += shardEvents
+      for region in outputs:
+        if region in selected:
+          fillOutputs(selected[region], *outputs[region])
+        if cutFlows is not None:
+          cutFlows[region].merge(shardCutFlows[region])
+  return nEvents
+
+def partialKey(contentHash, luminosity, variations = ()):
+  # Name of the partial result of a file: changes with the file content, the selection version, the luminosity and
+  # the weight variations. The selection version is also kept readable in front, so older partials can be told apart
+  key = "%s:%d:%r" % (contentHash, SELECTION_VERSION, luminosity)
+  if variations:
+    key += ":" + ";".join(variation.name + "=" + variation.expression for variation in variations)
+  return "v%d-%s" % (SELECTION_VERSION, hashlib.sha1(key.encode()).hexdigest())
+
+def savePartial(path, nEvents, selected, cutFlows):
+  ### Saves the selected arrays and cut flows of one file as a .npz, written to a temporary file of its own first,
+  #   so an interrupted run never leaves a truncated partial and runs building the same partial do not collide ###
+  arrays = {"nEvents": np.array(nEvents)}
+  for region, columns in selected.items():
+    for key, values in columns.items():
+      arrays[region + "." + key] = values
+  for region, cutFlow in cutFlows.items():
+    arrays[region + ".cutFlow.names"] = np.array(list(cutFlow.rows), dtype = str)
+    arrays[region + ".cutFlow.rows"] = np.array(list(cutFlow.rows.values()), dtype = np.float64).reshape(-1, 3)
+  with tempfile.NamedTemporaryFile(dir = os.path.dirname(path) or ".", prefix = os.path.basename(path),
+                                   suffix = ".tmp", delete = False) as partialFile:
+    np.savez(partialFile, **arrays)
+  os.replace(partialFile.name, path)
+
+def loadPartial(path):
+  ### Inverse of savePartial: returns (number of events, selected arrays per region, cut flow per region) ###
+  selected = {}
+  cutFlows = {}
+  with np.load(path) as arrays:
+    for name in arrays.files:
+      if name == "nEvents" or ".cutFlow." in name:
+        continue
+      region, key = name.split(".", 1)
+      selected.setdefault(region, {})[key] = arrays[name]
+    for region in SELECTIONS:
+      if region + ".cutFlow.names" in arrays.files:
+        cutFlows[region] = CutFlow()
+        rows = zip(arrays[region + ".cutFlow.names"], arrays[region + ".cutFlow.rows"])
+        for name, (events, weighted, seconds) in rows:
+          cutFlows[region].rows[str(name)] = [int(events), weighted, seconds]
+    return int(arrays["nEvents"]), selected, cutFlows
+
+def buildPartial(fileName, path, luminosity, chunkSize = 100000, variations = ()):
+  # Selection of one file with unnormalised weights (sumAllMC = 1), so the partial stays valid when other files change
+  savePartial(path, *selectFiles([fileName], luminosity, 1., chunkSize, variations))
+
+def runCached(fileNames, luminosity, sumAllMC, outputs, cacheDirectory, contentHashes, nWorkers = 1,
+              chunkSize = 100000, cutFlows = None, variations = ()):
+  ### Columnar selection with a partial result per input file in cacheDirectory, keyed by the file content hash and
+  #   SELECTION_VERSION. Only new or changed files are processed (in nWorkers processes), then the partials are merged
+  #   in file order and normalised with sumAllMC, giving the same outputs as runColumnar ###
+  os.makedirs(cacheDirectory, exist_ok = True)
+  paths = [os.path.join(cacheDirectory, partialKey(contentHashes[fileName], luminosity, variations) + ".npz")
+           for fileName in fileNames]
+  missing = {path: fileName for fileName, path in zip(fileNames, paths) if not os.path.exists(path)}
+  print(len(set(paths)) - len(missing), "cached partial results,", len(missing), "files to process")
+
+  if nWorkers > 1 and len(missing) > 1:
+    with stage("shard selection"), ProcessPoolExecutor(min(nWorkers, len(missing)),
+                                                       mp_context = multiprocessing.get_context("spawn")) as pool:
+      list(pool.map(buildPartial, missing.values(), missing.keys(), [luminosity]*len(missing),
+                    [chunkSize]*len(missing), [variations]*len(missing)))
+  else:
+    for path, fileName in missing.items():
+      buildPartial(fileName, path, luminosity, chunkSize, variations)
+
+  # partials of older selection versions (or named without one) are never used again. The ones of the current
+  # version are kept, other luminosities or weight variations may still need them, and so are the temporary files of
+  # running processes
+  for name in os.listdir(cacheDirectory):
+    partial = re.fullmatch(r"(?:v(\d+)-)?[0-9a-f]{40}\.npz", name)
+    if partial and partial.group(1) != str(SELECTION_VERSION):
+      os.remove(os.path.join(cacheDirectory, name))
+
+  # the partials are filled one at a time in file order, only one is in memory at once
+  nEvents = 0
+  for path in paths:
+    with stage("partial load"):
+      partialEvents, selected, partialCutFlows = loadPartial(path)
+    nEvents += partialEvents
+    for region, columns in selected.items():
+      for column in ("weight", *(variation.column for variation in variations)):
+        columns[column] = columns[column]/sumAllMC
+      fillOutputs(columns, *outputs[region])
+    if cutFlows is not None:
+      for region, cutFlow in partialCutFlows.items():
+        cutFlows[region].merge(cutFlow, 1/sumAllMC)
+  return nEvents
@@ -0,0 +1,236 @@
+import os
+import time
+import numpy as np
+from kinematics import REAL_Z_MASS, invariantMass, pairFeatures, take
+from runMetrics import stage
+
+## Declarative event selection shared by the selection engines.
+#  Each region is an ordered list of named cuts (name, mask, expression). The mask is a function of an Events view
+#  returning a boolean array, run by the columnar and event engines on the columns of a chunk; the expression is the
+#  same cut in C++ on the columns the rdf engine defines with the same names, run as a Filter. The cuts are evaluated
+#  one after the other on the events still passing, so putting cheap and tight cuts first short-circuits the expensive
+#  ones. Every cut fills an unweighted and a weighted counter.
+
+def subset(value, selection):
+  # Four-vectors are tuples of arrays, everything else a single array
+  return tuple(component[selection] for component in value) if isinstance(value, tuple) else value[selection]
+
+class Events:
+  ### Lazy view of a chunk restricted to the events passing the cuts so far. Columns are only gathered when a cut
+  #   uses them, and derived quantities are computed once and carried over when the view is narrowed ###
+  def __init__(self, columns, derived = None, index = None, cache = None):
+    self.columns = columns
+    self.derived = derived or {}
+    self.index = np.arange(len(columns["weight"])) if index is None else index
+    self.cache = {} if cache is None else cache
+
+  def __len__(self):
+    return len(self.index)
+
+  def __getitem__(self, key):
+    if key not in self.cache:
+      self.cache[key] = self.derived[key](self) if key in self.derived else subset(self.columns[key], self.index)
+    return self.cache[key]
+
+  def narrow(self, mask):
+    return Events(self.columns, self.derived, self.index[mask],
+                  {key: subset(value, mask) for key, value in self.cache.items()})
+
+class CutFlow:
+  ### Unweighted and weighted number of events and time spent after each cut, in the order the cuts ran ###
+  def __init__(self):
+    self.rows = {}
+
+  def add(self, name, events, weighted, seconds = 0.):
+    row = self.rows.setdefault(name, [0, 0., 0.])
+    row[0] += events
+    row[1] += weighted
+    row[2] += seconds
+
+  def fill(self, name, weights, seconds):
+    self.add(name, len(weights), float(np.sum(weights)), seconds)
+
+  def merge(self, other, scale = 1.):
+    # scale multiplies the weighted counts of other, e.g. to normalise cut flows built with unnormalised weights
+    for name, (events, weighted, seconds) in other.rows.items():
+      self.add(name, events, weighted*scale, seconds)
+
+  def table(self, title):
+    lines = ["%-34s %10s %14s %10s %10s" % (title, "events", "weighted", "rel. eff.", "time [ms]")]
+    previous = None
+    for name, (events, weighted, seconds) in self.rows.items():
+      efficiency = "" if previous is None else "%.4f" % (events/previous if previous else 0.)
+      lines.append("%-34s %10d %14.4f %10s %10.1f" % (name, events, weighted, efficiency, 1000*seconds))
+      previous = events
+    return "\n".join(lines)
+
+def runCuts(events, cuts, cutFlow = None):
+  ### Applies the cuts in order, narrowing the events after each one. Returns the passing events ###
+  for name, cut, _ in cuts:
+    start = time.perf_counter()
+    events = events.narrow(cut(events))
+    if cutFlow is not None:
+      cutFlow.fill(name, events["weight"], time.perf_counter() - start)
+  return events
+
+def writeCutFlows(cutFlows, fileName):
+  os.makedirs(os.path.dirname(fileName) or ".", exist_ok = True)
+  with open(fileName, "w") as outputFile:
+    outputFile.write("\n\n".join(cutFlows[region].table(region) for region in cutFlows) + "\n")
+
+### DERIVED QUANTITIES ###
+def isolated(e):
+  # Isolation working point of each lepton's own flavour (muons 1, electrons 2)
+  return np.where(e["flavour"] == 1, e["muIso"] == 1, (e["flavour"] == 2) & (e["eIso"] == 1))
+
+def diLeptonMass(e):
+  return invariantMass(tuple(c[:, 0] for c in e["leptonP4"]), tuple(c[:, 1] for c in e["leptonP4"]))
+
+def bestZCandidate(leptons, flavour, charge):
+  ### Batched Z candidate for any number of leptons per event (arrays of shape (nEvents, nLeptons), padded with charge 0).
+  #   Every opposite sign same flavour pair is considered and the one with the mass closest to the Z mass is kept.
+  #   Returns (found, index of the first lepton not in the pair, Z lepton indices); events without a pair or with a tie
+  #   for the closest pair are not found ###
+  first, second = np.triu_indices(flavour.shape[1], 1)
+  ossf = ((flavour[:, first] == flavour[:, second]) & (charge[:, first] == -charge[:, second])
+          & (charge[:, first] != 0))
+  mass = invariantMass(tuple(c[:, first] for c in leptons), tuple(c[:, second] for c in leptons))
+  distance = np.where(ossf, np.abs(mass - REAL_Z_MASS), np.inf)
+
+  best = np.argmin(distance, axis = 1)
+  bestDistance = np.take_along_axis(distance, best[:, None], axis = 1)
+  found = np.isfinite(bestDistance[:, 0]) & (np.sum(distance == bestDistance, axis = 1) == 1)
+  zIndex1, zIndex2 = first[best], second[best]
+  index = np.arange(flavour.shape[1])
+  leftIndex = np.argmax((index != zIndex1[:, None]) & (index != zIndex2[:, None]), axis = 1)
+  return found, leftIndex, zIndex1, zIndex2
+
+def zPairing(e):
+  # Z candidate of the 3 lepton events. With mixed flavours the only same flavour pair is used; with three leptons of
+  # the same flavour the odd charge lepton is paired with whichever lepton gives a mass closer to the Z mass
+  return bestZCandidate(e["leptonP4"], e["flavour"], e["charge"])
+
+def zMass(e):
+  _, _, zIndex1, zIndex2 = e["zPairing"]
+  return invariantMass(take(e["leptonP4"], zIndex1), take(e["leptonP4"], zIndex2))
+
+def leftoverLepton(e):
+  return take(e["leptonP4"], e["zPairing"][1])
+
+DERIVED = {
+  "isolated": isolated,
+  "mll": diLeptonMass,
+  "zPairing": zPairing,
+  "zMass": zMass,
+  "leftoverLepton": leftoverLepton
+}
+
+### SELECTIONS ###
+SELECTIONS = {
+  "2lep": [
+    ("2 taus, 2 leptons", lambda e: (e["nTaus"] == 2) & (e["nLeptons"] == 2),
+     "nTaus == 2 && nLeptons == 2"),
+    ("tau RNN medium", lambda e: (e["rnnID"][:, 0] == 1) & (e["rnnID"][:, 1] == 1),
+     "rnnID[0] == 1 && rnnID[1] == 1"),
+    ("tau ele BDT loose", lambda e: (e["tauBdt"][:, 0] == 1) & (e["tauBdt"][:, 1] == 1),
+     "tauBdt[0] == 1 && tauBdt[1] == 1"),
+    ("opposite sign taus", lambda e: e["tauCharge"][:, 0] == -e["tauCharge"][:, 1],
+     "tauCharge[0] == -tauCharge[1]"),
+    ("same flavour leptons", lambda e: e["flavour"][:, 0] == e["flavour"][:, 1],
+     "flavour[0] == flavour[1]"),
+    ("opposite sign leptons", lambda e: e["charge"][:, 0] == -e["charge"][:, 1],
+     "charge[0] == -charge[1]"),
+    ("tight lepton ID", lambda e: (e["idTight"][:, 0] == 1) & (e["idTight"][:, 1] == 1),
+     "idTight[0] == 1 && idTight[1] == 1"),
+    ("lepton isolation", lambda e: e["isolated"][:, 0] & e["isolated"][:, 1],
+     "isolated[0] && isolated[1]"),
+    ("tau pT sum > 75", lambda e: e["tauP4"][0][:, 0] + e["tauP4"][0][:, 1] > 75,
+     "tauP4[0].Pt() + tauP4[1].Pt() > 75"),
+    ("71 < m_ll < 111", lambda e: (e["mll"] > 71) & (e["mll"] < 111),
+     "mll > 71 && mll < 111")
+  ],
+  "3lep": [
+    ("1 tau, 3 leptons", lambda e: (e["nTaus"] == 1) & (e["nLeptons"] == 3),
+     "nTaus == 1 && nLeptons == 3"),
+    ("tau RNN medium", lambda e: e["rnnID"][:, 0] == 1,
+     "rnnID[0] == 1"),
+    ("tau ele BDT loose", lambda e: e["tauBdt"][:, 0] == 1,
+     "tauBdt[0] == 1"),
+    ("electrons or muons", lambda e: np.all((e["flavour"] == 1) | (e["flavour"] == 2), axis = 1),
+     "All(flavour == 1 || flavour == 2)"),
+    ("tight lepton ID", lambda e: np.all(e["idTight"] == 1, axis = 1),
+     "All(idTight == 1)"),
+    ("lepton isolation", lambda e: np.all(e["isolated"], axis = 1),
+     "All(isolated)"),
+    ("Z candidate", lambda e: e["zPairing"][0],
+     "zPairing[0] == 1"),
+    ("lepton opposite sign to tau", lambda e: np.take_along_axis(e["charge"], e["zPairing"][1][:, None], axis = 1)[:, 0]
+      == -e["tauCharge"][:, 0],
+     "charge[zPairing[1]] == -tauCharge[0]"),
+    ("lepton + tau pT > 60", lambda e: e["leftoverLepton"][0] + e["tauP4"][0][:, 0] > 60,
+     "leftoverLepton.Pt() + tauP4[0].Pt() > 60"),
+    ("81 < m_Z < 101", lambda e: (e["zMass"] > 81) & (e["zMass"] < 101),
+     "zMass > 81 && zMass < 101")
+  ]
+}
+
+# Cuts on the derived features: the histograms are only filled for events passing them
+def variableCuts(etallValue):
+  return [
+    ("delta R tautau < 3.1", lambda f: f["deltaRtt"] < 3.1, "deltaRtt < 3.1"),
+    ("delta R ll < 3", lambda f: f["deltaRll"] < 3, "deltaRll < 3"),
+    ("delta R tautau,ll < 3.9", lambda f: f["deltaRttll"] < 3.9, "deltaRttll < 3.9"),
+    ("delta eta tautau < 1.9", lambda f: f["deltaEtatt"] < 1.9, "deltaEtatt < 1.9"),
+    ("delta eta ll < " + str(etallValue), lambda f: f["deltaEtall"] < etallValue, "deltaEtall < %r" % etallValue),
+    ("-3.2 < delta phi ll < 2.4", lambda f: (f["deltaPhill"] > -3.2) & (f["deltaPhill"] < 2.4),
+     "deltaPhill > -3.2 && deltaPhill < 2.4"),
+    ("90 < MMC < 190", lambda f: (f["mmc"] > 90) & (f["mmc"] < 190), "mmc > 90 && mmc < 190")
+  ]
+
+VARIABLE_CUTS = {"2lep": variableCuts(3.5), "3lep": variableCuts(2.7)}
+
+### SELECTION OF A CHUNK ###
+def regionObjects(region, e):
+  ### (tau1, tauOrLep, Zlep1, Zlep2, mmc) of the events passing the selection of a region ###
+  taus, leptons = e["tauP4"], e["leptonP4"]
+  if region == "2lep":
+    return (tuple(c[:, 0] for c in taus), tuple(c[:, 1] for c in taus), tuple(c[:, 0] for c in leptons),
+            tuple(c[:, 1] for c in leptons), e["mmcTauTau"])
+  _, leftIndex, zIndex1, zIndex2 = e["zPairing"]
+  return (tuple(c[:, 0] for c in taus), e["leftoverLepton"], take(leptons, zIndex1), take(leptons, zIndex2),
+          np.take_along_axis(e["mmcLeptons"], leftIndex[:, None], axis = 1)[:, 0])
+
+def computeFeatures(tau1, tauOrLep, Zlep1, Zlep2, metPt, nJets, mmc):
+  ### Every feature of the output ntuples and histograms, from the objects of regionObjects ###
+  features = pairFeatures(tau1, tauOrLep, Zlep1, Zlep2)
+  features.update(metPt = metPt, nJets = nJets.astype(np.float64), mmc = mmc)
+  return features
+
+def selectColumns(columns, cutFlows = None, variations = ()):
+  ### Runs the cut flows of SELECTIONS on the columns of a chunk of events, filling cutFlows[region] if given. The
+  #   columns are nTaus, nLeptons, tauP4 and leptonP4 (kinematics four-vectors padded to 2 taus and 3 leptons),
+  #   flavour, charge, idTight, eIso and muIso (padded to 3 leptons), tauCharge, rnnID and tauBdt (padded to 2 taus),
+  #   metPt, nJets, mmcTauTau, mmcLeptons (one per lepton), weight and the weight of every variation.
+  #   Returns a dictionary per region with the features, the event weights and whether the variable cuts passed ###
+  events = Events(columns, DERIVED)
+  results = {}
+  for region, cuts in SELECTIONS.items():
+    cutFlow = cutFlows[region] if cutFlows is not None else None
+    with stage("selection"):
+      if cutFlow is not None:
+        cutFlow.fill("all events", events["weight"], 0.)
+      selected = runCuts(events, cuts, cutFlow)
+    with stage("feature computation"):
+      tau1, tauOrLep, Zlep1, Zlep2, mmc = regionObjects(region, selected)
+      features = computeFeatures(tau1, tauOrLep, Zlep1, Zlep2, selected["metPt"], selected["nJets"], mmc)
+    features["weight"] = selected["weight"]
+    for variation in variations:
+      features[variation.column] = selected[variation.column]
+
+    # the variable cuts only decide which selected events go in the histograms
+    with stage("selection"):
+      passing = runCuts(Events(features), VARIABLE_CUTS[region], cutFlow)
+    features["passCuts"] = np.zeros(len(selected), dtype = bool)
+    features["passCuts"][passing.index] = True
+    results[region] = features
+  return results
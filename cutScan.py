@@ -0,0 +1,117 @@
+import os
+import argparse
+import numpy as np
+import uproot
+from cutFlow import VARIABLE_CUTS, Events, runCuts
+
+# Thresholds of the variable cuts (cutFlow.VARIABLE_CUTS) scanned by default: (feature, direction, start,
+# stop, number of values). Every default grid contains the current working point
+SCAN_CUTS = {
+  "deltaRttMax": ("deltaRtt", "<", 2.5, 3.7, 5),
+  "deltaRllMax": ("deltaRll", "<", 2.4, 3.6, 5),
+  "deltaRttllMax": ("deltaRttll", "<", 3.3, 4.5, 5),
+  "deltaEtattMax": ("deltaEtatt", "<", 1.3, 2.5, 5),
+  "deltaEtallMax": ("deltaEtall", "<", 2.3, 3.9, 5),
+  "deltaPhillMin": ("deltaPhill", ">", -3.6, -2.8, 3),
+  "deltaPhillMax": ("deltaPhill", "<", 2.0, 2.8, 3),
+  "mmcMin": ("mmc", ">", 70, 110, 3),
+  "mmcMax": ("mmc", "<", 170, 210, 3)
+}
+
+def readColumns(fileNames, treeName, features):
+  ### Features and weights of the events of treeName in every file, concatenated ###
+  parts = []
+  for fileName in fileNames:
+    with uproot.open(fileName + ":" + treeName) as tree:
+      parts.append(tree.arrays([*features, "weight"], library = "np"))
+  return {key: np.concatenate([part[key] for part in parts]).astype(np.float64) for key in (*features, "weight")}
+
+def gridIndices(columns, grids):
+  ### Bin of every event along each cut of the grid. Along a cut with thresholds t_0 < ... < t_n-1, an event in bin k
+  #   passes t_j for every j >= k, and bin n holds the events failing all of them. Lower cuts (x > t) are turned into
+  #   upper cuts on -x with the thresholds -t in increasing order ###
+  indices = []
+  for feature, direction, thresholds in grids.values():
+    values = columns[feature] if direction == "<" else -columns[feature]
+    cuts = thresholds if direction == "<" else -thresholds[::-1]
+    indices.append(np.searchsorted(cuts, values, side = "right"))
+  return indices
+
+def passingWeights(columns, grids):
+  ### Weighted number of events passing every combination of thresholds, an array with one axis per cut of the grid.
+  #   The events are histogrammed once over the grid bins, then a cumulative sum along each axis gives the sum of
+  #   the events passing, so the cost does not depend on the number of events per grid point ###
+  shape = tuple(len(thresholds) + 1 for _, _, thresholds in grids.values())
+  cells = np.ravel_multi_index(gridIndices(columns, grids), shape)
+  passing = np.bincount(cells, columns["weight"], minlength = int(np.prod(shape))).reshape(shape)
+  for axis in range(len(shape)):
+    passing = np.cumsum(passing, axis = axis)
+  passing = passing[tuple(slice(0, size - 1) for size in shape)]
+  # the thresholds of the lower cuts were reversed, put them back in increasing order
+  lowerCuts = tuple(axis for axis, (_, direction, _) in enumerate(grids.values()) if direction != "<")
+  return np.flip(passing, axis = lowerCuts) if lowerCuts else passing
+
+def significance(signal, background):
+  total = signal + background
+  return np.divide(signal, np.sqrt(np.maximum(total, 0)), out = np.zeros_like(signal), where = total > 0)
+
+def workingPoint(columns, region):
+  # Weighted number of events passing the current variable cuts of cutFlow.VARIABLE_CUTS
+  return float(np.sum(runCuts(Events(columns), VARIABLE_CUTS[region])["weight"]))
+
+def writeScan(fileName, grids, signal, background, scores):
+  ### One line per grid point: the thresholds, S, B and S/sqrt(S+B) ###
+  os.makedirs(os.path.dirname(fileName) or ".", exist_ok = True)
+  points = np.meshgrid(*(thresholds for _, _, thresholds in grids.values()), indexing = "ij")
+  table = np.column_stack([point.ravel() for point in points] + [signal.ravel(), background.ravel(), scores.ravel()])
+  np.savetxt(fileName, table, delimiter = ",", fmt = "%.6g", header = ",".join([*grids, "S", "B", "significance"]),
+             comments = "")
+
+def main(args):
+  grids = {}
+  for name, (feature, direction, start, stop, number) in SCAN_CUTS.items():
+    grids[name] = (feature, direction, np.linspace(start, stop, number))
+  for spec in args.grid:
+    name, values = spec.split("=")
+    start, stop, number = values.split(":")
+    grids[name] = (SCAN_CUTS[name][0], SCAN_CUTS[name][1], np.linspace(float(start), float(stop), int(number)))
+  features = tuple(dict.fromkeys(feature for feature, _, _ in grids.values()))
+  print("Scanning", int(np.prod([len(thresholds) for _, _, thresholds in grids.values()])), "grid points per region")
+
+  for region in ("2lep", "3lep"):
+    signalColumns = readColumns(args.signal, "nominal" + region, features)
+    backgroundColumns = readColumns(args.background, "nominal" + region, features)
+    signal = passingWeights(signalColumns, grids)
+    background = passingWeights(backgroundColumns, grids)
+    scores = significance(signal, background)
+    writeScan(args.outputdir + "/" + region + ".csv", grids, signal, background, scores)
+
+    ### REPORT ###
+    signalNow, backgroundNow = workingPoint(signalColumns, region), workingPoint(backgroundColumns, region)
+    print("\n" + region + ": current working point S = %.4g, B = %.4g, S/sqrt(S+B) = %.4f"
+      % (signalNow, backgroundNow, significance(np.array(signalNow), np.array(backgroundNow))))
+    order = np.argsort(scores, axis = None)[::-1][:args.top]
+    for rank, flatIndex in enumerate(order):
+      point = np.unravel_index(flatIndex, scores.shape)
+      thresholds = ", ".join("%s %s %.4g" % (feature, direction, grid[index])
+                             for (feature, direction, grid), index in zip(grids.values(), point))
+      print("%3d. S = %.4g, B = %.4g, S/sqrt(S+B) = %.4f: %s" % (rank + 1, signal[point], background[point],
+        scores[point], thresholds))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Grid scan of the variable cut thresholds over the selection ntuples, "
+    "reporting S/sqrt(S+B) per grid point and the best working points of each region.")
+  parser.add_argument("--signal", "-s", metavar = "FILE", type = str, dest = "signal", nargs = "+",
+    default = ["nTupleGroups/signalGroup.root"], help = "signal ntuples")
+  parser.add_argument("--background", "-b", metavar = "FILE", type = str, dest = "background", nargs = "+",
+    default = ["nTupleGroups/backgroundGroup.root", "nTupleGroups/llllGroup.root", "nTupleGroups/jetsGroup.root"],
+    help = "background ntuples, summed over every file")
+  parser.add_argument("--grid", "-g", metavar = "CUT=START:STOP:N", type = str, dest = "grid", nargs = "+",
+    default = [], help = "thresholds scanned for a cut, out of " + ", ".join(SCAN_CUTS))
+  parser.add_argument("--top", "-t", type = int, dest = "top", default = 5,
+    help = "number of best working points printed per region")
+  parser.add_argument("--outputdir", "-o", metavar = "DIRECTORY", type = str, dest = "outputdir", default = "cutScan",
+    help = "directory of the <region>.csv tables of every grid point")
+  args = parser.parse_args()
+
+  main(args)
@@ -0,0 +1,38 @@
+import os
+import re
+
+## Method to resolve regular expressions in file names.
+#  TChain::Add only supports wildcards in the last items, i.e. on file level.
+#  This method can resolve all wildcards at any directory level,
+#  e.g. /my/directory/a*test*/pattern/*.root
+#  Directories are listed with os.scandir, so it can be used without importing ROOT
+#  @param pattern    the file name pattern using python regular expressions
+#  @return list of all files matching the pattern
+def findAllFilesInPath(pattern, path):
+  files = []
+
+  def checkPath(path, items):
+    # nested method to deal with the recursion
+    if not items:
+      return
+    item, myItems = items[0], items[1:]
+    if '*' in item:
+      # beg and end of line control so that *truc does not match bla_truc_xyz
+      p = re.compile("^" + item.replace('*', '.*') + "$")
+      try:
+        # entries in directory order, like ROOT.gSystem.GetDirEntry
+        entries = [entry.name for entry in os.scandir(path or ".")]
+      except (FileNotFoundError, NotADirectoryError):
+        return
+      for entry in entries:
+        if p.match(entry):
+          if not myItems:
+            files.append(path + entry)
+          else:
+            checkPath(path + entry + '/', myItems)
+    elif item and not myItems:
+      files.append(path + item)
+    else:
+      checkPath(path + item + '/', myItems)
+  checkPath(path, pattern.split('/'))
+  return files
@@ -0,0 +1,127 @@
+import os
+import argparse
+import numpy as np
+import uproot
+from sklearn.model_selection import KFold
+from sklearn.preprocessing import StandardScaler
+from numpyInference import ACTIVATIONS, loadModel
+from ntupleWriter import NTupleWriter, COMPRESSION
+from trainingData import VARIABLES, loadTrainingData, TrainingStream
+from kFold import PREDICTION_SCHEMA
+
+N_FOLDS = 5
+
+def modelPaths(cut, name = None):
+  # Fold models saved by kFold.trainFold, fold 1 to 5
+  return ["kFoldModels/" + (name + cut + str(fold) if name else cut + "Model" + str(fold)) + ".h5"
+          for fold in range(1, N_FOLDS + 1)]
+
+class FoldEnsemble:
+  ### The fold models of a region scored together: the weights of every layer are stacked along a first fold axis,
+  #   so one batched pass of numpy matrix products gives the output of every fold. Events are scored with the model
+  #   of their fold (out of fold, for the events kFold trained on) or with the mean of the folds (for new events) ###
+  def __init__(self, models):
+    architectures = {tuple((kernel.shape, activation) for kernel, _, activation in model.layers) for model in models}
+    if len(architectures) != 1:
+      raise ValueError("the fold models do not have the same layers")
+    self.kernels = [np.stack([model.layers[i][0] for model in models]) for i in range(len(models[0].layers))]
+    self.biases = [np.stack([model.layers[i][1] for model in models])[:, None, :]
+                   for i in range(len(models[0].layers))]
+    self.activations = [activation for _, _, activation in models[0].layers]
+
+  def predictFolds(self, x):
+    # (number of folds, number of events) outputs of every fold model
+    values = np.asarray(x, dtype = np.float32)[None]
+    for kernel, bias, activation in zip(self.kernels, self.biases, self.activations):
+      values = ACTIVATIONS[activation](np.matmul(values, kernel) + bias)
+    return values[:, :, 0]
+
+  def predict(self, x, folds = None, batch_size = 65536):
+    ### Output of the model of each event's fold (0 to 4), or the mean of the folds without folds ###
+    outputs = np.empty(len(x), np.float32)
+    for start in range(0, len(x), batch_size):
+      foldOutputs = self.predictFolds(x[start:start + batch_size])
+      if folds is None:
+        outputs[start:start + batch_size] = foldOutputs.mean(axis = 0)
+      else:
+        batchFolds = folds[start:start + batch_size]
+        outputs[start:start + batch_size] = foldOutputs[batchFolds, np.arange(len(batchFolds))]
+    return outputs
+
+def loadEnsemble(cut, name = None):
+  return FoldEnsemble([loadModel(path) for path in modelPaths(cut, name)])
+
+def trainingFolds(cut, stream = False):
+  ### Scaler of the training matrix of a region and the fold (0 to 4) kFold tested each of its events in: the
+  #   KFold(shuffle = True, random_state = 0) split of kFold.trainFold or, with stream, the event hash of
+  #   kFold --stream ###
+  if stream:
+    trainingStream = TrainingStream(cut, 0, N_FOLDS)
+    return trainingStream.scaler, np.concatenate([trainingStream.folds(start, stop)
+                                                  for start, stop in trainingStream.chunks])
+  x = loadTrainingData(cut)[0]
+  folds = np.empty(len(x), dtype = np.int64)
+  for fold, (_, test) in enumerate(KFold(n_splits = N_FOLDS, shuffle = True, random_state = 0).split(x)):
+    folds[test] = fold
+  return StandardScaler().fit(x), folds
+
+def scoreOutOfFold(args):
+  ### Predictions of every nTupleGroups event by the model of the fold it was held out of, written with the branches
+  #   of the predictions ntuple of kFold.py (event key, fold and weight) without retraining ###
+  with NTupleWriter(args.outputfile, args.compression, args.compressionlevel) as ntupleWriter:
+    for cut in ("2lep", "3lep"):
+      scaler, folds = trainingFolds(cut, args.stream)
+      x, _, weight, group, entry = loadTrainingData(cut)
+      prediction = loadEnsemble(cut, args.models).predict(scaler.transform(x), folds)
+      # in fold order, as kFold.py writes them
+      order = np.argsort(folds, kind = "stable")
+      ntupleWriter.book("nominal" + cut, PREDICTION_SCHEMA)
+      ntupleWriter.extend("nominal" + cut, {"prediction": prediction[order], "group": group[order],
+                                            "entry": entry[order], "fold": folds[order] + 1, "weight": weight[order]})
+      print(cut + ":", len(prediction), "out of fold predictions")
+
+def scoreFiles(args):
+  ### Ensemble mean prediction of every event of new ntuples, written to outputdir/<file name> with its entry, in the
+  #   order of the input tree ###
+  ensembles = {cut: loadEnsemble(cut, args.models) for cut in ("2lep", "3lep")}
+  scalers = {cut: trainingFolds(cut, args.stream)[0] for cut in ("2lep", "3lep")}
+  os.makedirs(args.outputdir, exist_ok = True)
+  for fileName in args.files:
+    with NTupleWriter(os.path.join(args.outputdir, os.path.basename(fileName)), args.compression,
+                      args.compressionlevel) as ntupleWriter:
+      for cut in ("2lep", "3lep"):
+        ntupleWriter.book("nominal" + cut, {"prediction": "f4", "entry": "i8"})
+        start = 0
+        with uproot.open(fileName + ":nominal" + cut) as tree:
+          for chunk in tree.iterate(list(VARIABLES), library = "np", step_size = "100 MB"):
+            x = np.column_stack([chunk[variable] for variable in VARIABLES]).astype(np.float32)
+            prediction = ensembles[cut].predict(scalers[cut].transform(x))
+            ntupleWriter.extend("nominal" + cut, {"prediction": prediction,
+                                                  "entry": np.arange(start, start + len(prediction))})
+            start += len(prediction)
+    print(fileName, "scored")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Score events with the 5 fold models of kFold.py at once: the "
+    "nTupleGroups events with the model of their held out fold, or the given ntuples with the mean of the folds.")
+  parser.add_argument("files", nargs = "*", help = "ntuples to score with the ensemble mean (default: out of fold "
+                      "predictions of the nTupleGroups)")
+  parser.add_argument("-i", "--input", metavar = "NAME", type = str, dest = "models", default = None,
+                      help = "Name the fold models were saved with (kFold.py -o), default <cut>Model<fold>.")
+  parser.add_argument("-o", "--output", metavar = "OUTPUT", type = str, dest = "outputfile",
+                      default = "kFoldNTuples/ensemble.root", help = "Out of fold predictions ntuple, kept apart from "
+                      "the predictions of kFold.py (kFoldNTuples/predictions.root) unless given.")
+  parser.add_argument("--outputdir", metavar = "DIRECTORY", type = str, dest = "outputdir", default = "ensembleNTuples",
+                      help = "Directory of the ensemble predictions of the given ntuples.")
+  parser.add_argument("--stream", action = "store_true", dest = "stream", default = False,
+                      help = "Folds and scaler of kFold.py --stream.")
+  parser.add_argument("--compression", type = str, dest = "compression", choices = list(COMPRESSION), default = "zstd",
+                      help = "Compression algorithm of the output ntuples.")
+  parser.add_argument("--compressionlevel", metavar = "LEVEL", type = int, dest = "compressionlevel", default = 5,
+                      help = "Compression level (1-9) of the output ntuples.")
+  args = parser.parse_args()
+
+  if args.files:
+    scoreFiles(args)
+  else:
+    scoreOutOfFold(args)
@@ -1,25 +1,138 @@
-from array import array
-import ROOT
-import uproot
+import os
 import argparse
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from math import sqrt
-from keras.models import load_model
 from sklearn.metrics import accuracy_score
 from sklearn.model_selection import KFold
 from sklearn.preprocessing import StandardScaler
-from selectionPlots import findAllFilesInPath
+from trainingData import loadTrainingData, TrainingStream, prefetch
+from ntupleWriter import NTupleWriter, COMPRESSION
+from numpyHist import Hist, significanceCurves
 from plotting import predictionsROCPlotter
+from predictionCache import cachedPredict
+
+# Branches of the predictions ntuple: the prediction of the fold the event was tested in, and the event key (group
+# number and entry of the event in its nTupleGroups ntuple) to join the predictions to the ntuple columns
+PREDICTION_SCHEMA = {"prediction": "f4", "group": "i4", "entry": "i8", "fold": "i4", "weight": "f4"}
+
+# Thread pool sizes of OpenMP, the BLAS libraries and the TensorFlow backend, read when the libraries are loaded
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TF_NUM_INTRAOP_THREADS",
+                    "TF_NUM_INTEROP_THREADS")
+
+@contextmanager
+def workerThreads(nThreads):
+  ### Thread budget of the worker processes started in the block. A spawned worker loads numpy and its BLAS while it
+  #   imports this module, before a pool initializer could run, so the budget is set in the environment the workers
+  #   inherit and the previous values are restored after the block ###
+  previous = {variable: os.environ.get(variable) for variable in THREAD_VARIABLES}
+  os.environ.update(dict.fromkeys(THREAD_VARIABLES, str(nThreads)))
+  try:
+    yield
+  finally:
+    for variable, value in previous.items():
+      if value is None:
+        os.environ.pop(variable, None)
+      else:
+        os.environ[variable] = value
+
+def prepareRegion(cut, stream):
+  ### Data of a region shared by its 5 folds, prepared once: the scaler fitted on every event and the (train, test)
+  #   split of each fold. Without stream the splits are the event indices of the KFold split, with stream the
+  #   TrainingStream (which holds the scaler) and the folds of its event hash. Building it also builds the cached
+  #   training matrix, so the fold workers only map it ###
+  if stream:
+    return TrainingStream(cut, 0, 5), [(tuple(i for i in range(5) if i != fold), (fold,)) for fold in range(5)]
+
+  # Scaler of the features of every sample
+  x = loadTrainingData(cut)[0]
+  sc = StandardScaler().fit(x)
+
+  # Create a kFold object
+  kf = KFold(n_splits = 5, shuffle = True, random_state = 0)
+  return sc, list(kf.split(x))
+
+def trainFold(cut, fold, prepared, split, args):
+  ### Trains the model of one fold (1 to 5) of a region, saves it and plots its ROC curve. prepared and split are the
+  #   region's scaler (or stream) and the fold's (train, test) split from prepareRegion. Returns the predictions,
+  #   labels, weights and event keys (group number and entry) of the test events of the fold. The training matrix is
+  #   memory mapped, so the folds can run in separate worker processes ###
+  from keras.models import load_model
+  batch = 64 if cut == "2lep" else 128
+
+  ### GET THE DATA ###
+  train, test = split
+  if args.stream:
+    # Batches streamed from the memory mapped training matrix, with the folds given by a hash of the event index
+    stream = prepared
+  else:
+    # Features, labels (1 for signal, 0 for background), weights, group numbers and entries of every sample
+    x, y, weight, group_number, entry = loadTrainingData(cut)
+    sc = prepared
+  ### ###
+
+  model = load_model("nnModels/architechture" + cut + ".h5")
+  print("Starting fold", fold, "for", cut, "cut")
+
+  if args.stream:
+    y_train, y_test = stream.column("y", train), stream.column("y", test)
+    weights_test, group_test = stream.column("weight", test), stream.column("group", test)
+    entry_test = stream.column("entry", test)
+
+    # Fit the model and get the predictions
+    model.fit(prefetch(stream.batches(train, batch)), steps_per_epoch = stream.steps(train, batch), epochs = 10,
+              verbose = 0)
+    pred = stream.predict(model, test)
+    x_train, pred_train = None, stream.predict(model, train)
+  else:
+    # Scale the data
+    x_train, x_test = sc.transform(x[train]), sc.transform(x[test])
+    y_train, y_test = y[train], y[test]
+    weights_test = weight[test]
+    group_test = group_number[test]
+    entry_test = entry[test]
+
+    # Fit the model
+    model.fit(x_train, y_train, batch_size = batch, epochs = 10, verbose = 0)
+
+    # Get the predictions
+    pred = cachedPredict(model, x_test)
+    pred_train = None
+  # Round the predictions to the nearest integer
+  y_pred = np.rint(pred).astype(int)
+  # Get the accuracy
+  print("Accuracy for fold", fold, "for", cut, "cut: ", accuracy_score(y_test, y_pred))
+
+  # Save the model
+  if args.outputfile:
+    model.save("kFoldModels/" + args.outputfile + cut + str(fold) + ".h5")
+  else:
+    model.save("kFoldModels/" + cut + "Model" + str(fold) + ".h5")
+
+  # Plot the ROC curve
+  predictionsROCPlotter(model, pred, y_test, y_train, x_train, cut, "kFoldPlots/" + cut + str(fold) + ".png",
+                        pred_train = pred_train)
+
+  return pred[:, 0], np.asarray(y_test), np.asarray(weights_test), np.asarray(group_test), np.asarray(entry_test)
 
 def main(args):
-  # Get the samples from the outputNTuples folder, store them in a dictionary with 1 for signal and 0 for background
-  sample_names = findAllFilesInPath("*.root", "nTupleGroups/")
-  ntuple_samples = dict.fromkeys(sample_names, 0)
-  ntuple_samples["nTupleGroups/signalGroup.root"] = 1
-
-  # Tuple of variables to get from each file
-  variables = ("tauPtSum", "zMassSum", "metPt", "deltaRll", "deltaRtt", "deltaRttll", "deltaEtall", "deltaEtatt",
-              "nJets", "deltaPhill", "deltaPhitt", "deltaPhilltt", "mmc")
+  # ROOT is imported when it is used, not when --help is printed or the module is imported
+  import ROOT
+
+  ### TRAINING ###
+  # The 5 folds of both regions are independent, with --workers > 1 they run in parallel worker processes
+  regions = {cut: prepareRegion(cut, args.stream) for cut in ("2lep", "3lep")}
+  jobs = [(cut, fold) for cut in ("2lep", "3lep") for fold in range(1, 6)]
+  arguments = [(cut, fold, regions[cut][0], regions[cut][1][fold - 1], args) for cut, fold in jobs]
+  if args.workers > 1:
+    threads = args.threads or max(os.cpu_count()//min(args.workers, len(jobs)), 1)
+    with workerThreads(threads), ProcessPoolExecutor(min(args.workers, len(jobs)),
+                                                     mp_context = multiprocessing.get_context("spawn")) as pool:
+      results = dict(zip(jobs, pool.map(trainFold, *zip(*arguments))))
+  else:
+    results = {job: trainFold(*jobArguments) for job, jobArguments in zip(jobs, arguments)}
+  ### ###
 
   # Create a canvas
   ROOT.gROOT.LoadMacro('../atlasrootstyle/AtlasStyle.C')
@@ -29,115 +142,31 @@ def main(args):
   canvas = ROOT.TCanvas("c", "c", 800, 600)
   canvas.cd()
 
-  # Create a TTree to store the predictions and the group number for kFoldCutting
-  output_ntuple_file = ROOT.TFile.Open(("kFoldNTuples/predictions.root"), "RECREATE")
+  # Create a file to store the predictions for kFoldCutting
+  ntuple_writer = NTupleWriter("kFoldNTuples/predictions.root", args.compression, args.compressionlevel)
 
   for cut in ["2lep", "3lep"]: # Loop over the different selection cuts (2 and 3 lepton)
-    batch = 64 if cut == "2lep" else 128
-
-    ### GET THE DATA ###
-    x = np.array([])
-    y = np.array([])
-    weight = np.array([])
-    group_number = np.array([])
-
-    # Create a TTree to store the predictions and the group number for kFoldCutting
-    ntuple = ROOT.TTree("nominal" + cut, "nominal" + cut)
-    prediction_array = array('f', [0])
-    ntuple.Branch("prediction", prediction_array, "prediction/F")
-    group_array = array('f', [0])
-    ntuple.Branch("group", group_array, "group/F")
-
-    for sample in ntuple_samples: # Loop over the samples
-      with uproot.open(sample + ":nominal" + cut) as tree:
-        x_temp = tree.arrays(variables, library = "pd")
-        weight_temp = tree["weight"].array(library = "np")
-
-      x_temp = x_temp.iloc[:, :].values
-
-      # 1 for signal, 0 for background
-      y_temp = np.zeros(len(x_temp)) if ntuple_samples[sample] == 0 else np.ones(len(x_temp))
-
-      # Concatenate the arrays
-      x = np.concatenate((x, x_temp)) if x.size else x_temp
-      y = np.concatenate((y, y_temp)) if y.size else y_temp
-      weight = np.concatenate((weight, weight_temp)) if weight.size else weight_temp
-
-      # Add the group number to identify sample groups for kFoldCutting
-      match sample:
-        case "nTupleGroups/signalGroup.root":
-          group_number = np.concatenate((group_number, np.zeros(len(x_temp))))
-        case "nTupleGroups/llllGroup.root":
-          group_number = np.concatenate((group_number, np.ones(len(x_temp))))
-        case "nTupleGroups/backgroundGroup.root":
-          group_number = np.concatenate((group_number, np.full(len(x_temp), 2)))
-        case "nTupleGroups/jetsGroup.root":
-          group_number = np.concatenate((group_number, np.full(len(x_temp), 3)))
-
-    # Scale the data
-    sc = StandardScaler()
-    x = sc.fit_transform(x)
-    ### ###
-
-    # Create a kFold object
-    kf = KFold(n_splits = 5, shuffle = True, random_state = 0)
-
-    # Create a ROOT histogram for the predictions and fill it
-    signal_predictions = ROOT.TH1D("Signalpredictions" + cut, "Predictions " + cut + " " + ";Prediction;Events", 13, 0, 1)
-    background_predictions = ROOT.TH1D("Backgroundpredictions" + cut, "Predictions " + cut + " " + ";Prediction;Events", 13, 0, 1)
-
-    i = 1
-    # Loop over the kFold splits
-    for train, test in kf.split(x):
-      model = load_model("nnModels/architechture" + cut + ".h5")
-
-      x_train, x_test = x[train], x[test]
-      y_train, y_test = y[train], y[test]
-      weights_test = weight[test]
-      group_test = group_number[test]
-
-      print("Starting fold", i, "for", cut, "cut")
-      # Fit the model
-      model.fit(x_train, y_train, batch_size = batch, epochs = 10, verbose = 0)
-
-      # Get the predictions
-      pred = model.predict(x_test)
-      # Round the predictions to the nearest integer
-      y_pred = np.rint(pred).astype(int)
-      # Get the accuracy
-      print("Accuracy for fold", i, ": ", accuracy_score(y_test, y_pred))
-
-      # Save the model
-      if args.outputfile:
-        model.save("kFoldModels/" + args.outputfile + cut + str(i) + ".h5")
-      else:
-        model.save("kFoldModels/" + cut + "Model" + str(i) + ".h5")
-
-      # Plot the ROC curve
-      predictionsROCPlotter(model, pred, y_test, y_train, x_train, cut, "kFoldPlots/" + cut + str(i) + ".png")
+    # Create a TTree to store the predictions and the event keys for kFoldCutting
+    ntuple_writer.book("nominal" + cut, PREDICTION_SCHEMA)
 
-      # Arrays of predictions for signal and background
-      pred_signal = array('d', pred[y_test == 1])
-      pred_background = array('d', pred[y_test == 0])
-      # Arrays of weights for signal and background
-      weights_signal = array('d', weights_test[y_test == 1])
-      weights_background = array('d', weights_test[y_test == 0])
+    # Create a histogram for the predictions and fill it
+    signal_predictions = Hist("Signalpredictions" + cut, "Predictions " + cut + " " + ";Prediction;Events", 13, 0, 1)
+    background_predictions = Hist("Backgroundpredictions" + cut, "Predictions " + cut + " " + ";Prediction;Events", 13, 0, 1)
 
-      # Fill the histogram (must use python arrays)
-      signal_predictions.FillN(len(pred_signal), pred_signal, weights_signal)
-      background_predictions.FillN(len(pred_background), pred_background, weights_background)
+    # Gather the folds in order
+    for fold in range(1, 6):
+      pred, y_test, weights_test, group_test, entry_test = results[(cut, fold)]
 
-      # Fill the TTree
-      for j in range(len(pred)):
-        prediction_array[0] = pred[j]
-        group_array[0] = group_test[j]
-        ntuple.Fill()
+      # Fill the histograms with the predictions for signal and background
+      signal_predictions.fill(pred[y_test == 1], weights_test[y_test == 1])
+      background_predictions.fill(pred[y_test == 0], weights_test[y_test == 0])
 
-      i += 1
+      # Fill the TTree with the whole fold at once
+      ntuple_writer.extend("nominal" + cut, {"prediction": pred, "group": group_test, "entry": entry_test,
+                                             "fold": np.full(len(pred), fold), "weight": weights_test})
 
     # Save the TTree
-    ntuple.Write()
-    del ntuple
+    ntuple_writer.flush("nominal" + cut)
 
     # # Save the signal histogram to a ROOT file
     # root_file = ROOT.TFile.Open("kFoldRoot/prediction" + cut + ".root", "RECREATE")
@@ -153,17 +182,19 @@ def main(args):
     leg.SetTextSize(0.03)
     leg.SetEntrySeparation(0.001)
 
-    histos = [signal_predictions, background_predictions]
     colours = [ROOT.kRed, ROOT.kBlue]
     sample_name = ["Signal", "Background"]
     prediction_yield = 0
-    for i in range(len(histos)):
-      hist = histos[i]
-      prediction_yield += hist.Integral(0, hist.GetNbinsX() + 1)
-      hist.SetLineColor(colours[i])
+    for hist in (signal_predictions, background_predictions):
+      prediction_yield += hist.integral(0, hist.nBins + 1)
 
       # Normalise the histograms
-      hist.Scale(1./hist.Integral())
+      hist.scale(1./hist.integral())
+
+    # ROOT copies for drawing
+    histos = [signal_predictions.toTH1D(), background_predictions.toTH1D()]
+    for i in range(len(histos)):
+      histos[i].SetLineColor(colours[i])
 
     if histos[0].GetMaximum() > histos[1].GetMaximum():
       maximum = histos[0].GetMaximum()
@@ -186,31 +217,11 @@ def main(args):
     ### END OF PLOTTING ###
 
     ### SB ratio histograms ###
-    sb_1 = signal_predictions.Clone("SBsignal1" + cut)
-    sb_2 = signal_predictions.Clone("SBsignal2" + cut)
-
-    for i in range(1, signal_predictions.GetNbinsX() + 1):
-      # Calculate the S/sqrt(S+B) up to bin i
-      signal_yield = signal_predictions.Integral(0, i)
-      background_yield = background_predictions.Integral(0, i)
-      try:
-        SoverSqrtSB = signal_yield/sqrt(signal_yield + background_yield)
-      except ZeroDivisionError:
-        SoverSqrtSB = 0
-      except ValueError:
-        SoverSqrtSB = 0
-      sb_1.SetBinContent(i, SoverSqrtSB)
-
-      # Calculate the S/sqrt(S+B) from bin i to the end
-      signal_yield = signal_predictions.Integral(i, signal_predictions.GetNbinsX() + 1)
-      background_yield = background_predictions.Integral(i, background_predictions.GetNbinsX() + 1)
-      try:
-        SoverSqrtSB = signal_yield/sqrt(signal_yield + background_yield)
-      except ZeroDivisionError:
-        SoverSqrtSB = 0
-      except ValueError:
-        SoverSqrtSB = 0
-      sb_2.SetBinContent(i, SoverSqrtSB)
+    # S/sqrt(S+B) up to each bin and from each bin to the end
+    sb_1 = signal_predictions.clone("SBsignal1" + cut)
+    sb_2 = signal_predictions.clone("SBsignal2" + cut)
+    sb_1.sumw[1:-1], sb_2.sumw[1:-1] = significanceCurves(signal_predictions, background_predictions)
+    sb_1, sb_2 = sb_1.toTH1D(), sb_2.toTH1D()
 
     sb_1.SetMaximum(sb_1.GetBinContent(sb_1.GetMaximumBin())*1.3)
     sb_1.SetLineWidth(3)
@@ -230,12 +241,22 @@ def main(args):
     # print("Yield for cut", cut, "is", prediction_yield)
 
   # Close the output ntuple file
-  output_ntuple_file.Close()
+  ntuple_writer.close()
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description = "Train a neural network on the nTuples.")
   parser.add_argument("-o", "--output", metavar = "OUTPUT", type = str, dest = "outputfile", default = None,
                       help = "Ouptut file name for the model to be saved into.")
+  parser.add_argument("--compression", type = str, dest = "compression", choices = list(COMPRESSION), default = "zstd",
+                      help = "Compression algorithm of the predictions ntuple.")
+  parser.add_argument("--compressionlevel", metavar = "LEVEL", type = int, dest = "compressionlevel", default = 5,
+                      help = "Compression level (1-9) of the predictions ntuple.")
+  parser.add_argument("--stream", action = "store_true", dest = "stream", default = False,
+                      help = "Stream the training input in batches instead of loading every event in memory.")
+  parser.add_argument("-w", "--workers", type = int, dest = "workers", default = 1,
+                      help = "Number of folds trained in parallel worker processes, over both regions.")
+  parser.add_argument("-t", "--threads", type = int, dest = "threads", default = None,
+                      help = "Threads per worker process (default: the cores shared between the workers).")
   args = parser.parse_args()
 
   main(args)
@@ -1,19 +1,28 @@
-from array import array
 import uproot
-import ROOT
 import numpy as np
-from selectionPlots import findAllFilesInPath
-
-def significance_calc(bin, signal_hist, background_hist):
-  signal_yield = signal_hist.GetBinContent(bin)
-  background_yield = background_hist.GetBinContent(bin)
-  try:
-    sb = signal_yield/np.sqrt(signal_yield + background_yield)
-  except RuntimeWarning:
-    sb = 0
-  return sb
+import pandas as pd
+from numpyHist import Hist
+from trainingData import eventColumns
+
+def significance_calc(signal_hist, background_hist):
+  # S/sqrt(S+B) of every bin (1 to nBins), 0 where S+B is not positive
+  signal_yield = signal_hist.sumw[1:-1]
+  total_yield = signal_yield + background_hist.sumw[1:-1]
+  return np.divide(signal_yield, np.sqrt(np.maximum(total_yield, 0)), out = np.zeros_like(signal_yield),
+                   where = total_yield > 0)
+
+def loadPredictions(cut, branches, columns = (), fileName = "kFoldNTuples/predictions.root"):
+  ### DataFrame of branches of the kFold.py predictions (prediction, fold, weight) with the event key (group, entry),
+  #   joined by key to columns of the nTupleGroups ntuples. Only the branches and columns asked for are read ###
+  with uproot.open(fileName + ":nominal" + cut) as tree:
+    predictions = pd.DataFrame(tree.arrays(list(dict.fromkeys(("group", "entry", *branches))), library = "np"))
+  if not columns:
+    return predictions
+  return predictions.merge(eventColumns(cut, columns), on = ["group", "entry"], how = "left", validate = "one_to_one")
 
 def main():
+  import ROOT
+
   # Create a canvas
   ROOT.gROOT.LoadMacro('../atlasrootstyle/AtlasStyle.C')
   ROOT.gROOT.LoadMacro('../atlasrootstyle/AtlasUtils.C')
@@ -22,9 +31,6 @@ def main():
   canvas = ROOT.TCanvas("c", "c", 800, 600)
   canvas.cd()
 
-  # Get the samples from the outputNTuples folder, store them in a dictionary with 1 for signal and 0 for background
-  sample_names = findAllFilesInPath("*.root", "nTupleGroups/")
-
   # Thresholds for 2lep, 3lep cuts
   thresholds = (0.52, 0.15)
 
@@ -37,27 +43,6 @@ def main():
       "signal": np.array([])
     }
     weight_dict = dict.fromkeys(delta_phi_ll_dict, np.array([]))
-    predictions_dict = dict.fromkeys(delta_phi_ll_dict, np.array([]))
-
-    # Get the delta phi ll arrays for each sample
-    for sample in sample_names:
-      match sample:
-        case "nTupleGroups/signalGroup.root":
-          key = "signal"
-        case "nTupleGroups/llllGroup.root":
-          key = "llll"
-        case "nTupleGroups/backgroundGroup.root":
-          key = "other di-boson"
-        case "nTupleGroups/jetsGroup.root":
-          key = "jets"
-      with uproot.open(sample + ":nominal" + cut) as tree:
-        delta_phi_ll_dict[key] = tree["deltaPhill"].array(library = "np")
-        weight_dict[key] = tree["weight"].array(library = "np")
-
-    # Get predictions and group number from kFold.py ntuples
-    with uproot.open("kFoldNTuples/predictions.root:nominal" + cut) as f:
-      prediction = f["prediction"].array(library = "np")
-      group_number = f["group"].array(library = "np")
 
     # Dictionary of group numbers
     group_dict = {
@@ -67,39 +52,38 @@ def main():
       "signal": 0
     }
 
-    # Sort predictions into groups
-    for key in predictions_dict:
-      predictions_dict[key] = prediction[group_number == group_dict[key]]
+    # Predictions and weights from kFold.py ntuples, joined by event key to the delta phi ll of the nTupleGroups
+    events = loadPredictions(cut, ("prediction", "weight"), ("deltaPhill",))
 
-    # Cut delta phi ll arrays using threshold
+    # Cut delta phi ll arrays using threshold, and sort them into groups
+    events = events[events["prediction"] > threshold]
     for key in delta_phi_ll_dict:
-      delta_phi_ll_dict[key] = delta_phi_ll_dict[key][predictions_dict[key] > threshold]
-      weight_dict[key] = weight_dict[key][predictions_dict[key] > threshold]
+      selected = events[events["group"] == group_dict[key]]
+      delta_phi_ll_dict[key] = selected["deltaPhill"].to_numpy()
+      weight_dict[key] = selected["weight"].to_numpy()
 
     # Generate histogram for output
     delta_phi_ll_histograms =  {
-      "llll": ROOT.TH1D("llll" + cut, "delta_phi_ll" + cut + ";#Delta #phi_{ll} (Rad);Normalised Counts", 8, -3.14, 3.14),
-      "other di-boson": ROOT.TH1D("di-boson" + cut, "delta_phi_ll" + cut + ";#Delta #phi_{ll} (Rad);Normalised Counts", 8, -3.14, 3.14),
-      "jets": ROOT.TH1D("jets" + cut, "delta_phi_ll" + cut + ";#Delta #phi_{ll} (Rad);Normalised Counts", 8, -3.14, 3.14),
-      "signal": ROOT.TH1D("signal" + cut, "delta_phi_ll" + cut + ";#Delta #phi_{ll} (Rad);Normalised Counts", 8, -3.14, 3.14)
+      "llll": Hist("llll" + cut, "delta_phi_ll" + cut + ";#Delta #phi_{ll} (Rad);Normalised Counts", 8, -3.14, 3.14),
+      "other di-boson": Hist("di-boson" + cut, "delta_phi_ll" + cut + ";#Delta #phi_{ll} (Rad);Normalised Counts", 8, -3.14, 3.14),
+      "jets": Hist("jets" + cut, "delta_phi_ll" + cut + ";#Delta #phi_{ll} (Rad);Normalised Counts", 8, -3.14, 3.14),
+      "signal": Hist("signal" + cut, "delta_phi_ll" + cut + ";#Delta #phi_{ll} (Rad);Normalised Counts", 8, -3.14, 3.14)
     }
 
     # Fill histogram with delta phi ll values
     for key in delta_phi_ll_dict:
-      arr = array('d', delta_phi_ll_dict[key])
-      weight_arr = array('d', weight_dict[key])
-      delta_phi_ll_histograms[key].FillN(len(arr), arr, weight_arr)
+      delta_phi_ll_histograms[key].fill(delta_phi_ll_dict[key], weight_dict[key])
 
     # Print yields
     print("Yields for " + cut + " cut")
     background_yield = 0
     for key in delta_phi_ll_histograms:
-      max_bin = delta_phi_ll_histograms[key].GetNbinsX() + 1
+      max_bin = delta_phi_ll_histograms[key].nBins + 1
       if key == "signal":
-        signal_yield = delta_phi_ll_histograms[key].Integral(0, max_bin)
+        signal_yield = delta_phi_ll_histograms[key].integral(0, max_bin)
         print("Signal yield: ", signal_yield)
       else:
-        temp_yield = delta_phi_ll_histograms[key].Integral(0, max_bin)
+        temp_yield = delta_phi_ll_histograms[key].integral(0, max_bin)
         print(key, "yield: ", temp_yield)
         background_yield += temp_yield
     print("S/B:", signal_yield/background_yield)
@@ -115,21 +99,26 @@ def main():
     colours = [ROOT.kBlack, ROOT.kBlue, ROOT.kGreen, ROOT.kRed]
     maximum = -999
     stacked_hist = ROOT.THStack()
+    stacked_parts = [] # keeps the stacked copies alive while the stack is drawn
+    drawn_histograms = {} # ROOT copies of the normalised histograms
     for i, key in enumerate(delta_phi_ll_histograms):
       hist = delta_phi_ll_histograms[key]
-      hist.SetLineColor(colours[i])
 
-      stacked_hist.Add(hist.Clone())
+      stacked_parts.append(hist.toTH1D(hist.name + "Stack"))
+      stacked_parts[-1].SetLineColor(colours[i])
+      stacked_hist.Add(stacked_parts[-1])
 
       # Normalise the histograms
-      hist.Scale(1./hist.Integral())
+      hist.scale(1./hist.integral())
+      drawn_histograms[key] = hist.toTH1D()
+      drawn_histograms[key].SetLineColor(colours[i])
 
       # Get the maximum value of the histograms
-      if hist.GetMaximum() > maximum and key != "jets":
-        maximum = hist.GetMaximum()
+      if drawn_histograms[key].GetMaximum() > maximum and key != "jets":
+        maximum = drawn_histograms[key].GetMaximum()
 
-    for i, key in enumerate(delta_phi_ll_histograms):
-      hist = delta_phi_ll_histograms[key]
+    for i, key in enumerate(drawn_histograms):
+      hist = drawn_histograms[key]
       if i == 0:
         hist.SetMaximum(maximum * 1.2)
         hist.Draw("hist")
@@ -149,26 +138,26 @@ def main():
     leg.SetBorderSize(0)
     leg.SetTextSize(0.03)
     leg.SetEntrySeparation(0.001)
-    for i, key in enumerate(delta_phi_ll_histograms):
-      hist = delta_phi_ll_histograms[key]
+    for i, key in enumerate(drawn_histograms):
+      hist = drawn_histograms[key]
       leg.AddEntry(hist, key, "l")
 
     stacked_hist.Draw("hist")
     leg.Draw('SAME')
-    stacked_hist.GetXaxis().SetTitle(delta_phi_ll_histograms["llll"].GetXaxis().GetTitle())
-    stacked_hist.GetYaxis().SetTitle(delta_phi_ll_histograms["llll"].GetYaxis().GetTitle())
+    stacked_hist.GetXaxis().SetTitle(drawn_histograms["llll"].GetXaxis().GetTitle())
+    stacked_hist.GetYaxis().SetTitle(drawn_histograms["llll"].GetYaxis().GetTitle())
     canvas.SaveAs("signedDeltaPhill/stack_" + cut + ".pdf")
     canvas.Clear()
     ### END OF PLOTTING ###
 
     ### SIGNIFICANCE PLOTTING ###
-    sig_1 = delta_phi_ll_histograms["signal"].Clone("SBsignal1" + cut)
-    total_background = delta_phi_ll_histograms["llll"].Clone("SBbackground" + cut)
-    total_background.Add(delta_phi_ll_histograms["other di-boson"])
-    total_background.Add(delta_phi_ll_histograms["jets"])
+    sig_1 = delta_phi_ll_histograms["signal"].clone("SBsignal1" + cut)
+    total_background = delta_phi_ll_histograms["llll"].clone("SBbackground" + cut)
+    total_background.add(delta_phi_ll_histograms["other di-boson"])
+    total_background.add(delta_phi_ll_histograms["jets"])
 
-    for i in range(1, sig_1.GetNbinsX() + 1):
-      sig_1.SetBinContent(i, significance_calc(i, delta_phi_ll_histograms["signal"], total_background))
+    sig_1.sumw[1:-1] = significance_calc(delta_phi_ll_histograms["signal"], total_background)
+    sig_1 = sig_1.toTH1D()
 
     sig_1.SetMaximum(sig_1.GetBinContent(sig_1.GetMaximumBin())*1.1)
     sig_1.SetLineWidth(3)
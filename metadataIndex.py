@@ -0,0 +1,77 @@
+import os
+import json
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import uproot
+
+# Histogram bins holding the sum of weights: bin 8 of h_metadata, or the theory weights used for ZHlltt and ggZH
+SUM_OF_WEIGHTS_BINS = (("h_metadata", 8), ("h_metadata_theory_weights", 110), ("h_metadata_theory_weights", 111))
+
+def sumOfWeightsKey(sample):
+  # Key of the sum of weights used to normalise a sample, as in the original pre-pass of selectionPlots.main
+  if sample == "ZHlltt":
+    return "h_metadata_theory_weights:110"
+  elif sample == "ggZH":
+    return "h_metadata_theory_weights:111"
+  return "h_metadata:8"
+
+def fileStamp(fileName):
+  stat = os.stat(fileName)
+  return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+def contentHash(fileName, blockSize = 1 << 24):
+  # Hash of the file content, used to key results derived from the file (e.g. the partial results of selectionPlots).
+  # It reads the whole file, so it is only computed for the indexes that ask for it (loadMetadata(hashes = True))
+  digest = hashlib.sha1()
+  with open(fileName, "rb") as inputFile:
+    for block in iter(lambda: inputFile.read(blockSize), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+def scanFile(fileName):
+  ### Reads the metadata of one input file: sums of weights, NOMINAL entries and tree names ###
+  entry = fileStamp(fileName)
+  with uproot.open(fileName) as inputFile:
+    classNames = inputFile.classnames(recursive = False, cycle = False)
+    entry["sumOfWeights"] = {}
+    for histName, histBin in SUM_OF_WEIGHTS_BINS:
+      if histName in classNames:
+        # values with flow bins has the same indexing as TH1::GetBinContent
+        entry["sumOfWeights"][histName + ":" + str(histBin)] = float(inputFile[histName].values(flow = True)[histBin])
+    entry["trees"] = sorted(name for name, className in classNames.items() if className == "TTree")
+    entry["entries"] = inputFile["NOMINAL"].num_entries if "NOMINAL" in entry["trees"] else 0
+  return entry
+
+def loadMetadata(fileNames, indexPath, nWorkers = 16, hashes = False):
+  ### Returns the metadata of every file, keyed by path. Entries are cached in the JSON index at indexPath and only
+  #   rescanned (in parallel) for files that are new or whose size or modification time changed. With hashes, the
+  #   entries also get the contentHash of their file, computed once per file version ###
+  index = {}
+  if os.path.exists(indexPath):
+    with open(indexPath) as indexFile:
+      index = json.load(indexFile)
+
+  stale = [fileName for fileName in fileNames
+           if fileName not in index
+           or {key: index[fileName].get(key) for key in ("size", "mtime")} != fileStamp(fileName)]
+  if stale:
+    with ThreadPoolExecutor(min(nWorkers, len(stale))) as pool:
+      for fileName, entry in zip(stale, pool.map(scanFile, stale)):
+        index[fileName] = entry
+  unhashed = [fileName for fileName in fileNames if "contentHash" not in index[fileName]] if hashes else []
+  if unhashed:
+    with ThreadPoolExecutor(min(nWorkers, len(unhashed))) as pool:
+      for fileName, fileHash in zip(unhashed, pool.map(contentHash, unhashed)):
+        index[fileName]["contentHash"] = fileHash
+
+  metadata = {fileName: index[fileName] for fileName in fileNames}
+  if stale or unhashed or len(index) != len(metadata):
+    # write to a temporary file of its own first, so an interrupted run never leaves a truncated index and runs
+    # updating the same index at the same time each replace it with a complete one
+    os.makedirs(os.path.dirname(indexPath) or ".", exist_ok = True)
+    with tempfile.NamedTemporaryFile("w", dir = os.path.dirname(indexPath) or ".", prefix = os.path.basename(indexPath),
+                                     suffix = ".tmp", delete = False) as indexFile:
+      json.dump(metadata, indexFile, indent = 1)
+    os.replace(indexFile.name, indexPath)
+  return metadata
@@ -1,11 +1,17 @@
 import argparse
 import numpy as np
-from keras.models import load_model
 from sklearn.metrics import accuracy_score
 from nnTrain import getSplitData
+from predictionCache import cachedPredict
 from plotting import predictionsROCPlotter, shapPlotter
 
 def main(args):
+  if args.numpy:
+    # numpy forward pass of the weights of the .h5 files, TensorFlow and Keras are not imported
+    from numpyInference import loadModel as load_model
+  else:
+    from keras.models import load_model
+
   for cut in ["2lep", "3lep"]: # Loop over the different selection cuts (2 and 3 lepton)
 
     x_train, x_test, y_train, y_test = getSplitData(cut, 0)
@@ -20,7 +26,7 @@ def main(args):
       print(model.summary())
 
     # Predict the labels
-    pred = model.predict(x_test)
+    pred = cachedPredict(model, x_test)
     # Round the predictions to the nearest integer
     y_pred = np.rint(pred).astype(int)
 
@@ -42,6 +48,8 @@ if __name__ == "__main__":
     help = "Whether to plot the SHAP values or not.")
   parser.add_argument("-v", "--verbose", action = "store_true", dest = "verbose", default = None,
     help = "Whether to print out the model summary or not.")
+  parser.add_argument("-n", "--numpy", action = "store_true", dest = "numpy", default = None,
+    help = "Whether to score with the numpy forward pass (numpyInference.py) instead of Keras.")
   args = parser.parse_args()
 
   main(args)
@@ -1,41 +1,13 @@
-import uproot
 import argparse
-import numpy as np
-from keras.optimizers import Adam
-from keras.layers import Dense
-from keras.models import Sequential
-from keras.callbacks import EarlyStopping
 from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import train_test_split
-from selectionPlots import findAllFilesInPath
+from trainingData import loadTrainingData, TrainingStream, prefetch
+from predictionCache import cachedPredict
 from plotting import predictionsROCPlotter, trainingPlotter
 
 def getSplitData(cut, seed):
-  # Get the samples from the outputNTuples folder, store them in a dictionary with 1 for signal and 0 for background
-  sampleNames = findAllFilesInPath("*.root", "nTupleGroups/")
-  nTupleSamples = dict.fromkeys(sampleNames, 0)
-  nTupleSamples["nTupleGroups/signalGroup.root"] = 1
-
-  # Tuple of variables to get from each file
-  variables = ("tauPtSum", "zMassSum", "metPt", "deltaRll", "deltaRtt", "deltaRttll", "deltaEtall", "deltaEtatt",
-               "nJets", "deltaPhill", "deltaPhitt", "deltaPhilltt", "mmc")
-
-  x = np.array([])
-  y = np.array([])
-
-  for sample in nTupleSamples: # Loop over the samples
-    with uproot.open(sample + ":nominal" + cut) as tree:
-      x_temp = tree.arrays(variables, library = "pd")
-      weight = tree["weight"].array(library = "np")
-
-    x_temp = x_temp.iloc[:, :].values
-
-    # 1 for signal, 0 for background
-    y_temp = np.zeros(len(x_temp)) if nTupleSamples[sample] == 0 else np.ones(len(x_temp))
-
-    # Concatenate the arrays
-    x = np.concatenate((x, x_temp)) if x.size else x_temp
-    y = np.concatenate((y, y_temp)) if y.size else y_temp
+  # Features and labels of every nTupleGroups sample (1 for signal, 0 for background), from the cached training matrix
+  x, y = loadTrainingData(cut)[:2]
 
   # Scale the data
   sc = StandardScaler()
@@ -46,10 +18,25 @@ def getSplitData(cut, seed):
 
   return x_train, x_test, y_train, y_test
 
+# Folds of the TrainingStream used for training and testing with --stream: 80% and 20% of the events, like getSplitData
+TRAIN_FOLDS = (1, 2, 3, 4)
+TEST_FOLDS = (0,)
+
 def main(args):
+  # keras is only imported for training, getSplitData is also used by scripts that never build a model
+  from keras.optimizers import Adam
+  from keras.layers import Dense
+  from keras.models import Sequential
+  from keras.callbacks import EarlyStopping
+
   for cut in ["2lep", "3lep"]: # Loop over the different selection cuts (2 and 3 lepton)
 
-    x_train, x_test, y_train, y_test = getSplitData(cut, 0)
+    if args.stream:
+      # Batches streamed from the memory mapped training matrix, the memory used does not depend on the number of events
+      stream = TrainingStream(cut, 0)
+      x_train, x_test, y_train, y_test = None, None, stream.column("y", TRAIN_FOLDS), stream.column("y", TEST_FOLDS)
+    else:
+      x_train, x_test, y_train, y_test = getSplitData(cut, 0)
 
     # Create the model
     model = Sequential()
@@ -65,8 +52,13 @@ def main(args):
     stop_early = EarlyStopping(monitor = "val_loss", patience = 5, restore_best_weights = True, verbose = 1)
 
     # Train the model
-    model_fit = model.fit(x_train, y_train, validation_data = (x_test, y_test), epochs=50, batch_size=64,
-                         callbacks=[stop_early])
+    if args.stream:
+      model_fit = model.fit(prefetch(stream.batches(TRAIN_FOLDS, 64)), steps_per_epoch = stream.steps(TRAIN_FOLDS, 64),
+                            validation_data = prefetch(stream.batches(TEST_FOLDS, 64, shuffle = False)),
+                            validation_steps = stream.steps(TEST_FOLDS, 64), epochs = 50, callbacks = [stop_early])
+    else:
+      model_fit = model.fit(x_train, y_train, validation_data = (x_test, y_test), epochs=50, batch_size=64,
+                           callbacks=[stop_early])
 
     # Save the model
     if args.outputfile:
@@ -75,16 +67,19 @@ def main(args):
       model.save("nnModels/trained" + cut + ".h5")
 
     # Predict the labels
-    pred = model.predict(x_test)
+    pred = stream.predict(model, TEST_FOLDS) if args.stream else cachedPredict(model, x_test)
+    pred_train = stream.predict(model, TRAIN_FOLDS) if args.stream else None
 
     # Plot graphs
     trainingPlotter(model_fit, cut)
-    predictionsROCPlotter(model, pred, y_test, y_train, x_train, cut)
+    predictionsROCPlotter(model, pred, y_test, y_train, x_train, cut, pred_train = pred_train)
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description = "Train a neural network on the nTuples.")
   parser.add_argument("-o", "--output", metavar = "OUTPUT", type = str, dest = "outputfile", default = None,
                       help = "Ouptut file name for the model to be saved into.")
+  parser.add_argument("--stream", action = "store_true", dest = "stream", default = False,
+                      help = "Stream the training input in batches instead of loading every event in memory.")
   args = parser.parse_args()
 
   main(args)
@@ -0,0 +1,49 @@
+import numpy as np
+import uproot
+
+# Compression algorithms of the output ntuples, used with a level from 1 to 9
+COMPRESSION = {"zlib": uproot.ZLIB, "lzma": uproot.LZMA, "lz4": uproot.LZ4, "zstd": uproot.ZSTD}
+
+class NTupleWriter:
+  ### Writes flat trees from whole arrays per branch, replacing one TTree::Fill per event.
+  #   Each tree has a typed schema {branch: dtype}; the arrays given to extend are cast to it and buffered until
+  #   basketSize entries are reached, so every basket is written in one go ###
+  def __init__(self, fileName, compression = "zstd", level = 5, basketSize = 100000):
+    self.file = uproot.recreate(fileName, compression = COMPRESSION[compression](level))
+    self.basketSize = basketSize
+    self.schemas = {}
+    self.buffers = {}
+    self.entries = {}
+
+  def book(self, treeName, schema):
+    self.schemas[treeName] = {branch: np.dtype(dtype) for branch, dtype in schema.items()}
+    self.buffers[treeName] = []
+    self.entries[treeName] = 0
+    self.file.mktree(treeName, self.schemas[treeName])
+
+  def extend(self, treeName, columns):
+    # columns may hold more arrays than the schema (e.g. passCuts), only the booked branches are written
+    chunk = {branch: np.asarray(columns[branch]).astype(dtype, copy = False)
+             for branch, dtype in self.schemas[treeName].items()}
+    self.buffers[treeName].append(chunk)
+    self.entries[treeName] += len(next(iter(chunk.values())))
+    if self.entries[treeName] >= self.basketSize:
+      self.flush(treeName)
+
+  def flush(self, treeName = None):
+    for name in ([treeName] if treeName is not None else list(self.buffers)):
+      if self.buffers[name]:
+        self.file[name].extend({branch: np.concatenate([chunk[branch] for chunk in self.buffers[name]])
+                                for branch in self.schemas[name]})
+        self.buffers[name] = []
+        self.entries[name] = 0
+
+  def close(self):
+    self.flush()
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exception):
+    self.close()
@@ -0,0 +1,140 @@
+import numpy as np
+import uproot
+
+class Hist:
+  ### Fixed binning 1D histogram backed by numpy arrays of the sum of weights and of squared weights.
+  #   Bins follow the TH1 convention: index 0 is the underflow, 1 to nBins the axis and nBins + 1 the overflow.
+  #   The statistics (entries, sums of w, w2, wx, wx2 in range) are kept like TH1::Fill for the conversion to TH1D ###
+  def __init__(self, name, title, nBins, low, high):
+    self.name = name
+    self.title = title
+    self.nBins = nBins
+    self.low = float(low)
+    self.high = float(high)
+    self.sumw = np.zeros(nBins + 2)
+    self.sumw2 = np.zeros(nBins + 2)
+    self.stats = np.zeros(5) # entries, sum w, sum w2, sum wx, sum wx2
+
+  def clone(self, name = None):
+    other = Hist(self.name if name is None else name, self.title, self.nBins, self.low, self.high)
+    other.sumw[:] = self.sumw
+    other.sumw2[:] = self.sumw2
+    other.stats[:] = self.stats
+    return other
+
+  def findBin(self, values):
+    # TAxis::FindFixBin, with its correction of values rounded into the neighbouring bin. NaN goes to the overflow
+    values = np.asarray(values, dtype = np.float64)
+    width = (self.high - self.low)/self.nBins
+    with np.errstate(invalid = "ignore"):
+      bins = np.clip((1 + self.nBins*(values - self.low)/(self.high - self.low)).astype(np.int64), 1, self.nBins)
+      bins = np.where(values < self.low + (bins - 1)*width, bins - 1,
+                      np.where(values >= self.low + bins*width, bins + 1, bins))
+    return np.where(values < self.low, 0, np.where(values < self.high, bins, self.nBins + 1))
+
+  def fill(self, values, weights = None):
+    ### Weighted fill of a whole array, equivalent to one TH1::Fill per value in the same order. Every sum is
+    #   accumulated value by value onto the current contents, so the results round like the TH1::Fill calls whatever
+    #   the chunking: np.bincount would sum each chunk from zero before adding it to the contents ###
+    values = np.asarray(values, dtype = np.float64)
+    weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype = np.float64)
+    bins = self.findBin(values)
+    np.add.at(self.sumw, bins, weights)
+    np.add.at(self.sumw2, bins, weights*weights)
+
+    inRange = (bins > 0) & (bins <= self.nBins)
+    x, w = values[inRange], weights[inRange]
+    self.stats[0] += len(values)
+    for i, value in enumerate((w, w*w, w*x, w*x*x), 1):
+      # running sum starting from the current total
+      self.stats[i] = np.cumsum(np.concatenate(([self.stats[i]], value)))[-1]
+
+  def add(self, other, scale = 1.):
+    # TH1::Add(other, scale)
+    self.sumw += scale*other.sumw
+    self.sumw2 += scale*scale*other.sumw2
+    self.stats += other.stats*(1., scale, scale*scale, scale, scale)
+
+  def scale(self, factor):
+    # TH1::Scale(factor)
+    self.sumw *= factor
+    self.sumw2 *= factor*factor
+    self.stats[1:] *= (factor, factor*factor, factor, factor)
+
+  def integral(self, first = 1, last = None):
+    ### TH1::Integral(first, last), flow bins excluded by default. Summed in bin order like ROOT ###
+    last = self.nBins if last is None else last
+    return float(np.cumsum(self.sumw[first:last + 1])[-1]) if last >= first else 0.
+
+  def cumulative(self, forward = True):
+    ### Integral(0, i) for every bin i (forward) or Integral(i, nBins + 1) (backward), flow bins included ###
+    return np.cumsum(self.sumw) if forward else np.cumsum(self.sumw[::-1])[::-1]
+
+  def toTH1D(self, name = None):
+    ### TH1D copy for drawing with ROOT. Contents and errors are copied in bulk into the TH1D's own arrays ###
+    import ROOT
+    hist = ROOT.TH1D(self.name if name is None else name, self.title, self.nBins, self.low, self.high)
+    hist.SetDirectory(0)
+    hist.Sumw2()
+    np.frombuffer(hist.GetArray(), dtype = np.float64, count = self.nBins + 2)[:] = self.sumw
+    np.frombuffer(hist.GetSumw2().GetArray(), dtype = np.float64, count = self.nBins + 2)[:] = self.sumw2
+    hist.PutStats(np.ascontiguousarray(self.stats[1:]))
+    hist.SetEntries(self.stats[0])
+    return hist
+
+  @classmethod
+  def fromTH1(cls, hist):
+    titles = (hist.GetTitle(), hist.GetXaxis().GetTitle(), hist.GetYaxis().GetTitle())
+    nBins = hist.GetNbinsX()
+    other = cls(hist.GetName(), ";".join(titles).rstrip(";"), nBins, hist.GetXaxis().GetXmin(),
+                hist.GetXaxis().GetXmax())
+    other.sumw[:] = np.frombuffer(hist.GetArray(), dtype = np.float64, count = nBins + 2)
+    if hist.GetSumw2N():
+      other.sumw2[:] = np.frombuffer(hist.GetSumw2().GetArray(), dtype = np.float64, count = nBins + 2)
+    else:
+      other.sumw2[:] = other.sumw
+    stats = np.zeros(4)
+    hist.GetStats(stats)
+    other.stats[:] = (hist.GetEntries(), *stats)
+    return other
+
+  def toUproot(self):
+    # "title;x axis title;y axis title" as in the TH1 constructor
+    title, xTitle, yTitle = (self.title.split(";") + ["", ""])[:3]
+    return uproot.writing.identify.to_TH1x(self.name, title, self.sumw, *self.stats, self.sumw2,
+      uproot.writing.identify.to_TAxis("xaxis", xTitle, self.nBins, self.low, self.high),
+      uproot.writing.identify.to_TAxis("yaxis", yTitle, 1, 0., 1.))
+
+  @classmethod
+  def fromUproot(cls, hist):
+    xAxis, yAxis = hist.member("fXaxis"), hist.member("fYaxis")
+    title = ";".join((hist.member("fTitle"), xAxis.member("fTitle"), yAxis.member("fTitle"))).rstrip(";")
+    other = cls(hist.member("fName"), title, xAxis.member("fNbins"), xAxis.member("fXmin"), xAxis.member("fXmax"))
+    other.sumw[:] = hist.values(flow = True)
+    other.sumw2[:] = hist.variances(flow = True)
+    other.stats[:] = [hist.member(key) for key in ("fEntries", "fTsumw", "fTsumw2", "fTsumwx", "fTsumwx2")]
+    return other
+
+def writeHists(fileName, hists):
+  ### Writes the histograms to a new ROOT file, readable as TH1D ###
+  with uproot.recreate(fileName) as outputFile:
+    for hist in hists:
+      outputFile[hist.name] = hist.toUproot()
+
+def readHists(fileName, names = None):
+  ### Reads every TH1 of a ROOT file (or only names) into a dictionary {name: Hist}, opening the file once ###
+  with uproot.open(fileName) as inputFile:
+    if names is None:
+      names = [name for name, className in inputFile.classnames(cycle = False).items() if className.startswith("TH1")]
+    return {name: Hist.fromUproot(inputFile[name]) for name in names}
+
+def significanceCurves(signal, background):
+  ### S/sqrt(S+B) for bins 1 to nBins, integrating up to each bin and from each bin to the end (flow bins included).
+  #   Bins where S+B is not positive are set to 0 ###
+  curves = []
+  for forward in (True, False):
+    signalYield = signal.cumulative(forward)[1:-1]
+    totalYield = signalYield + background.cumulative(forward)[1:-1]
+    curves.append(np.divide(signalYield, np.sqrt(np.maximum(totalYield, 0)), out = np.zeros_like(signalYield),
+                            where = totalYield > 0))
+  return curves
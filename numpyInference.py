@@ -0,0 +1,113 @@
+import os
+import json
+import argparse
+import numpy as np
+
+## Forward pass of the trained classifiers with numpy only.
+#  The networks of nnTrain and kFold are Sequential stacks of Dense layers (13 -> 30 -> 18 -> 16 -> 1), so scoring is a
+#  few matrix products that do not need TensorFlow or Keras. Models are read from the Keras .h5 files with h5py, or
+#  from the compact .npz weight files written by exportModel
+
+def sigmoid(x):
+  with np.errstate(over = "ignore"):
+    return 1/(1 + np.exp(-x))
+
+# Activations of the Dense layers, as keras.activations
+ACTIVATIONS = {"linear": lambda x: x, "relu": lambda x: np.maximum(x, 0), "sigmoid": sigmoid, "tanh": np.tanh}
+
+def decode(name):
+  return name.decode() if isinstance(name, bytes) else str(name)
+
+def layersFromH5(fileName):
+  ### (kernel, bias, activation) of every Dense layer of a Sequential model saved by model.save(<name>.h5), read with
+  #   h5py. The weights of a layer are listed in its weight_names attribute, kernel first ###
+  import h5py
+  with h5py.File(fileName, "r") as modelFile:
+    config = json.loads(decode(modelFile.attrs["model_config"]))
+    # Keras 2 stores the layers of a Sequential model as the config itself, Keras 3 under "layers"
+    configs = config["config"]["layers"] if isinstance(config["config"], dict) else config["config"]
+    activations = {}
+    for layer in configs:
+      if layer["class_name"] == "Dense":
+        activations[layer["config"]["name"]] = layer["config"]["activation"]
+      elif layer["class_name"] not in ("InputLayer", "Dropout"):
+        raise ValueError("layer " + layer["config"]["name"] + " of " + fileName + " is a " + layer["class_name"]
+                         + ", only Dense layers are supported")
+
+    layers = []
+    weightsGroup = modelFile["model_weights"]
+    for layerName in map(decode, weightsGroup.attrs["layer_names"]):
+      weightNames = list(map(decode, weightsGroup[layerName].attrs["weight_names"]))
+      if not weightNames:
+        continue
+      kernel = np.asarray(weightsGroup[layerName][weightNames[0]], dtype = np.float32)
+      bias = (np.asarray(weightsGroup[layerName][weightNames[1]], dtype = np.float32) if len(weightNames) > 1
+              else np.zeros(kernel.shape[1], np.float32))
+      layers.append((kernel, bias, activations[layerName]))
+  return layers
+
+def layersFromModel(model):
+  # (kernel, bias, activation) of every Dense layer of a Keras model in memory
+  layers = []
+  for layer in model.layers:
+    weights = layer.get_weights()
+    if weights:
+      bias = weights[1] if len(weights) > 1 else np.zeros(weights[0].shape[1], np.float32)
+      layers.append((weights[0].astype(np.float32), bias.astype(np.float32), layer.get_config()["activation"]))
+  return layers
+
+class NumpyModel:
+  ### Batched forward pass of a stack of Dense layers in float32, a replacement of model.predict for scoring. It is
+  #   callable, so it can also be given to shap.Explainer ###
+  def __init__(self, layers):
+    for _, _, activation in layers:
+      if activation not in ACTIVATIONS:
+        raise ValueError("activation " + activation + " is not supported")
+    self.layers = layers
+
+  def predict(self, x, batch_size = 65536, verbose = 0):
+    # (number of events, number of outputs) like model.predict, computed batch_size events at a time
+    x = np.asarray(x, dtype = np.float32)
+    outputs = np.empty((len(x), self.layers[-1][0].shape[1]), np.float32)
+    for start in range(0, len(x), batch_size):
+      values = x[start:start + batch_size]
+      for kernel, bias, activation in self.layers:
+        values = ACTIVATIONS[activation](values @ kernel + bias)
+      outputs[start:start + batch_size] = values
+    return outputs
+
+  __call__ = predict
+
+  def summary(self):
+    lines = ["Dense %d -> %d, %s" % (kernel.shape[0], kernel.shape[1], activation)
+             for kernel, _, activation in self.layers]
+    return "\n".join(lines + ["Total parameters: %d" % sum(kernel.size + bias.size for kernel, bias, _ in self.layers)])
+
+  def save(self, fileName):
+    ### Compact weight file (.npz): kernel<i>, bias<i> and the activation of every layer ###
+    arrays = {"activations": np.array([activation for _, _, activation in self.layers])}
+    for i, (kernel, bias, _) in enumerate(self.layers):
+      arrays["kernel" + str(i)], arrays["bias" + str(i)] = kernel, bias
+    np.savez(fileName, **arrays)
+
+def loadModel(fileName):
+  ### NumpyModel of a .npz weight file or of a Keras .h5 file, the numpy counterpart of keras.models.load_model ###
+  if fileName.endswith(".h5"):
+    return NumpyModel(layersFromH5(fileName))
+  with np.load(fileName) as arrays:
+    return NumpyModel([(arrays["kernel" + str(i)], arrays["bias" + str(i)], str(activation))
+                       for i, activation in enumerate(arrays["activations"])])
+
+def exportModel(model, fileName):
+  # Writes the weights of a Keras model, in memory or saved as .h5, to a .npz weight file
+  NumpyModel(layersFromH5(model) if isinstance(model, str) else layersFromModel(model)).save(fileName)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Export trained Keras models (.h5) to .npz weight files for the numpy "
+    "forward pass, e.g. python numpyInference.py nnModels/*.h5 kFoldModels/*.h5")
+  parser.add_argument("models", nargs = "+", help = "Keras .h5 model files, each written to <name>.npz")
+  args = parser.parse_args()
+
+  for modelName in args.models:
+    exportModel(modelName, os.path.splitext(modelName)[0] + ".npz")
+    print(modelName, "->", os.path.splitext(modelName)[0] + ".npz")
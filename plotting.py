@@ -1,12 +1,17 @@
-import shap
-import matplotlib
-import matplotlib.pyplot as plt
 from sklearn.metrics import roc_curve, auc
+from predictionCache import cachedPredict
 
-matplotlib.use("SVG") # Use SVG for matplotlib
+def pyplot():
+  # matplotlib is imported by the first plot, not when the module is imported
+  import matplotlib
+  matplotlib.use("SVG") # Use SVG for matplotlib
+  import matplotlib.pyplot as plt
+  return plt
 
-def predictionsROCPlotter(model, pred, y_test, y_train, X_train, cut, filename = None):
-  ### Plots Predictions and ROC curve ###
+def predictionsROCPlotter(model, pred, y_test, y_train, X_train, cut, filename = None, pred_train = None):
+  ### Plots Predictions and ROC curve. pred_train replaces the predictions of X_train, e.g. predicted batch by batch
+  #   when the training set does not fit in memory. Otherwise X_train is predicted once per model and input ###
+  plt = pyplot()
   fpr, tpr, thresholds = roc_curve(y_test, pred) # Calculate the ROC curve
   rocArea = auc(fpr, tpr) # Calculate the area under the ROC curve
 
@@ -27,8 +32,10 @@ def predictionsROCPlotter(model, pred, y_test, y_train, X_train, cut, filename =
   signalPredictionTest = pred[y_test == 1]
   backgroundPredictionTest = pred[y_test == 0]
   # verbose = 0 means no output
-  signalPredictionTrain = model.predict(X_train, verbose = 0)[y_train == 1]
-  backgroundPredictionTrain = model.predict(X_train, verbose = 0)[y_train == 0]
+  if pred_train is None:
+    pred_train = cachedPredict(model, X_train, verbose = 0)
+  signalPredictionTrain = pred_train[y_train == 1]
+  backgroundPredictionTrain = pred_train[y_train == 0]
 
   # Plot the predictions
   plt.figure(figsize = (8, 6))
@@ -47,6 +54,7 @@ def predictionsROCPlotter(model, pred, y_test, y_train, X_train, cut, filename =
 
 def trainingPlotter(modelFit, cut):
   ### Plots the loss and accuracy for each epoch of training ###
+  plt = pyplot()
   for i in ("loss", "accuracy"):
     plt.figure(figsize = (8, 6))
     plt.plot(modelFit.history[i])
@@ -60,6 +68,8 @@ def trainingPlotter(modelFit, cut):
 
 def shapPlotter(model, X_train, cut):
   ### Plots the SHAP values ###
+  import shap
+  plt = pyplot()
 
   # Tuple of variables to get from each file
   variables = ("tauPtSum", "zMassSum", "metPt", "deltaRll", "deltaRtt", "deltaRttll", "deltaEtall", "deltaEtatt",
@@ -0,0 +1,25 @@
+import weakref
+import hashlib
+import numpy as np
+
+# Predictions of this process, keyed by (id of the model, fingerprint of the input). The model is held by a weak
+# reference, so an entry is dropped once its model is deleted and its id can not be mistaken for a new model's
+CACHE = {}
+
+def fingerprint(x):
+  # Shape, type and hash of the content of an input array
+  x = np.ascontiguousarray(x)
+  return x.shape, x.dtype.str, hashlib.sha1(x.view(np.uint8)).hexdigest()
+
+def cachedPredict(model, x, **kwargs):
+  ### model.predict(x), computed once per (model, input) pair, e.g. for the test set predictions used by both the
+  #   accuracy and the plots. kwargs (verbose, batch_size) do not change the predictions and are not part of the key ###
+  for key in [key for key, (reference, _) in CACHE.items() if reference() is None]:
+    del CACHE[key]
+  key = (id(model), fingerprint(x))
+  if key not in CACHE or CACHE[key][0]() is not model:
+    CACHE[key] = (weakref.ref(model), model.predict(x, **kwargs))
+  return CACHE[key][1]
+
+def clear():
+  CACHE.clear()
@@ -0,0 +1,189 @@
+import ROOT
+import json
+import numpy as np
+from cutFlow import SELECTIONS, VARIABLE_CUTS
+from kinematics import REAL_Z_MASS
+from selectionPlots import MMC_LEPTON_BRANCHES, VECTOR_COLUMNS, fillOutputs
+from runMetrics import stage
+
+# Order of the features in the vector returned by zhtt::features
+FEATURES = ("tauPtSum", "zMassSum", "metPt", "deltaRll", "deltaRtt", "deltaEtall", "deltaEtatt", "deltaRttll",
+            "nJets", "deltaPhill", "deltaPhitt", "deltaPhilltt", "mmc")
+
+# C++ helpers of the rdf engine, JIT compiled once per process: the derived columns used by the cuts of cutFlow.py and
+# the features of the selected events
+SELECTION_CODE = """
+#include <cmath>
+#include <limits>
+#include <stdexcept>
+#include <string>
+#include <vector>
+#include "TLorentzVector.h"
+#include "ROOT/RVec.hxx"
+#include "ROOT/RDF/RSampleInfo.hxx"
+
+namespace zhtt {
+
+const double REAL_Z_MASS = %r;
+
+// Index in fileNames (the files of the chain, in order) of the file of a sample ("<file name>/NOMINAL")
+int fileIndex(const ROOT::RDF::RSampleInfo& sample, const std::vector<std::string>& fileNames) {
+  for (std::size_t i = 0; i < fileNames.size(); ++i) {
+    if (sample.AsString() == fileNames[i] + "/NOMINAL") return i;
+  }
+  throw std::runtime_error("zhtt::fileIndex: " + sample.AsString() + " is not an input file");
+}
+
+// Isolation working point of each lepton's own flavour (muons 1, electrons 2), as cutFlow.isolated
+template <typename Flavour, typename EIso, typename MuIso>
+ROOT::RVecB isolated(const Flavour& flavour, const EIso& eIso, const MuIso& muIso) {
+  ROOT::RVecB result(flavour.size());
+  for (std::size_t i = 0; i < flavour.size(); ++i) {
+    result[i] = flavour[i] == 1 ? muIso[i] == 1 : flavour[i] == 2 && eIso[i] == 1;
+  }
+  return result;
+}
+
+// Z candidate of cutFlow.bestZCandidate: {found, index of the first lepton not in the pair, Z lepton indices}. The
+// opposite sign same flavour pair with the mass closest to the Z mass is kept, a tie for the closest pair is not found
+template <typename P4s, typename Flavour, typename Charge>
+ROOT::RVecI zPairing(const P4s& leptons, const Flavour& flavour, const Charge& charge) {
+  double best = std::numeric_limits<double>::infinity();
+  int nBest = 0, zIndex1 = 0, zIndex2 = 1;
+  for (int i = 0; i < int(flavour.size()); ++i) {
+    for (int j = i + 1; j < int(flavour.size()); ++j) {
+      if (flavour[i] != flavour[j] || charge[i] != -charge[j] || charge[i] == 0) continue;
+      const double distance = std::fabs((leptons[i] + leptons[j]).M() - REAL_Z_MASS);
+      if (distance < best) {
+        best = distance;
+        nBest = 1;
+        zIndex1 = i;
+        zIndex2 = j;
+      } else if (distance == best) {
+        ++nBest;
+      }
+    }
+  }
+  int leftIndex = 0;
+  while (leftIndex == zIndex1 || leftIndex == zIndex2) ++leftIndex;
+  return {nBest == 1, leftIndex, zIndex1, zIndex2};
+}
+
+double getDeltaPhill(const TLorentzVector& Zlep1, const TLorentzVector& Zlep2) {
+  return Zlep1.Eta() > Zlep2.Eta() ? Zlep1.DeltaPhi(Zlep2) : Zlep2.DeltaPhi(Zlep1);
+}
+
+// Features of a selected event, in the order of FEATURES
+ROOT::RVecD features(const TLorentzVector& tau1, const TLorentzVector& tauOrLep, const TLorentzVector& Zlep1,
+                     const TLorentzVector& Zlep2, double mmc, double metPt, double nJets) {
+  return {tau1.Pt() + tauOrLep.Pt(), (Zlep1 + Zlep2).M(), metPt, Zlep1.DeltaR(Zlep2), tau1.DeltaR(tauOrLep),
+          std::fabs(Zlep1.Eta() - Zlep2.Eta()), std::fabs(tau1.Eta() - tauOrLep.Eta()),
+          (tau1 + tauOrLep).DeltaR(Zlep1 + Zlep2), nJets, getDeltaPhill(Zlep1, Zlep2), tau1.DeltaPhi(tauOrLep),
+          (Zlep1 + Zlep2).DeltaPhi(tau1 + tauOrLep), mmc};
+}
+
+}
+""" % REAL_Z_MASS
+
+# The branches under the column names of cutFlow.selectColumns, which the C++ expressions of the cuts use
+ALIASES = {"tauP4": "taus_p4", "leptonP4": "leptons_p4", "mmcTauTau": "mmc_tau0_tau1_mmc_mlm_m",
+           **{column: branch for column, (branch, _) in VECTOR_COLUMNS.items()}}
+
+# The other columns of the cuts, the derived ones as cutFlow.DERIVED. They are only computed for the events reaching a
+# cut or feature using them
+COLUMNS = {
+  "nTaus": "int(taus_p4.size())",
+  "nLeptons": "int(leptons_p4.size())",
+  "mmcLeptons": "ROOT::RVecD{" + ", ".join(MMC_LEPTON_BRANCHES) + "}",
+  "isolated": "zhtt::isolated(flavour, eIso, muIso)",
+  "mll": "(leptonP4[0] + leptonP4[1]).M()",
+  "zPairing": "zhtt::zPairing(leptonP4, flavour, charge)",
+  "zMass": "(leptonP4[zPairing[2]] + leptonP4[zPairing[3]]).M()",
+  "leftoverLepton": "leptonP4[zPairing[1]]"
+}
+
+# (tau1, tauOrLep, Zlep1, Zlep2, mmc) of the events passing the selection of a region, as cutFlow.regionObjects
+REGION_OBJECTS = {
+  "2lep": "tauP4[0], tauP4[1], leptonP4[0], leptonP4[1], mmcTauTau",
+  "3lep": "tauP4[0], leftoverLepton, leptonP4[zPairing[2]], leptonP4[zPairing[3]], mmcLeptons[zPairing[1]]"
+}
+
+def declareSelection():
+  # Only declare the C++ code once per process
+  if not hasattr(ROOT, "zhtt"):
+    ROOT.gInterpreter.Declare(SELECTION_CODE)
+
+def runRDataFrame(fileNames, luminosity, sumAllMC, outputs, nThreads = 0, variations = (), cutFlows = None):
+  ### RDataFrame event loop with implicit multithreading, filling outputs[region] = (ntupleWriter, treeName,
+  #   histograms, variationHistograms) and cutFlows[region] if given. The cuts of cutFlow.py are a chain of filters
+  #   per region, counted after each one; they run interleaved on several threads, so the cut flow has no time per cut.
+  #   The selected events are collected in the graph, then the histograms and the ntuple are filled in chain order,
+  #   (file, entry in the file) ###
+  ROOT.EnableImplicitMT(nThreads)
+  declareSelection()
+
+  chain = ROOT.TChain("NOMINAL")
+  for fileName in fileNames:
+    chain.Add(fileName)
+  df = ROOT.RDataFrame(chain)
+  # with several threads rdfentry_ is not the entry of the chain, only its order within a file is kept, so the events
+  # are ordered by their file first. The file names are given as C++ string literals (JSON strings are valid ones)
+  df = df.DefinePerSample("fileIndex", "zhtt::fileIndex(rdfsampleinfo_, {%s})" % ", ".join(map(json.dumps, fileNames)))
+
+  # calculates weight for each event, in double precision like the per-event loop
+  df = df.Define("wTotal", "((double) cross_section * %r * (double) pu_NOMINAL_pileup_combined_weight"
+    " * (double) weight_mc)/%r" % (float(luminosity), float(sumAllMC)))
+  for variation in variations:
+    df = df.Define(variation.column, variation.rdfExpression(luminosity, sumAllMC))
+  for column, branch in ALIASES.items():
+    df = df.Alias(column, branch)
+  for column, expression in COLUMNS.items():
+    df = df.Define(column, expression)
+
+  columnResults = {}
+  cutFlowResults = {}
+  for region, cuts in SELECTIONS.items():
+    counted = [("all events", df)]
+    regionDf = df
+    for name, _, expression in cuts:
+      regionDf = regionDf.Filter(expression, name)
+      counted.append((name, regionDf))
+    regionDf = regionDf.Define("features", "zhtt::features(%s, met_p4.Pt(), n_jets_30)" % REGION_OBJECTS[region])
+    for i, feature in enumerate(FEATURES):
+      regionDf = regionDf.Define(feature, "features[%d]" % i)
+
+    # the variable cuts only decide which selected events go in the histograms
+    passingDf = regionDf
+    for name, _, expression in VARIABLE_CUTS[region]:
+      passingDf = passingDf.Filter(expression, name)
+      counted.append((name, passingDf))
+    regionDf = regionDf.Define("passCuts", " && ".join("(" + expression + ")"
+                                                       for _, _, expression in VARIABLE_CUTS[region]))
+    if cutFlows is not None:
+      cutFlowResults[region] = [(name, node.Count(), node.Sum("wTotal")) for name, node in counted]
+
+    columnResults[region] = {key: regionDf.Take["double"](key) for key in FEATURES}
+    columnResults[region]["weight"] = regionDf.Take["double"]("wTotal")
+    for variation in variations:
+      columnResults[region][variation.column] = regionDf.Take["double"](variation.column)
+    columnResults[region]["passCuts"] = regionDf.Take["bool"]("passCuts")
+    columnResults[region]["entry"] = regionDf.Take["ULong64_t"]("rdfentry_")
+    columnResults[region]["fileIndex"] = regionDf.Take["int"]("fileIndex")
+
+  # Triggers the single (multithreaded) event loop for every booked result. Reading, selection and features run
+  # interleaved in the graph, so they are timed as one stage
+  with stage("event loop"):
+    ROOT.RDF.RunGraphs([result for region in columnResults for result in columnResults[region].values()]
+                       + [result for region in cutFlowResults for _, *results in cutFlowResults[region]
+                          for result in results])
+
+  for region in outputs:
+    columns = {key: np.array(result.GetValue()) for key, result in columnResults[region].items()}
+    order = np.lexsort((columns.pop("entry"), columns.pop("fileIndex"))) # threads finish out of order
+    fillOutputs({key: values[order] for key, values in columns.items()}, *outputs[region])
+  for region, counters in cutFlowResults.items():
+    for name, count, weighted in counters:
+      cutFlows[region].add(name, count.GetValue(), weighted.GetValue())
+
+  ROOT.DisableImplicitMT()
+  return chain.GetEntries()
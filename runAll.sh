@@ -1,3 +1 @@
-source ./runSignal.sh
-source ./runBackground.sh
-source ./runJets.sh
+python runSamples.py "$@"
@@ -0,0 +1,76 @@
+import os
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+class RunMetrics:
+  ### Wall time per stage of a selection run and number of selected events per output tree, written as JSON.
+  #   Stages are summed over every time they run, so a stage timed once per chunk gives its total over the run ###
+  def __init__(self):
+    self.start = time.perf_counter()
+    self.stages = {}
+    self.regions = {}
+
+  def add(self, name, seconds):
+    self.stages[name] = self.stages.get(name, 0.) + seconds
+
+  @contextmanager
+  def stage(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add(name, time.perf_counter() - start)
+
+  def count(self, treeName, selected, passCuts):
+    region = self.regions.setdefault(treeName, {"selected": 0, "passCuts": 0})
+    region["selected"] += int(selected)
+    region["passCuts"] += int(passCuts)
+
+  def report(self, **info):
+    ### Dictionary of the metrics, with info (sample, engine, number of events, ...) at the top ###
+    wallTime = time.perf_counter() - self.start
+    events = info.get("events", 0)
+    # ru_maxrss is in kB on Linux, the children are the worker processes of the sharded engines
+    return {**info, "wallTime": wallTime, "eventsPerSecond": events/wallTime if wallTime > 0 else 0.,
+            "stages": dict(self.stages), "regions": self.regions,
+            "peakRSSMB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+            "peakRSSChildrenMB": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024}
+
+  def write(self, fileName, **info):
+    os.makedirs(os.path.dirname(fileName) or ".", exist_ok = True)
+    with open(fileName, "w") as outputFile:
+      json.dump(self.report(**info), outputFile, indent = 2)
+      outputFile.write("\n")
+
+# Metrics of the run in this process, filled by the selection engines through the functions below
+METRICS = RunMetrics()
+
+def reset():
+  # Starts the metrics of a new run, e.g. at the start of selectionPlots.main
+  global METRICS
+  METRICS = RunMetrics()
+  return METRICS
+
+def stage(name):
+  return METRICS.stage(name)
+
+def add(name, seconds):
+  METRICS.add(name, seconds)
+
+def count(treeName, selected, passCuts):
+  METRICS.count(treeName, selected, passCuts)
+
+def timedIterate(iterable, name):
+  ### Yields the items of iterable, adding the time spent producing each one (e.g. reading a chunk) to stage name ###
+  iterator = iter(iterable)
+  while True:
+    start = time.perf_counter()
+    try:
+      item = next(iterator)
+    except StopIteration:
+      return
+    finally:
+      add(name, time.perf_counter() - start)
+    yield item
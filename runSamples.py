@@ -0,0 +1,144 @@
+import os
+import sys
+import time
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+# Samples previously started by runSignal.sh, runBackground.sh and runJets*.sh
+SAMPLE_GROUPS = {
+  "signal": ["ZHlltt", "ggZH"],
+  "background": ["ZqqZll", "WqqZll", "llll", "lllv", "llvv", "ttH", "llll_lowMllPtComplement",
+                 "lllv_lowMllPtComplement", "llvv_lowMllPtComplement"],
+  "jets": [flavour + "_" + slice for flavour in ("Zee", "Zmumu")
+           for slice in ("MV0_70_BF", "MV0_70_CFBV", "MV0_70_CVBV", "MV70_140_BF", "MV70_140_CFBV", "MV70_140_CVBV",
+                         "MV140_280_BF", "MV140_280_CFBV", "MV140_280_CVBV", "MV280_500_BF", "MV280_500_CFBV",
+                         "MV280_500_CVBV", "MV500_1000", "MV1000_E_CMS")]
+          + ["Ztt_MV0_70_l13l7", "Ztt_MV0_70_l15h20", "Ztt_MV280_500_BF", "Ztt_MV280_500_CFBV", "Ztt_MV280_500_CVBV",
+             "Ztt_MV500_1000", "Ztt_MV1000_E_CMS"]
+}
+
+def sampleSize(sample, inputDirectory = "rootData"):
+  # Total size in bytes of the input files of a sample, used to start the largest samples first
+  from fileUtils import findAllFilesInPath
+  fileNames = findAllFilesInPath("*.root", inputDirectory + "/" + sample + "/")
+  return sum(os.path.getsize(fileName) for fileName in fileNames)
+
+def runSample(sample, selectionArgs, logDirectory):
+  ### Runs selectionPlots.main for one sample in a worker process, with stdout and stderr (including ROOT's)
+  #   redirected to logDirectory/<sample>.log. Returns (sample, status, runtime, number of events) ###
+  logFile = open(os.path.join(logDirectory, sample + ".log"), "a")
+  sys.stdout.flush()
+  sys.stderr.flush()
+  os.dup2(logFile.fileno(), 1)
+  os.dup2(logFile.fileno(), 2)
+
+  start = time.perf_counter()
+  try:
+    import selectionPlots
+    nEvents = selectionPlots.main(selectionPlots.getParser().parse_args(["-i", sample] + selectionArgs))
+    status = "done"
+  except Exception:
+    traceback.print_exc()
+    nEvents = 0
+    status = "failed"
+  sys.stdout.flush()
+  sys.stderr.flush()
+  return sample, status, time.perf_counter() - start, nEvents
+
+def report(sample, status, runtime, nEvents, attempt):
+  rate = nEvents/runtime if runtime > 0 else 0
+  print("%-30s %-7s attempt %d  %8.1f s  %10d events  %9.0f events/s" % (sample, status, attempt, runtime, nEvents,
+    rate), flush = True)
+
+def schedule(samples, selectionArgs, nWorkers, retries, logDirectory):
+  ### Runs the samples over nWorkers worker processes, largest first, retrying failed samples.
+  #   Each worker handles a single sample so ROOT state is never shared between samples ###
+  attempts = dict.fromkeys(samples, 0)
+  results = {}
+  from selectionPlots import getParser
+  inputDirectory = getParser().parse_known_args(selectionArgs)[0].inputdir
+  sizes = {sample: sampleSize(sample, inputDirectory) for sample in samples}
+  for sample in samples:
+    if sizes[sample] == 0: # no input files, nothing to run
+      results[sample] = (sample, "missing", 0., 0)
+  queue = sorted((sample for sample in samples if sizes[sample] > 0), key = sizes.get, reverse = True)
+  context = multiprocessing.get_context("spawn")
+
+  running = {}
+  while queue or running:
+    while queue and len(running) < nWorkers:
+      # every sample runs in a pool of its own, so a worker crash (e.g. segfault) only breaks the pool of its sample
+      # and only that sample is charged an attempt
+      sample = queue.pop(0)
+      pool = ProcessPoolExecutor(1, mp_context = context)
+      running[pool.submit(runSample, sample, selectionArgs, logDirectory)] = (sample, pool)
+
+    done, _ = wait(running, return_when = FIRST_COMPLETED)
+    for future in done:
+      sample, pool = running.pop(future)
+      pool.shutdown()
+      attempts[sample] += 1
+      try:
+        result = future.result()
+      except BrokenProcessPool: # the worker of this sample crashed
+        result = (sample, "crashed", 0., 0)
+      report(*result, attempts[sample])
+
+      if result[1] != "done" and attempts[sample] <= retries:
+        queue.append(sample)
+      else:
+        results[sample] = result
+
+  return results, attempts
+
+def sampleJobs(nSamples, selectionArgs, jobs = None):
+  ### Number of samples run at the same time and the selectionPlots arguments, so the samples together use about
+  #   every core once: by default the cores are divided by the cores one sample uses (the rdf threads or the columnar
+  #   shard workers). An rdf run on every core (--threads 0) is given an equal share of the cores instead ###
+  from selectionPlots import getParser
+  options = getParser().parse_known_args(selectionArgs)[0]
+  cores = os.cpu_count() or 1
+  if options.engine == "rdf" and options.threads == 0:
+    jobs = jobs or min(nSamples, cores)
+    return jobs, selectionArgs + ["--threads", str(max(cores//jobs, 1))]
+  sampleCores = {"rdf": options.threads, "columnar": options.shards}.get(options.engine, 1)
+  return jobs or max(cores//sampleCores, 1), selectionArgs
+
+def main(args, selectionArgs):
+  samples = []
+  for name in (args.samples or list(SAMPLE_GROUPS)):
+    samples.extend(SAMPLE_GROUPS.get(name, [name]))
+  jobs, selectionArgs = sampleJobs(len(samples), selectionArgs, args.jobs)
+
+  os.makedirs(args.logdir, exist_ok = True)
+  start = time.perf_counter()
+  results, attempts = schedule(samples, selectionArgs, jobs, args.retries, args.logdir)
+  makespan = time.perf_counter() - start
+
+  # Summary of every sample, failures last
+  print("\nSummary (makespan %.1f s):" % makespan)
+  for result in sorted(results.values(), key = lambda result: result[1] != "done"):
+    report(*result, attempts[result[0]])
+  failed = [sample for sample, result in results.items() if result[1] != "done"]
+  if failed:
+    print("Failed samples:", " ".join(failed))
+  return 1 if failed else 0
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Run selectionPlots.py over many samples with a bounded process pool. "
+    "Unrecognised arguments are passed on to selectionPlots.py")
+  parser.add_argument("samples", nargs = "*", help = "samples or sample groups (" + ", ".join(SAMPLE_GROUPS) +
+    "), all groups by default")
+  parser.add_argument("-j", "--jobs", type = int, dest = "jobs", default = None,
+    help = "number of samples processed at the same time, by default the number of cores divided by the threads or "
+    "shards of one sample; rdf samples without --threads share the cores between them")
+  parser.add_argument("-r", "--retries", type = int, dest = "retries", default = 1,
+    help = "number of times a failed sample is retried")
+  parser.add_argument("-l", "--logdir", type = str, dest = "logdir", default = "logs",
+    help = "directory for the per-sample logs")
+  args, selectionArgs = parser.parse_known_args()
+
+  sys.exit(main(args, selectionArgs))
@@ -1,141 +1,261 @@
 import ROOT
-import copy, re
+import os
 import argparse
-import math
-from array import array
-
-REAL_Z_MASS = 91.1876
-
-## Method to resolve regular expressions in file names.
-#  TChain::Add only supports wildcards in the last items, i.e. on file level.
-#  This method can resolve all wildcards at any directory level,
-#  e.g. /my/directory/a*test*/pattern/*.root
-#  @param pattern    the file name pattern using python regular expressions
-#  @return list of all files matching the pattern
-def findAllFilesInPath(pattern, path):
-  files = []
-  items = pattern.split( '/' )
-
-  def checkPath( path, items ):
-    # nested method to deal with the recursion
-    import ROOT
-    if not items:
-      return
-    myItems = copy.copy( items )
-    item = myItems.pop(0)
-    if '*' in item:
-      directory = ROOT.gSystem.OpenDirectory( path )
-      # beg and end of line control so that *truc does not match bla_truc_xyz
-      item = "^"+item.replace( '*', '.*' )+"$"
-      p = re.compile( item )
-      entry = True
-      while entry:
-        entry = ROOT.gSystem.GetDirEntry( directory )
-        if p.match( entry ):
-          if not myItems:
-            files.append( path + entry )
-          else:
-            checkPath( path + entry + '/', myItems)
-      ROOT.gSystem.FreeDirectory( directory )
-    elif item and not myItems:
-      files.append( path + item )
-    else:
-      checkPath( path + item + '/', myItems )
-  checkPath( path, items )
-  return files
-
-def fillHistograms(tau1, tauOrLep, Zlep1, Zlep2, met_p4, nJets, mmc, totalWeight, nTuples, newTree, histograms = None):
-  fillers = dict.fromkeys(nTuples.keys())
-  del fillers["weight"]
-
-  fillers["tauPtSum"] = tau1.Pt() + tauOrLep.Pt()
-  fillers["zMassSum"] = (Zlep1 + Zlep2).M()
-  fillers["metPt"] = (met_p4)
-  fillers["deltaRll"] = (Zlep1.DeltaR(Zlep2))
-  fillers["deltaRtt"] = (tau1.DeltaR(tauOrLep))
-  fillers["deltaEtall"] = (math.fabs(Zlep1.Eta() - Zlep2.Eta()))
-  fillers["deltaEtatt"] = (math.fabs(tau1.Eta() - tauOrLep.Eta()))
-  fillers["deltaRttll"] = ((tau1 + tauOrLep).DeltaR(Zlep1 + Zlep2))
-  fillers["nJets"] = (nJets)
-  fillers["deltaPhill"] = getDeltaPhill(Zlep1, Zlep2)
-  fillers["deltaPhitt"] = (tau1.DeltaPhi(tauOrLep))
-  fillers["deltaPhilltt"] = ((Zlep1 + Zlep2).DeltaPhi(tau1 + tauOrLep))
-  fillers["mmc"] = (mmc)
-
-  if histograms is not None:
-    for key in fillers:
-      nTuples[key][0] = fillers[key] # fills nTuples with values
-      histograms[key].Fill(fillers[key], totalWeight) #fills histograms
-  else:
-    for key in fillers:
-      nTuples[key][0] = fillers[key]
-
-  nTuples["weight"][0] = totalWeight
-  newTree.Fill()
+import time
+import numpy as np
+from fileUtils import findAllFilesInPath
+from cutFlow import CutFlow, selectColumns, writeCutFlows
+from kinematics import fromCartesian
+from metadataIndex import loadMetadata, sumOfWeightsKey
+from ntupleWriter import NTupleWriter, COMPRESSION
+from numpyHist import Hist, writeHists
+from weightVariations import parseVariations, variationBranches
+import runMetrics
+from runMetrics import stage
+
+# Branches of the NOMINAL tree used by the selection. Every other branch is disabled on the chain,
+# and only these are added to the read-ahead cache
+SELECTION_BRANCHES = ("taus_p4", "leptons_p4", "met_p4", "n_jets_30", "leptons", "leptons_q", "taus_q",
+  "cross_section", "taus_jet_rnn_medium", "pu_NOMINAL_pileup_combined_weight", "weight_mc", "leptons_id_tight",
+  "taus_ele_bdt_loose_retuned", "leptons_iso_FCLoose", "leptons_iso_TightTrackOnly_FixedRad",
+  "mmc_tau0_tau1_mmc_mlm_m", "mmc_tau0_lep0_mmc_mlm_m", "mmc_tau0_lep1_mmc_mlm_m", "mmc_tau0_lep2_mmc_mlm_m")
+
+# MMC mass of the tau with each of the 3 leptons, indexed by the lepton paired with the tau
+MMC_LEPTON_BRANCHES = ("mmc_tau0_lep0_mmc_mlm_m", "mmc_tau0_lep1_mmc_mlm_m", "mmc_tau0_lep2_mmc_mlm_m")
+
+# Columns of the selection read from the vector branches by the event engine: column: (branch, values per event)
+VECTOR_COLUMNS = {"flavour": ("leptons", 3), "charge": ("leptons_q", 3), "tauCharge": ("taus_q", 2),
+  "rnnID": ("taus_jet_rnn_medium", 2), "idTight": ("leptons_id_tight", 3), "tauBdt": ("taus_ele_bdt_loose_retuned", 2),
+  "eIso": ("leptons_iso_FCLoose", 3), "muIso": ("leptons_iso_TightTrackOnly_FixedRad", 3)}
+
+# Every column of the selection (cutFlow.selectColumns) but the weight variations
+SELECTION_COLUMNS = ("nTaus", "nLeptons", "tauP4", "leptonP4", "metPt", "nJets", *VECTOR_COLUMNS, "mmcTauTau",
+  "mmcLeptons", "weight")
+
+# Peak working memory of the columnar selection of a chunk per uncompressed byte of its input branches
+MEMORY_EXPANSION = 4
+
+# Branches and types of the output ntuples (nominal2lep and nominal3lep), in the order of the histogram dictionaries
+NTUPLE_SCHEMA = {"tauPtSum": "f4", "zMassSum": "f4", "metPt": "f4", "deltaRll": "f4", "deltaRtt": "f4",
+  "deltaEtall": "f4", "deltaEtatt": "f4", "deltaRttll": "f4", "nJets": "i4", "deltaPhill": "f4", "deltaPhitt": "f4",
+  "deltaPhilltt": "f4", "mmc": "f4", "weight": "f4"}
+
+def fillOutputs(columns, ntupleWriter, treeName, histograms, variationHistograms = None):
+  # Fills the histograms with the events passing the variable cuts and writes every selected event to the ntuple.
+  # variationHistograms holds a histogram set per weight variation column, filled from the same events
+  passCuts = np.asarray(columns["passCuts"], dtype = bool)
+  runMetrics.count(treeName, len(passCuts), np.count_nonzero(passCuts))
+  histogramSets = {"weight": histograms, **(variationHistograms or {})}
+  with stage("histogram fill"):
+    for column, hists in histogramSets.items():
+      weights = np.asarray(columns[column], dtype = np.float64)[passCuts]
+      for key in hists:
+        hists[key].fill(np.asarray(columns[key], dtype = np.float64)[passCuts], weights)
+
+  with stage("tree write"):
+    fillNTuple(columns, ntupleWriter, treeName)
+
+def fillNTuple(columns, ntupleWriter, treeName):
+  # Writes the arrays (or lists) in columns to the tree treeName, all entries at once
+  ntupleWriter.extend(treeName, columns)
+
+def pruneBranches(tree, branches, cacheSize):
+  # Disables every branch not in branches and caches exactly those branches, cacheSize in bytes
+  tree.SetBranchStatus("*", 0)
+  for branch in branches:
+    tree.SetBranchStatus(branch, 1)
+  tree.LoadTree(0) # the cache needs a loaded tree, the chain carries it over to the following files
+  tree.SetCacheSize(cacheSize)
+  for branch in branches:
+    tree.AddBranchToCache(branch, True)
+  tree.StopCacheLearningPhase()
+
+# TTreePerfStats also counting the baskets decompressed during the run: every compressed basket read from the file
+# or the read-ahead cache goes through one UnzipEvent call
+PERF_STATS_CODE = """
+#include "TTreePerfStats.h"
+
+namespace zhttio {
+
+class BasketCountingPerfStats : public TTreePerfStats {
+public:
+  using TTreePerfStats::TTreePerfStats;
+  Long64_t GetBasketsUnzipped() const { return fBasketsUnzipped; }
+  void UnzipEvent(TObject *tree, Long64_t pos, Double_t start, Int_t complen, Int_t objlen) override {
+    ++fBasketsUnzipped;
+    TTreePerfStats::UnzipEvent(tree, pos, start, complen, objlen);
+  }
 
-def variableCutsIf(tau1, tauOrLep, Zlep1, Zlep2, mmc, etallValue):
-  deltaPhill = getDeltaPhill(Zlep1, Zlep2)
+private:
+  Long64_t fBasketsUnzipped = 0;
+};
+
+}
+"""
+
+def basketCountingPerfStats(name, tree):
+  # Only declare the C++ code once per process
+  if not hasattr(ROOT, "zhttio"):
+    ROOT.gInterpreter.Declare(PERF_STATS_CODE)
+  return ROOT.zhttio.BasketCountingPerfStats(name, tree)
+
+def printIOReport(bytesRead, readCalls, perfStats, ioTime, computeTime):
+  print("I/O: %.1f MB read in %d calls, %d baskets decompressed (unzip %.2f s, disk %.2f s)"
+    % (bytesRead/1e6, readCalls, perfStats.GetBasketsUnzipped(), perfStats.GetUnzipTime(), perfStats.GetDiskTime()))
+  print("I/O time: %.2f s, compute time: %.2f s (%.0f%% I/O)"
+    % (ioTime, computeTime, 100*ioTime/max(ioTime + computeTime, 1e-9)))
+
+def budgetSizes(tree, branches, schema, memoryBudget):
+  ### Chunk size (entries), output basket size (entries) and read-ahead cache size (bytes) keeping a run within
+  #   memoryBudget bytes: half of it for the chunk being selected, a quarter for the baskets buffered by the two
+  #   output trees and a quarter for the cache. The input size per entry is taken from the first file of the chain ###
+  if tree.LoadTree(0) < 0:
+    return 100000, 100000, memoryBudget//4
+  inputTree = tree.GetTree()
+  inputBytes = sum(inputTree.GetBranch(branch).GetTotBytes("*") for branch in branches)/max(inputTree.GetEntries(), 1)
+  outputBytes = sum(np.dtype(dtype).itemsize for dtype in schema.values())
+  return (max(int(memoryBudget/2/(MEMORY_EXPANSION*inputBytes)), 1), max(int(memoryBudget/4/(2*outputBytes)), 1),
+          memoryBudget//4)
+
+def firstP4s(vector, n):
+  # (px, py, pz, E) of the first n four-vectors of a TLorentzVector branch, padded with zero four-vectors
+  components = []
+  for i in range(min(len(vector), n)):
+    p4 = vector[i]
+    components.append((p4.Px(), p4.Py(), p4.Pz(), p4.E()))
+  return components + [(0., 0., 0., 0.)]*(n - len(components))
+
+def firstValues(vector, n):
+  # first n values of a vector branch, padded with zeros
+  values = [vector[i] for i in range(min(len(vector), n))]
+  return values + [0]*(n - len(values))
+
+def readEvent(tree, columns, luminosity, sumAllMC, variations = ()):
+  ### Appends the current entry of the tree to the lists of the selection columns (cutFlow.selectColumns), padded to
+  #   2 taus and 3 leptons like columnarSelection.chunkColumns. Four-vectors are kept as (px, py, pz, E) ###
+  taus_p4 = getattr(tree, "taus_p4")
+  leptons_p4 = getattr(tree, "leptons_p4")
+  met_p4 = getattr(tree, "met_p4")
+  columns["nTaus"].append(len(taus_p4))
+  columns["nLeptons"].append(len(leptons_p4))
+  columns["tauP4"].append(firstP4s(taus_p4, 2))
+  columns["leptonP4"].append(firstP4s(leptons_p4, 3))
+  columns["metPt"].append(met_p4.Pt())
+  columns["nJets"].append(getattr(tree, "n_jets_30"))
+  for column, (branch, n) in VECTOR_COLUMNS.items():
+    columns[column].append(firstValues(getattr(tree, branch), n))
+  columns["mmcTauTau"].append(getattr(tree, "mmc_tau0_tau1_mmc_mlm_m"))
+  columns["mmcLeptons"].append([getattr(tree, branch) for branch in MMC_LEPTON_BRANCHES])
+  # calculates weight for each event
+  columns["weight"].append((getattr(tree, "cross_section") * luminosity
+    * getattr(tree, "pu_NOMINAL_pileup_combined_weight") * getattr(tree, "weight_mc"))/sumAllMC)
+  for variation in variations:
+    columns[variation.column].append(variation.evaluate({branch: getattr(tree, branch)
+      for branch in variation.branches}, luminosity, sumAllMC))
+
+def selectEvents(columns, outputs, cutFlows = None, variations = ()):
+  ### Selects the events read into columns with the cuts of cutFlow.py, fills the outputs and empties the lists ###
+  with stage("event read"): # packing the lists into numpy columns
+    arrays = {key: np.asarray(values) for key, values in columns.items()}
+    for key in ("tauP4", "leptonP4"):
+      arrays[key] = fromCartesian(*np.moveaxis(arrays[key].astype(np.float64), 2, 0))
+  for region, selected in selectColumns(arrays, cutFlows, variations).items():
+    fillOutputs(selected, *outputs[region])
+  for values in columns.values():
+    values.clear()
+
+def eventLoop(tree, luminosity, sumAllMC, outputs, cacheSize = 30000000, variations = (), chunkSize = 100000,
+              cutFlows = None):
+  ### Per-event loop over the chain, filling outputs[region] = (ntupleWriter, treeName, histograms,
+  #   variationHistograms) with the nominal weight and every weight variation, and cutFlows[region] if given. The
+  #   entries are read one at a time, and every chunkSize entries the chunk is selected with the cuts of cutFlow.py ###
+  columns = {key: [] for key in (*SELECTION_COLUMNS, *(variation.column for variation in variations))}
+
+  # Only read the branches the selection and the weight variations use, and keep track of the I/O
+  pruneBranches(tree, variationBranches(variations, SELECTION_BRANCHES), cacheSize)
+  perfStats = basketCountingPerfStats("ioPerfStats", tree)
+  bytesStart = ROOT.TFile.GetFileBytesRead()
+  readCallsStart = ROOT.TFile.GetFileReadCalls()
+  ioTime = 0.
+  loopStart = time.perf_counter()
 
-  return ((tau1.DeltaR(tauOrLep) < 3.1) and (Zlep1.DeltaR(Zlep2) < 3)
-          and ((tau1 + tauOrLep).DeltaR(Zlep1 + Zlep2) < 3.9)
-          and (math.fabs(tau1.Eta() - tauOrLep.Eta()) < 1.9)
-          and (math.fabs(Zlep1.Eta() - Zlep2.Eta()) < etallValue) and (deltaPhill > -3.2)
-          and (deltaPhill < 2.4) and (mmc > 90) and (mmc < 190))
+  for i in range(0, tree.GetEntries()):
+    if i > 0 and i % chunkSize == 0:
+      selectEvents(columns, outputs, cutFlows, variations)
+    ioStart = time.perf_counter()
+    tree.GetEntry(i)
+    readEvent(tree, columns, luminosity, sumAllMC, variations)
+    ioTime += time.perf_counter() - ioStart
+  if columns["weight"]:
+    selectEvents(columns, outputs, cutFlows, variations)
 
-def getDeltaPhill(Zlep1, Zlep2):
-  if (Zlep1.Eta() > Zlep2.Eta()):
-    return (Zlep1.DeltaPhi(Zlep2))
-  else:
-    return (Zlep2.DeltaPhi(Zlep1))
+  computeTime = time.perf_counter() - loopStart - ioTime
+  runMetrics.add("event read", ioTime)
+  printIOReport(ROOT.TFile.GetFileBytesRead() - bytesStart, ROOT.TFile.GetFileReadCalls() - readCallsStart, perfStats,
+    ioTime, computeTime)
+  return tree.GetEntries()
 
 def main(args):
+  metrics = runMetrics.reset()
+  # the budget sizes the chunks of one process, the worker processes of --shards and --partialcache would each use
+  # them and the merging process holds whole files or shards of selected events
+  if args.memorybudget is not None and args.engine == "columnar" and (args.shards > 1 or args.partialcache is not None):
+    raise ValueError("--memorybudget bounds a single process, it cannot be combined with --shards or --partialcache")
   if (args.inputsample[-1] != "/"): # adds / to end of file path if not present
     args.inputsample += "/"
-  directory = "rootData/" + args.inputsample
+  directory = args.inputdir + "/" + args.inputsample
   pattern = "*.root"
 
   tree = ROOT.TChain("NOMINAL")
   nFiles = 0
   luminosity = 140000
   sumAllMC = 0
-  for fileName in findAllFilesInPath(pattern, directory):
-    nFiles += tree.Add(fileName)
-    file = ROOT.TFile.Open(fileName)
-    if args.inputsample[:-1] == "ZHlltt":
-      h = file.Get("h_metadata_theory_weights")
-      sumAllMC += h.GetBinContent(110)
-    elif args.inputsample[:-1] == "ggZH":
-      h = file.Get("h_metadata_theory_weights")
-      sumAllMC += h.GetBinContent(111)
-    else:
-      h = file.Get("h_metadata")
-      sumAllMC += h.GetBinContent(8)
-    file.Close()
+  with stage("file open"):
+    fileNames = findAllFilesInPath(pattern, directory)
+  # sums of weights and entries come from the cached metadata index, only new or changed files are opened
+  with stage("metadata scan"):
+    # the index of another input directory (e.g. a skim) is kept apart, so both can be used without rescans
+    indexName = args.inputsample[:-1] if args.inputdir == "rootData" else \
+      args.inputsample[:-1] + "." + os.path.basename(os.path.normpath(args.inputdir))
+    # the content hashes key the partial results, the files are only read in full for them
+    metadata = loadMetadata(fileNames, args.metadataindex + "/" + indexName + ".json",
+                            hashes = args.engine == "columnar" and args.partialcache is not None)
+  weightsKey = sumOfWeightsKey(args.inputsample[:-1])
+  with stage("file open"):
+    for fileName in fileNames:
+      nFiles += tree.Add(fileName, metadata[fileName]["entries"])
+      sumAllMC += metadata[fileName]["sumOfWeights"][weightsKey]
   print(args.inputsample, ":", nFiles, "files")
+  # alternative event weights, filled in the same pass over the events as the nominal weight
+  variations = parseVariations(args.weights)
 
   # define histogram dictionaries
   diLepHistograms = {
-    "tauPtSum": ROOT.TH1D("2_lep_tau_pt_sum", "p_{T}^{#tau_sum};pT(GeV);Normalised Counts", 50, 50, 350),
-    "zMassSum": ROOT.TH1D("2_lep_Z_lepton_mass_sum", "M(ll);Mass(GeV);Normalised Counts", 50, 70, 115),
-    "metPt": ROOT.TH1D("2_lep_met_pt", "met.Pt();pT(GeV);Normalised Counts", 50, 0, 350),
-    "deltaRll": ROOT.TH1D("2_lep_delta_R_ll", "delta_R_ll;Delta R(Rad);Normalised Counts", 50, 0, 5),
-    "deltaRtt": ROOT.TH1D("2_lep_delta_R_tt", "delta_R_tt;Delta R(Rad);Normalised Counts", 50, 0, 5),
-    "deltaEtall":ROOT.TH1D("2_lep_delta_Eta_ll", "delta_Eta_ll;Delta Eta(Rad);Normalised Counts", 50, 0, 5),
-    "deltaEtatt":ROOT.TH1D("2_lep_delta_Eta_tt", "delta_Eta_tt;Delta Eta(Rad);Normalised Counts", 50, 0, 5),
-    "deltaRttll": ROOT.TH1D("2_lep_delta_R_tt_ll", "delta_R_ttll;Delta R(Rad);Normalised Counts", 50, 0, 5),
-    "nJets": ROOT.TH1D("2_lep_n_jets", "n_jets;n_jets;Normalised Counts", 10, 0, 10),
-    "deltaPhill": ROOT.TH1D("2_lep_delta_Phi_ll", "delta_Phi_ll;Delta Phi(Rad);Normalised Counts", 50, -4, 4),
-    "deltaPhitt": ROOT.TH1D("2_lep_delta_Phi_tt", "delta_Phi_tt;Delta Phi(Rad);Normalised Counts", 50, -4, 4),
-    "deltaPhilltt": ROOT.TH1D("2_lep_delta_Phi_ll_tt", "delta_Phi_lltt;Delta Phi(Rad);Normalised Counts", 50, -4, 4),
-    "mmc": ROOT.TH1D("2_lep_mmc_mass", "MMC_mass;Mass(GeV);Normalised Counts", 50, 0, 300)
+    "tauPtSum": Hist("2_lep_tau_pt_sum", "p_{T}^{#tau_sum};pT(GeV);Normalised Counts", 50, 50, 350),
+    "zMassSum": Hist("2_lep_Z_lepton_mass_sum", "M(ll);Mass(GeV);Normalised Counts", 50, 70, 115),
+    "metPt": Hist("2_lep_met_pt", "met.Pt();pT(GeV);Normalised Counts", 50, 0, 350),
+    "deltaRll": Hist("2_lep_delta_R_ll", "delta_R_ll;Delta R(Rad);Normalised Counts", 50, 0, 5),
+    "deltaRtt": Hist("2_lep_delta_R_tt", "delta_R_tt;Delta R(Rad);Normalised Counts", 50, 0, 5),
+    "deltaEtall":Hist("2_lep_delta_Eta_ll", "delta_Eta_ll;Delta Eta(Rad);Normalised Counts", 50, 0, 5),
+    "deltaEtatt":Hist("2_lep_delta_Eta_tt", "delta_Eta_tt;Delta Eta(Rad);Normalised Counts", 50, 0, 5),
+    "deltaRttll": Hist("2_lep_delta_R_tt_ll", "delta_R_ttll;Delta R(Rad);Normalised Counts", 50, 0, 5),
+    "nJets": Hist("2_lep_n_jets", "n_jets;n_jets;Normalised Counts", 10, 0, 10),
+    "deltaPhill": Hist("2_lep_delta_Phi_ll", "delta_Phi_ll;Delta Phi(Rad);Normalised Counts", 50, -4, 4),
+    "deltaPhitt": Hist("2_lep_delta_Phi_tt", "delta_Phi_tt;Delta Phi(Rad);Normalised Counts", 50, -4, 4),
+    "deltaPhilltt": Hist("2_lep_delta_Phi_ll_tt", "delta_Phi_lltt;Delta Phi(Rad);Normalised Counts", 50, -4, 4),
+    "mmc": Hist("2_lep_mmc_mass", "MMC_mass;Mass(GeV);Normalised Counts", 50, 0, 300)
   }
   triLepHistograms = dict.fromkeys(diLepHistograms.keys()) # list for histograms of the three lepton cut
 
   # loop through dictionary diLepHistograms and copy histograms to triLepHistograms
   for key in diLepHistograms:
-    triLepHistograms[key] = diLepHistograms[key].Clone("3" + diLepHistograms[key].GetName()[1:])
-    diLepHistograms[key].Sumw2()
-    triLepHistograms[key].Sumw2()
+    triLepHistograms[key] = diLepHistograms[key].clone("3" + diLepHistograms[key].name[1:])
+
+  # one more set of histograms per weight variation, named <histogram>_<variation>
+  diLepVariations = {variation.column: {key: hist.clone(hist.name + "_" + variation.name)
+                                        for key, hist in diLepHistograms.items()} for variation in variations}
+  triLepVariations = {variation.column: {key: hist.clone(hist.name + "_" + variation.name)
+                                         for key, hist in triLepHistograms.items()} for variation in variations}
 
   ### NTUPLE INITIALISATION ###
   # if outputntfile is not specified, generate from input sample
@@ -146,209 +266,55 @@ def main(args):
       args.outputntfile += ".root"
     outputNtName = args.outputntfile
 
-  # Create ntuple output file
-  outNtupleFile = ROOT.TFile.Open(("outputNTuples/" + outputNtName), "RECREATE")
-  newTree2Lep = ROOT.TTree("nominal2lep", "nominal2lep")
-  newTree3Lep = ROOT.TTree("nominal3lep", "nominal3lep")
-
-  nTuples2Lep = dict.fromkeys(diLepHistograms.keys()) # list for nTuples from diLepHistograms
-  nTuples3Lep = dict.fromkeys(diLepHistograms.keys()) # list for nTuples from triLepHistograms
-
-  for i in nTuples2Lep:
-    nTuples2Lep[i] = array('f', [0])
-    nTuples3Lep[i] = array('f', [0])
-    newTree2Lep.Branch(i, nTuples2Lep[i], i + "/F")
-    newTree3Lep.Branch(i, nTuples3Lep[i], i + "/F")
-  nTuples2Lep["weight"] = array('f', [0]) # Add weight branch
-  newTree2Lep.Branch("weight", nTuples2Lep["weight"], "weight/F")
-  nTuples3Lep["weight"] = array('f', [0]) # Add weight branch
-  newTree3Lep.Branch("weight", nTuples3Lep["weight"], "weight/F")
-
-  #FILL HISTOGRAMS LOOP
-  for i in range(0, tree.GetEntries()):
-    tree.GetEntry(i)
+  schema = {**NTUPLE_SCHEMA, **{variation.column: "f4" for variation in variations}}
+
+  # with a memory budget, the chunks, output baskets and read cache are sized to fit in it
+  chunkSize, basketSize, cacheSize = args.chunksize, 100000, args.cachesize*1000000
+  if args.memorybudget is not None:
+    chunkSize, basketSize, cacheSize = budgetSizes(tree, variationBranches(variations, SELECTION_BRANCHES), schema,
+      args.memorybudget*1000000)
+    print("Memory budget %d MB: chunks of %d entries, baskets of %d entries, %.1f MB read cache"
+      % (args.memorybudget, chunkSize, basketSize, cacheSize/1e6))
+
+  # Create ntuple output file, the trees are written from whole arrays by the NTupleWriter
+  ntupleWriter = NTupleWriter("outputNTuples/" + outputNtName, args.compression, args.compressionlevel, basketSize)
+  ntupleWriter.book("nominal2lep", schema)
+  ntupleWriter.book("nominal3lep", schema)
+
+  outputs = {"2lep": (ntupleWriter, "nominal2lep", diLepHistograms, diLepVariations),
+             "3lep": (ntupleWriter, "nominal3lep", triLepHistograms, triLepVariations)}
+  # every engine runs the declarative cuts of cutFlow.py and keeps a cut flow table per region
+  cutFlows = {region: CutFlow() for region in outputs}
+  if args.engine == "columnar" and args.partialcache is not None:
+    # only new or changed files are processed, the other ones come from their cached partial results
+    from columnarSelection import runCached
+    nEvents = runCached(fileNames, luminosity, sumAllMC, outputs, args.partialcache + "/" + args.inputsample[:-1],
+      {fileName: metadata[fileName]["contentHash"] for fileName in fileNames}, args.shards, chunkSize, cutFlows,
+      variations)
+  elif args.engine == "columnar" and args.shards > 1:
+    from columnarSelection import runSharded
+    nEvents = runSharded(fileNames, luminosity, sumAllMC, outputs, args.shards, chunkSize, cutFlows, variations)
+  elif args.engine == "columnar":
+    from columnarSelection import runColumnar
+    nEvents = runColumnar(fileNames, luminosity, sumAllMC, outputs, chunkSize, cutFlows, variations)
+  elif args.engine == "rdf":
+    from rdfSelection import runRDataFrame
+    nEvents = runRDataFrame(fileNames, luminosity, sumAllMC, outputs, args.threads, variations, cutFlows)
+  else:
+    nEvents = eventLoop(tree, luminosity, sumAllMC, outputs, cacheSize, variations, chunkSize, cutFlows)
 
-    taus_p4 = getattr(tree, "taus_p4")
-    leptons_p4 = getattr(tree, "leptons_p4")
-    met_p4 = getattr(tree, "met_p4")
-    nJets30 = getattr(tree, "n_jets_30")
-    lFlavour = getattr(tree, "leptons")
-    lCharge = getattr(tree, "leptons_q")
-    tauCharge = getattr(tree, "taus_q")
-    crossSection = getattr(tree, "cross_section")
-    rnnID = getattr(tree, "taus_jet_rnn_medium")
-    wTotal = (crossSection * luminosity * getattr(tree, "pu_NOMINAL_pileup_combined_weight") *
-      getattr(tree, "weight_mc"))/sumAllMC # calculates weight for each event
-    leptonsIDTight = getattr(tree, "leptons_id_tight")
-    tauBdt = getattr(tree, "taus_ele_bdt_loose_retuned")
-    eIsoPass = getattr(tree, "leptons_iso_FCLoose")
-    muIsoPass = getattr(tree, "leptons_iso_TightTrackOnly_FixedRad")
-
-    if len(taus_p4) > 0: # checks if there is a tau
-      if len(leptons_p4) == 3: flavList = [lFlavour[0], lFlavour[1], lFlavour[2]] # list of lepton flavours
-
-      #### SELECTION CUT for 2 lepton final state ####
-      if ((len(leptons_p4) == 2) and (len(taus_p4) == 2) and (lFlavour[0] == lFlavour[1])
-        and (lCharge[0] == -lCharge[1]) and (rnnID[0] == 1) and (rnnID[1] == 1) and (tauCharge[0] == -tauCharge[1])
-        and (taus_p4[0].Pt() + taus_p4[1].Pt() > 75) and ((leptons_p4[0] + leptons_p4[1]).M() > 71)
-        and ((leptons_p4[0] + leptons_p4[1]).M() < 111) and (leptonsIDTight[0] == 1) and (leptonsIDTight[1] == 1)
-        and ((lFlavour[0] == 1 and muIsoPass[0] == 1 and muIsoPass[1] == 1)
-        or (lFlavour[0] == 2 and eIsoPass[0] == 1 and eIsoPass[1] == 1)) and (tauBdt[0] == 1) and (tauBdt[1] == 1)):
-
-        tau0tau1MMC = getattr(tree, "mmc_tau0_tau1_mmc_mlm_m")
-
-        # if fill nTuples or not
-        if variableCutsIf(taus_p4[0], taus_p4[1], leptons_p4[0], leptons_p4[1], tau0tau1MMC, 3.5):
-          fillHistograms(taus_p4[0], taus_p4[1], leptons_p4[0], leptons_p4[1], met_p4.Pt(), nJets30, tau0tau1MMC,
-            wTotal, nTuples2Lep, newTree2Lep, diLepHistograms)
-        else:
-          fillHistograms(taus_p4[0], taus_p4[1], leptons_p4[0], leptons_p4[1], met_p4.Pt(), nJets30, tau0tau1MMC,
-            wTotal, nTuples2Lep, newTree2Lep)
-
-      #### SELECTION CUT for 3 lepton final state ####
-      elif ((len(leptons_p4) == 3) and len(taus_p4) == 1 and (rnnID[0] == 1)
-        and (flavList.count(1) + flavList.count(2) == 3) and (leptonsIDTight[0] == 1) and (leptonsIDTight[1] == 1)
-        and (leptonsIDTight[2] == 1) and (tauBdt[0] == 1)):
-        chargeList = [lCharge[0], lCharge[1], lCharge[2]] # list of lepton charges
-        try:
-          muIndex = flavList.index(1) #index of muon
-          eIndex = flavList.index(2) #index of electron
-        except ValueError:
-          pass
-
-        # One muon, two electrons
-        if ((flavList.count(1) == 1) and (flavList.count(2) == 2) and (lCharge[muIndex] == -tauCharge[0])
-          and (leptons_p4[muIndex].Pt() + taus_p4[0].Pt() > 60)
-          and (lCharge[(muIndex + 1)%3] == -lCharge[(muIndex - 1)%3])
-          and ((leptons_p4[(muIndex + 1)%3] + leptons_p4[(muIndex - 1)%3]).M() > 81)
-          and ((leptons_p4[(muIndex + 1)%3] + leptons_p4[(muIndex - 1)%3]).M() < 101) and (muIsoPass[muIndex] == 1)
-          and (eIsoPass[(muIndex + 1)%3] == 1) and (eIsoPass[(muIndex - 1)%3] == 1)):
-
-          tau0lepMMC = getattr(tree, "mmc_tau0_lep" + str(muIndex) + "_mmc_mlm_m")
-
-          # if fill nTuples or not
-          if variableCutsIf(taus_p4[0], leptons_p4[muIndex], leptons_p4[(muIndex + 1)%3], leptons_p4[(muIndex - 1)%3],
-            tau0lepMMC, 2.7):
-            fillHistograms(taus_p4[0], leptons_p4[muIndex], leptons_p4[(muIndex + 1)%3], leptons_p4[(muIndex - 1)%3],
-              met_p4.Pt(), nJets30, tau0lepMMC, wTotal, nTuples3Lep, newTree3Lep, triLepHistograms)
-          else:
-            fillHistograms(taus_p4[0], leptons_p4[muIndex], leptons_p4[(muIndex + 1)%3], leptons_p4[(muIndex - 1)%3],
-              met_p4.Pt(), nJets30, tau0lepMMC, wTotal, nTuples3Lep, newTree3Lep)
-
-        # Two muons, one electron
-        elif ((flavList.count(2) == 1) and (flavList.count(1) == 2) and (lCharge[eIndex] == -tauCharge[0])
-          and (leptons_p4[eIndex].Pt() + taus_p4[0].Pt() > 60)
-          and (lCharge[(eIndex + 1)%3] == -lCharge[(eIndex - 1)%3])
-          and ((leptons_p4[(eIndex + 1)%3] + leptons_p4[(eIndex - 1)%3]).M() > 81)
-          and ((leptons_p4[(eIndex + 1)%3] + leptons_p4[(eIndex - 1)%3]).M() < 101) and (eIsoPass[eIndex] == 1)
-          and (muIsoPass[(eIndex + 1)%3] == 1) and (muIsoPass[(eIndex - 1)%3] == 1)):
-
-          tau0lepMMC = getattr(tree, "mmc_tau0_lep" + str(eIndex) + "_mmc_mlm_m")
-
-          # if fill nTuples or not
-          if variableCutsIf(taus_p4[0], leptons_p4[eIndex], leptons_p4[(eIndex + 1)%3], leptons_p4[(eIndex - 1)%3],
-            tau0lepMMC, 2.7):
-            fillHistograms(taus_p4[0], leptons_p4[eIndex], leptons_p4[(eIndex + 1)%3], leptons_p4[(eIndex - 1)%3],
-              met_p4.Pt(), nJets30, tau0lepMMC, wTotal, nTuples3Lep, newTree3Lep, triLepHistograms)
-          else:
-            fillHistograms(taus_p4[0], leptons_p4[eIndex], leptons_p4[(eIndex + 1)%3], leptons_p4[(eIndex - 1)%3],
-              met_p4.Pt(), nJets30, tau0lepMMC, wTotal, nTuples3Lep, newTree3Lep)
-
-        # One positive charge, two negatives
-        elif ((chargeList.count(+1) == 1) and (chargeList.count(-1) == 2)
-          and ((flavList.count(1) == 3 and muIsoPass[0] == 1 and muIsoPass[1] == 1 and muIsoPass[2] == 1)
-          or (flavList.count(2) == 3 and eIsoPass[0] == 1 and eIsoPass[1] == 1 and eIsoPass[2] == 1))):
-          #and (lCharge[(chargeList.index(+1) - 1)%3] == -lCharge[(chargeList.index(+1) + 1)%3])) is implied
-
-          posIndex = chargeList.index(+1)
-          zMass1 = (leptons_p4[posIndex] + leptons_p4[(posIndex + 1)%3]).M()
-          zMass2 = (leptons_p4[posIndex] + leptons_p4[(posIndex - 1)%3]).M()
-          zCandidate1 = math.fabs(zMass1 - REAL_Z_MASS)
-          zCandidate2 = math.fabs(zMass2 - REAL_Z_MASS)
-
-          if ((zCandidate1 < zCandidate2) and ((lCharge[(posIndex - 1)%3] == -tauCharge[0]))
-            and (leptons_p4[(posIndex - 1)%3].Pt() + taus_p4[0].Pt() > 60) and (zMass1 > 81) and (zMass1 < 101)):
-
-            tau0lepMMC = getattr(tree, "mmc_tau0_lep" + str((posIndex - 1)%3) + "_mmc_mlm_m")
-
-            # if fill nTuples or not
-            if variableCutsIf(taus_p4[0], leptons_p4[(posIndex - 1)%3], leptons_p4[posIndex],
-              leptons_p4[(posIndex + 1)%3], tau0lepMMC, 2.7):
-              fillHistograms(taus_p4[0], leptons_p4[(posIndex - 1)%3], leptons_p4[posIndex],
-                leptons_p4[(posIndex + 1)%3], met_p4.Pt(), nJets30, tau0lepMMC, wTotal, nTuples3Lep, newTree3Lep,
-                triLepHistograms)
-            else:
-              fillHistograms(taus_p4[0], leptons_p4[(posIndex - 1)%3], leptons_p4[posIndex],
-                leptons_p4[(posIndex + 1)%3], met_p4.Pt(), nJets30, tau0lepMMC, wTotal, nTuples3Lep, newTree3Lep)
-
-          elif ((zCandidate1 > zCandidate2) and ((lCharge[(posIndex + 1)%3] == -tauCharge[0]))
-            and (leptons_p4[(posIndex + 1)%3].Pt() + taus_p4[0].Pt() > 60) and (zMass2 > 81) and (zMass2 < 101)):
-
-            tau0lepMMC = getattr(tree, "mmc_tau0_lep" + str((posIndex + 1)%3) + "_mmc_mlm_m")
-
-            # if fill nTuples or not
-            if variableCutsIf(taus_p4[0], leptons_p4[(posIndex + 1)%3], leptons_p4[posIndex],
-              leptons_p4[(posIndex - 1)%3], tau0lepMMC, 2.7):
-              fillHistograms(taus_p4[0], leptons_p4[(posIndex + 1)%3], leptons_p4[posIndex],
-                leptons_p4[(posIndex - 1)%3], met_p4.Pt(), nJets30, tau0lepMMC, wTotal, nTuples3Lep, newTree3Lep,
-                triLepHistograms)
-            else:
-              fillHistograms(taus_p4[0], leptons_p4[(posIndex + 1)%3], leptons_p4[posIndex],
-                leptons_p4[(posIndex - 1)%3], met_p4.Pt(), nJets30, tau0lepMMC, wTotal, nTuples3Lep, newTree3Lep)
-
-        # Two positive charges, one negative
-        elif ((chargeList.count(-1) == 1) and (chargeList.count(+1) == 2)
-          and ((flavList.count(1) == 3 and muIsoPass[0] == 1 and muIsoPass[1] == 1 and muIsoPass[2] == 1)
-          or (flavList.count(2) == 3 and eIsoPass[0] == 1 and eIsoPass[1] == 1 and eIsoPass[2] == 1))):
-          #and(lCharge[(chargeList.index(-1) - 1)%3] == -lCharge[(chargeList.index(-1) + 1)%3])): is implied
-
-          negIndex = chargeList.index(-1)
-          zMass1 = (leptons_p4[negIndex] + leptons_p4[(negIndex + 1)%3]).M()
-          zMass2 = (leptons_p4[negIndex] + leptons_p4[(negIndex - 1)%3]).M()
-          zCandidate1 = math.fabs(zMass1 - REAL_Z_MASS)
-          zCandidate2 = math.fabs(zMass2 - REAL_Z_MASS)
-
-          if ((zCandidate1 < zCandidate2) and ((lCharge[(negIndex - 1)%3] == -tauCharge[0]))
-            and (leptons_p4[(negIndex - 1)%3].Pt() + taus_p4[0].Pt() > 60) and (zMass1 > 81) and (zMass1 < 101)):
-
-            tau0lepMMC = getattr(tree, "mmc_tau0_lep" + str((negIndex - 1)%3) + "_mmc_mlm_m")
-
-            # if fill nTuples or not
-            if variableCutsIf(taus_p4[0], leptons_p4[(negIndex - 1)%3], leptons_p4[negIndex],
-              leptons_p4[(negIndex + 1)%3], tau0lepMMC, 2.7):
-              fillHistograms(taus_p4[0], leptons_p4[(negIndex - 1)%3], leptons_p4[negIndex],
-                leptons_p4[(negIndex + 1)%3], met_p4.Pt(), nJets30, tau0lepMMC, wTotal, nTuples3Lep, newTree3Lep,
-                triLepHistograms)
-            else:
-              fillHistograms(taus_p4[0], leptons_p4[(negIndex - 1)%3], leptons_p4[negIndex],
-                leptons_p4[(negIndex + 1)%3], met_p4.Pt(), nJets30, tau0lepMMC, wTotal, nTuples3Lep, newTree3Lep)
-
-          elif ((zCandidate1 > zCandidate2) and ((lCharge[(negIndex + 1)%3] == -tauCharge[0]))
-            and (leptons_p4[(negIndex + 1)%3].Pt() + taus_p4[0].Pt() > 60) and (zMass2 > 81) and (zMass2 < 101)):
-
-            tau0lepMMC = getattr(tree, "mmc_tau0_lep" + str((negIndex + 1)%3) + "_mmc_mlm_m")
-
-            # if fill nTuples or not
-            if variableCutsIf(taus_p4[0], leptons_p4[(negIndex + 1)%3], leptons_p4[negIndex],
-              leptons_p4[(negIndex - 1)%3], tau0lepMMC, 2.7):
-              fillHistograms(taus_p4[0], leptons_p4[(negIndex + 1)%3], leptons_p4[negIndex],
-                leptons_p4[(negIndex - 1)%3], met_p4.Pt(), nJets30, tau0lepMMC, wTotal, nTuples3Lep, newTree3Lep,
-                triLepHistograms)
-            else:
-              fillHistograms(taus_p4[0], leptons_p4[(negIndex + 1)%3], leptons_p4[negIndex],
-                leptons_p4[(negIndex - 1)%3], met_p4.Pt(), nJets30, tau0lepMMC, wTotal, nTuples3Lep, newTree3Lep)
-
-  print("2lep selection cut integral yield:", diLepHistograms["tauPtSum"].Integral(0,
-    diLepHistograms["tauPtSum"].GetNbinsX() + 1))
-  print("3lep selection cut integral yield:", triLepHistograms["tauPtSum"].Integral(0,
-    triLepHistograms["tauPtSum"].GetNbinsX() + 1))
+  print("2lep selection cut integral yield:", diLepHistograms["tauPtSum"].integral(0,
+    diLepHistograms["tauPtSum"].nBins + 1))
+  print("3lep selection cut integral yield:", triLepHistograms["tauPtSum"].integral(0,
+    triLepHistograms["tauPtSum"].nBins + 1))
+  for variation in variations:
+    for region, hists in (("2lep", diLepVariations), ("3lep", triLepVariations)):
+      print(region, "selection cut integral yield (" + variation.name + "):",
+        hists[variation.column]["tauPtSum"].integral(0, hists[variation.column]["tauPtSum"].nBins + 1))
 
   # Write Ntuples to files
-  newTree2Lep.Write()
-  newTree3Lep.Write()
-  outNtupleFile.Close()
-  del newTree2Lep
-  del newTree3Lep
+  with stage("tree write"):
+    ntupleWriter.close()
 
   # Generates output file name from input file name if not specified
   if (args.outputfile == None):
@@ -358,26 +324,72 @@ def main(args):
       args.outputfile += ".root"
     outputName = "outputRoot/" + args.outputfile
 
-  outHistFile = ROOT.TFile.Open(outputName, "RECREATE")
-  outHistFile.cd()
-  for key in diLepHistograms: #writes all histograms
-    diLepHistograms[key].Write()
-    triLepHistograms[key].Write()
+  #writes all histograms, the nominal ones first
+  histogramSets = [(diLepHistograms, triLepHistograms)] + [(diLepVariations[variation.column],
+    triLepVariations[variation.column]) for variation in variations]
+  with stage("histogram write"):
+    writeHists(outputName, [hist for diLep, triLep in histogramSets for key in diLep
+                            for hist in (diLep[key], triLep[key])])
 
-  outHistFile.Close()
+  writeCutFlows(cutFlows, args.cutflowdir + "/" + args.inputsample[:-1] + ".txt")
+
+  # machine readable timings, throughput, selected events and peak memory of the run
+  metrics.write(args.metricsdir + "/" + args.inputsample[:-1] + ".json", sample = args.inputsample[:-1],
+    engine = args.engine, files = nFiles, events = nEvents,
+    yields = {"2lep": diLepHistograms["tauPtSum"].integral(0, diLepHistograms["tauPtSum"].nBins + 1),
+              "3lep": triLepHistograms["tauPtSum"].integral(0, triLepHistograms["tauPtSum"].nBins + 1)})
 
   del tree
+  return nEvents
 
-if __name__ == "__main__":
-  # parse the CLI arguments
+def getParser():
+  # CLI arguments, also used by runSamples.py to build the arguments of each sample
   parser = argparse.ArgumentParser(description='script to run over ntuple dataset')
   parser.add_argument('--inputsample', '-i', metavar='INPUT', type=str, dest="inputsample",
     default="ZHlltt/", help='directory for input root files')
+  parser.add_argument('--inputdir', metavar='DIRECTORY', type=str, dest="inputdir",
+    default="rootData", help='directory of the input samples, e.g. skimCache for the samples skimmed by skim.py')
   parser.add_argument('--outputfile', '-o', metavar='OUTPUT', type=str, dest="outputfile",
     default=None, help='outputfile for process')
   parser.add_argument('--ntuplefile', '-n', metavar='NTUPLEOUT', type=str, dest="outputntfile",
     default=None, help='outputfile for ntuple')
-  args = parser.parse_args()
+  parser.add_argument('--engine', '-e', type=str, dest="engine", choices=["event", "columnar", "rdf"],
+    default="event", help='per-event TChain loop, columnar (uproot/awkward) or multithreaded RDataFrame selection')
+  parser.add_argument('--chunksize', metavar='ENTRIES', type=int, dest="chunksize",
+    default=100000, help='number of entries per chunk, read at once by the columnar engine and selected together by '
+    'the event engine')
+  parser.add_argument('--threads', '-t', metavar='NTHREADS', type=int, dest="threads",
+    default=0, help='number of threads for the rdf engine (0 uses every core)')
+  parser.add_argument('--shards', '-s', metavar='NSHARDS', type=int, dest="shards",
+    default=1, help='split the input files into shards processed in parallel (columnar engine)')
+  parser.add_argument('--cachesize', metavar='MB', type=int, dest="cachesize",
+    default=30, help='read-ahead cache size in MB for the branches read by the event engine')
+  parser.add_argument('--metadataindex', metavar='DIRECTORY', type=str, dest="metadataindex",
+    default="metadataIndex", help='directory of the cached per-sample metadata (sum of weights) index')
+  parser.add_argument('--compression', type=str, dest="compression", choices=list(COMPRESSION),
+    default="zstd", help='compression algorithm of the output ntuples')
+  parser.add_argument('--compressionlevel', metavar='LEVEL', type=int, dest="compressionlevel",
+    default=5, help='compression level (1-9) of the output ntuples')
+  parser.add_argument('--partialcache', metavar='DIRECTORY', type=str, dest="partialcache",
+    default=None, help='keep a partial result per input file in DIRECTORY/<sample> and only process new or changed '
+    'files (columnar engine)')
+  parser.add_argument('--cutflowdir', metavar='DIRECTORY', type=str, dest="cutflowdir",
+    default="cutFlows", help='directory of the per-sample cut flow tables')
+  parser.add_argument('--memorybudget', '-m', metavar='MB', type=int, dest="memorybudget",
+    default=None, help='memory budget in MB for the event data, overrides --chunksize and --cachesize so a sample '
+    'of any size runs in bounded memory in a single process (event and columnar engines, not with --shards or '
+    '--partialcache)')
+  parser.add_argument('--metricsdir', metavar='DIRECTORY', type=str, dest="metricsdir",
+    default="runMetrics", help='directory of the per-sample JSON run metrics (stage timings, events/s, peak RSS)')
+  parser.add_argument('--weights', '-w', metavar='NAME=EXPRESSION', type=str, dest="weights", nargs='+',
+    default=[], help='weight variations filled in the same pass as the nominal weight, each replacing '
+    'cross_section*pu_NOMINAL_pileup_combined_weight*weight_mc with an arithmetic expression of scalar branches, '
+    'e.g. puUp=cross_section*pu_PRW_DATASF__1up_pileup_combined_weight*weight_mc')
+  return parser
+
+if __name__ == "__main__":
+  # parse the CLI arguments
+  args = getParser().parse_args()
 
   # call the main function
   main(args)
@@ -1,6 +1,7 @@
 from math import sqrt
 from ROOT import *
-from selectionPlots import findAllFilesInPath
+from fileUtils import findAllFilesInPath
+from numpyHist import readHists, significanceCurves
 
 gROOT.LoadMacro('../atlasrootstyle/AtlasStyle.C')
 gROOT.LoadMacro('../atlasrootstyle/AtlasUtils.C')
@@ -47,6 +48,9 @@ varXAxis = {
     "mmc_mass": "MMC mass (GeV)"
 }
 
+# Read the histograms of every file once
+fileHistograms = {fileName: readHists(fileName) for sample in samples for fileName in sample[1]}
+
 # Clear plottingYields.txt
 open("plottingYields.txt", "w").close()
 
@@ -60,7 +64,9 @@ for cut in ["2_lep_", "3_lep_"]: # Loop over the different selection cuts (2 and
     leg.SetEntrySeparation(0.001)
 
     counter = 0
+    groupHistos=[]
     histos=[]
+    stackedParts=[]
     legnames=[]
     maximum = -999.
     stackedHisto = THStack()
@@ -68,26 +74,28 @@ for cut in ["2_lep_", "3_lep_"]: # Loop over the different selection cuts (2 and
       sample = samples[i]
 
       for j in range(len(sample[1])): # Loop over the files in the sample group
-        infile = TFile.Open(sample[1][j],"READ")
-        histo = infile.Get(var)
-        histo.SetDirectory(0)
+        histo = fileHistograms[sample[1][j]][var]
         if j == 0:
-          histos.append(histo)
+          groupHistos.append(histo.clone())
         else:
-          histos[i].Add(histo)
-        infile.Close()
-
-      histos[i].SetLineWidth(3)
-      histos[i].SetMarkerColor(sample[2])
-      histos[i].SetLineColor(sample[2])
+          groupHistos[i].add(histo)
 
-      stackedHisto.Add(histos[i].Clone())
+      # unnormalised copy for the stack plot
+      stackedParts.append(groupHistos[i].toTH1D(var + "Stack" + str(i)))
+      stackedParts[i].SetLineWidth(3)
+      stackedParts[i].SetMarkerColor(sample[2])
+      stackedParts[i].SetLineColor(sample[2])
+      stackedHisto.Add(stackedParts[i])
 
-      # print(var + ":" + (str)(histos[i].Integral(0, histos[i].GetNbinsX() + 1)))
+      # print(var + ":" + (str)(groupHistos[i].integral(0, groupHistos[i].nBins + 1)))
       if var == cut + "tau_pt_sum":
-        cutYields[sample[0]] = histos[i].Integral(0, histos[i].GetNbinsX() + 1)
+        cutYields[sample[0]] = groupHistos[i].integral(0, groupHistos[i].nBins + 1)
 
-      histos[i].Scale(1./histos[i].Integral())
+      groupHistos[i].scale(1./groupHistos[i].integral())
+      histos.append(groupHistos[i].toTH1D(var + str(i)))
+      histos[i].SetLineWidth(3)
+      histos[i].SetMarkerColor(sample[2])
+      histos[i].SetLineColor(sample[2])
       legName = sample[0]
 
       if histos[i].GetMaximum() > maximum:
@@ -120,35 +128,15 @@ for cut in ["2_lep_", "3_lep_"]: # Loop over the different selection cuts (2 and
     canv.Clear()
 
     # SB ratio plots
-    var_sig1 = histos[3].Clone()
-    var_sig2 = histos[3].Clone()
-    total_background = histos[0].Clone()
-    total_background.Add(histos[1])
-    total_background.Add(histos[2])
-
-    # Loop over the bins and calculate the S/sqrt(S+B) for each bin
-    for i in range(1, histos[3].GetNbinsX() + 1):
-      # Integrating up
-      signalYield = histos[3].Integral(0, i)
-      backgroundYield = total_background.Integral(0, i)
-      try:
-        SoverSqrtSB = signalYield/sqrt(signalYield + backgroundYield)
-      except ZeroDivisionError:
-        SoverSqrtSB = 0
-      except ValueError:
-        SoverSqrtSB = 0
-      var_sig1.SetBinContent(i, SoverSqrtSB)
-
-      # Integrating inverse
-      signalYield = histos[3].Integral(i, histos[3].GetNbinsX() + 1)
-      backgroundYield = total_background.Integral(i, histos[3].GetNbinsX() + 1)
-      try:
-        SoverSqrtSB = signalYield/sqrt(signalYield + backgroundYield)
-      except ZeroDivisionError:
-        SoverSqrtSB = 0
-      except ValueError:
-        SoverSqrtSB = 0
-      var_sig2.SetBinContent(i, SoverSqrtSB)
+    var_sig1 = groupHistos[3].clone(var + "SB1")
+    var_sig2 = groupHistos[3].clone(var + "SB2")
+    total_background = groupHistos[0].clone()
+    total_background.add(groupHistos[1])
+    total_background.add(groupHistos[2])
+
+    # S/sqrt(S+B) for each bin, integrating up and integrating inverse
+    var_sig1.sumw[1:-1], var_sig2.sumw[1:-1] = significanceCurves(groupHistos[3], total_background)
+    var_sig1, var_sig2 = var_sig1.toTH1D(), var_sig2.toTH1D()
 
     var_sig1.SetMaximum(var_sig1.GetMaximum() * 1.1)
     var_sig1.SetLineWidth(3)
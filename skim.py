@@ -0,0 +1,93 @@
+import os
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from selectionPlots import SELECTION_BRANCHES
+from fileUtils import findAllFilesInPath
+from metadataIndex import SUM_OF_WEIGHTS_BINS
+
+# Loose preconditions of both selections: at least one tau and 2 or 3 leptons (TTree::Draw selection on NOMINAL)
+PRESELECTION = "@taus_p4.size() > 0 && (@leptons_p4.size() == 2 || @leptons_p4.size() == 3)"
+
+def isUpToDate(inputName, outputName, preselection, branches):
+  ### A skimmed file is reused if it is newer than its input and was made with the same preselection and branches ###
+  import ROOT
+  if not os.path.exists(outputName) or os.path.getmtime(outputName) < os.path.getmtime(inputName):
+    return False
+  outputFile = ROOT.TFile.Open(outputName)
+  try:
+    preselectionTag, branchesTag = outputFile.Get("skimPreselection"), outputFile.Get("skimBranches")
+    return (bool(preselectionTag) and bool(branchesTag) and preselectionTag.GetTitle() == preselection
+            and branchesTag.GetTitle() == ",".join(branches))
+  finally:
+    outputFile.Close()
+
+def skimFile(inputName, outputName, preselection, branches):
+  ### Writes the NOMINAL events of inputName passing preselection, with only branches, to outputName. The sum of
+  #   weights histograms are copied unchanged so the skimmed file is normalised like its input. Returns
+  #   (input file, events in, events out, seconds), with -1 events in for a file that was already up to date ###
+  import ROOT
+  start = time.perf_counter()
+  if isUpToDate(inputName, outputName, preselection, branches):
+    return inputName, -1, 0, 0.
+  os.makedirs(os.path.dirname(outputName) or ".", exist_ok = True)
+
+  # TTree::CopyTree keeps the branch types and the order of the events, only the selection branches are enabled
+  inputFile = ROOT.TFile.Open(inputName)
+  tree = inputFile.Get("NOMINAL")
+  tree.SetBranchStatus("*", 0)
+  for branch in branches:
+    tree.SetBranchStatus(branch, 1)
+  outputFile = ROOT.TFile.Open(outputName + ".tmp", "RECREATE")
+  skimmed = tree.CopyTree(preselection)
+  nIn, nOut = tree.GetEntries(), skimmed.GetEntries()
+  skimmed.Write()
+  for histName in dict.fromkeys(histName for histName, _ in SUM_OF_WEIGHTS_BINS):
+    hist = inputFile.Get(histName)
+    if hist:
+      outputFile.WriteObject(hist, histName)
+  # the preselection and branches are stored with the events to know when the skim has to be redone
+  outputFile.WriteObject(ROOT.TNamed("skimPreselection", preselection), "skimPreselection")
+  outputFile.WriteObject(ROOT.TNamed("skimBranches", ",".join(branches)), "skimBranches")
+  outputFile.Close()
+  inputFile.Close()
+  # written to a temporary file first so an interrupted skim never leaves a truncated file in the cache
+  os.replace(outputName + ".tmp", outputName)
+  return inputName, nIn, nOut, time.perf_counter() - start
+
+def main(args):
+  branches = list(dict.fromkeys(SELECTION_BRANCHES + tuple(args.branches)))
+  jobs = []
+  for sample in args.samples:
+    sample = sample.rstrip("/")
+    for inputName in findAllFilesInPath("*.root", args.inputdir + "/" + sample + "/"):
+      jobs.append((inputName, os.path.join(args.outputdir, sample, os.path.basename(inputName))))
+
+  with ProcessPoolExecutor(max(min(args.workers, len(jobs)), 1), mp_context = multiprocessing.get_context("spawn")) \
+      as pool:
+    results = list(pool.map(skimFile, [inputName for inputName, _ in jobs], [outputName for _, outputName in jobs],
+                            [args.preselection]*len(jobs), [branches]*len(jobs)))
+
+  skimmed = [result for result in results if result[1] >= 0]
+  nIn, nOut = sum(result[1] for result in skimmed), sum(result[2] for result in skimmed)
+  print("%d files skimmed, %d up to date: %d of %d events kept (%.1f%%), %.1f s" % (len(skimmed),
+    len(results) - len(skimmed), nOut, nIn, 100*nOut/max(nIn, 1), sum(result[3] for result in skimmed)))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Skim the input samples with a loose preselection, keeping only the "
+    "branches used by selectionPlots.py. Run selectionPlots.py with --inputdir on the output directory afterwards")
+  parser.add_argument("samples", nargs = "+", help = "samples (directories of the input directory) to skim")
+  parser.add_argument("--inputdir", metavar = "DIRECTORY", type = str, dest = "inputdir", default = "rootData",
+    help = "directory of the input samples")
+  parser.add_argument("--outputdir", "-o", metavar = "DIRECTORY", type = str, dest = "outputdir",
+    default = "skimCache", help = "directory of the skimmed samples, one file per input file")
+  parser.add_argument("--preselection", "-p", metavar = "EXPRESSION", type = str, dest = "preselection",
+    default = PRESELECTION, help = "selection (TTree::Draw syntax) an event has to pass to be kept")
+  parser.add_argument("--branches", "-b", metavar = "BRANCH", type = str, dest = "branches", nargs = "+",
+    default = [], help = "branches kept on top of the ones of the selection, e.g. for --weights variations")
+  parser.add_argument("--workers", "-w", type = int, dest = "workers", default = os.cpu_count(),
+    help = "number of files skimmed in parallel")
+  args = parser.parse_args()
+
+  main(args)
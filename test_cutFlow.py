@@ -0,0 +1,157 @@
+import math
+import numpy as np
+import pytest
+
+ROOT = pytest.importorskip("ROOT")
+
+from array import array
+from columnarSelection import runColumnar
+from cutFlow import CutFlow, bestZCandidate
+from kinematics import REAL_Z_MASS, fromPtEtaPhiM
+from rdfSelection import runRDataFrame
+from selectionPlots import eventLoop
+
+# Consistency of the event, columnar and rdf engines, which all run the cuts of cutFlow.py, on a few handmade
+# events. Run with python -m pytest test_cutFlow.py
+
+# Pt of the leptons of a pair back to back in phi at the same eta, with the Z mass: m = 2 pt
+Z_PT = REAL_Z_MASS/2
+
+def lepton(pt, eta, phi, flavour, charge):
+  return {"p4": (pt, eta, phi, 0.1), "flavour": flavour, "charge": charge}
+
+def tau(pt, eta, phi, charge):
+  return {"p4": (pt, eta, phi, 1.777), "charge": charge}
+
+# Pt of the two negative leptons at phi = +-(pi - 0.3) giving the Z mass with a positive lepton of pt Z_PT at phi 0
+TIE_PT = REAL_Z_MASS**2/(2*Z_PT*(1 + math.cos(0.3)))
+
+EVENTS = [
+  # 2lep: Z -> mumu with two opposite sign taus, selected
+  {"taus": [tau(50, 0.5, 1.5, 1), tau(40, -0.5, -1.5, -1)],
+   "leptons": [lepton(Z_PT, 0, 0, 1, 1), lepton(Z_PT, 0, math.pi, 1, -1)]},
+  # 2lep: m_ll = 60, rejected
+  {"taus": [tau(50, 0.5, 1.5, 1), tau(40, -0.5, -1.5, -1)],
+   "leptons": [lepton(30, 0, 0, 2, 1), lepton(30, 0, math.pi, 2, -1)]},
+  # 3lep mixed flavour: the electron pair is the Z, the muon is opposite sign to the tau, selected
+  {"taus": [tau(50, 1, 1.5, -1)],
+   "leptons": [lepton(Z_PT, 0, 0, 2, 1), lepton(30, 0.5, -1.5, 1, 1), lepton(Z_PT, 0, math.pi, 2, -1)]},
+  # 3lep mixed flavour without an opposite sign same flavour pair, rejected
+  {"taus": [tau(50, 1, 1.5, -1)],
+   "leptons": [lepton(Z_PT, 0, 0, 2, 1), lepton(30, 0.5, -1.5, 1, -1), lepton(Z_PT, 0, math.pi, 2, 1)]},
+  # 3lep same flavour, the pair of leptons 0 and 1 is closest to the Z mass, selected
+  {"taus": [tau(50, 1, 1.5, 1)],
+   "leptons": [lepton(Z_PT, 0, 0, 1, 1), lepton(Z_PT, 0, math.pi, 1, -1), lepton(30, 0.5, -1.5, 1, -1)]},
+  # 3lep same flavour with a tie: both pairs with the positive lepton have the same mass, rejected
+  {"taus": [tau(50, 1, 1.5, 1)],
+   "leptons": [lepton(Z_PT, 0, 0, 1, 1), lepton(TIE_PT, 0, math.pi - 0.3, 1, -1),
+               lepton(TIE_PT, 0, 0.3 - math.pi, 1, -1)]}
+]
+
+def writeEvents(fileName, events):
+  ### NOMINAL tree with the branches read by the selection, every tau and lepton passing the identification,
+  #   isolation and MMC requirements, so only the kinematics and charges decide ###
+  outputFile = ROOT.TFile(fileName, "RECREATE")
+  tree = ROOT.TTree("NOMINAL", "NOMINAL")
+  vectors = {"leptons": "unsigned int", "leptons_q": "float", "taus_q": "float", "taus_jet_rnn_medium": "unsigned int",
+             "leptons_id_tight": "unsigned int", "taus_ele_bdt_loose_retuned": "unsigned int",
+             "leptons_iso_FCLoose": "unsigned int", "leptons_iso_TightTrackOnly_FixedRad": "unsigned int"}
+  vectors = {name: ROOT.std.vector(typeName)() for name, typeName in vectors.items()}
+  for name, vector in vectors.items():
+    tree.Branch(name, vector)
+  scalarNames = ("cross_section", "pu_NOMINAL_pileup_combined_weight", "weight_mc", "mmc_tau0_tau1_mmc_mlm_m",
+                 "mmc_tau0_lep0_mmc_mlm_m", "mmc_tau0_lep1_mmc_mlm_m", "mmc_tau0_lep2_mmc_mlm_m")
+  scalars = {name: array("f", [1.]) for name in scalarNames}
+  for name, scalar in scalars.items():
+    tree.Branch(name, scalar, name + "/F")
+  nJets = array("i", [0])
+  tree.Branch("n_jets_30", nJets, "n_jets_30/I")
+  taus, leptons, met = ROOT.std.vector("TLorentzVector")(), ROOT.std.vector("TLorentzVector")(), ROOT.TLorentzVector()
+  tree.Branch("taus_p4", taus)
+  tree.Branch("leptons_p4", leptons)
+  tree.Branch("met_p4", met)
+
+  for i, event in enumerate(events):
+    for vector in (*vectors.values(), taus, leptons):
+      vector.clear()
+    for objects, p4s, prefix in ((event["taus"], taus, "taus_q"), (event["leptons"], leptons, "leptons_q")):
+      for particle in objects:
+        p4 = ROOT.TLorentzVector()
+        p4.SetPtEtaPhiM(*particle["p4"])
+        p4s.push_back(p4)
+        vectors[prefix].push_back(particle["charge"])
+    for particle in event["taus"]:
+      vectors["taus_jet_rnn_medium"].push_back(1)
+      vectors["taus_ele_bdt_loose_retuned"].push_back(1)
+    for particle in event["leptons"]:
+      vectors["leptons"].push_back(particle["flavour"])
+      for name in ("leptons_id_tight", "leptons_iso_FCLoose", "leptons_iso_TightTrackOnly_FixedRad"):
+        vectors[name].push_back(1)
+    for name in scalars:
+      scalars[name][0] = 120. + i if name.startswith("mmc") else 1.
+    met.SetPxPyPzE(10., 0., 0., 10.)
+    tree.Fill()
+  outputFile.Write()
+  outputFile.Close()
+
+class Recorder:
+  # Output ntuple writer keeping the extended columns in memory
+  def __init__(self):
+    self.columns = {}
+
+  def extend(self, treeName, columns):
+    for key, values in columns.items():
+      self.columns.setdefault(treeName, {}).setdefault(key, []).extend(np.asarray(values).tolist())
+
+def selectedEvents(engine, fileName):
+  ### {region: columns} of the events each engine selects, through the output ntuple writer, and the cut flows ###
+  recorder = Recorder()
+  outputs = {region: (recorder, "nominal" + region, {}, None) for region in ("2lep", "3lep")}
+  cutFlows = {region: CutFlow() for region in ("2lep", "3lep")}
+  if engine == "event":
+    chain = ROOT.TChain("NOMINAL")
+    chain.Add(fileName)
+    eventLoop(chain, 1., 1., outputs, cutFlows = cutFlows)
+  elif engine == "columnar":
+    runColumnar([fileName], 1., 1., outputs, cutFlows = cutFlows)
+  else:
+    runRDataFrame([fileName], 1., 1., outputs, 1, cutFlows = cutFlows)
+  selected = {region: recorder.columns.get("nominal" + region, {"mmc": []}) for region in ("2lep", "3lep")}
+  return selected, {region: {name: row[:2] for name, row in cutFlows[region].rows.items()} for region in cutFlows}
+
+@pytest.fixture(scope = "module")
+def engines(tmp_path_factory):
+  fileName = str(tmp_path_factory.mktemp("events") / "events.root")
+  writeEvents(fileName, EVENTS)
+  return {engine: selectedEvents(engine, fileName) for engine in ("event", "columnar", "rdf")}
+
+@pytest.mark.parametrize("engine", ["columnar", "rdf"])
+def test_engines_select_the_same_events(engines, engine):
+  event, other = engines["event"][0], engines[engine][0]
+  # events are told apart by their MMC mass, 120 + their index
+  assert event["2lep"]["mmc"] == other["2lep"]["mmc"] == [120.]
+  assert event["3lep"]["mmc"] == other["3lep"]["mmc"] == [122., 124.]
+  for region in ("2lep", "3lep"):
+    for key in ("zMassSum", "tauPtSum", "deltaPhill", "deltaRttll"):
+      assert np.allclose(event[region][key], other[region][key], rtol = 1e-6)
+
+@pytest.mark.parametrize("engine", ["columnar", "rdf"])
+def test_engines_count_the_same_cut_flow(engines, engine):
+  event, other = engines["event"][1], engines[engine][1]
+  for region in ("2lep", "3lep"):
+    assert event[region] and list(event[region]) == list(other[region])
+    for name in event[region]:
+      assert event[region][name][0] == other[region][name][0]
+      assert event[region][name][1] == pytest.approx(other[region][name][1])
+
+def test_best_z_candidate():
+  events = EVENTS[2:]
+  leptons = fromPtEtaPhiM(*(np.array([[particle["p4"][i] for particle in event["leptons"]] for event in events])
+                            for i in range(4)))
+  flavour = np.array([[particle["flavour"] for particle in event["leptons"]] for event in events])
+  charge = np.array([[particle["charge"] for particle in event["leptons"]] for event in events], dtype = np.float64)
+  found, leftIndex, zIndex1, zIndex2 = bestZCandidate(leptons, flavour, charge)
+  # mixed flavour: the only same flavour pair; no opposite sign pair; closest pair; tie
+  assert found.tolist() == [True, False, True, False]
+  assert (leftIndex[0], zIndex1[0], zIndex2[0]) == (1, 0, 2)
+  assert (leftIndex[2], zIndex1[2], zIndex2[2]) == (2, 0, 1)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+keras = pytest.importorskip("keras")
+
+from numpyInference import exportModel, loadModel
+
+# The numpy forward pass of numpyInference against Keras' own predict, for a model saved as .h5 and its .npz export,
+# and of the fold models scored together by foldEnsemble. Run with python -m pytest test_numpyInference.py
+
+def denseModel(seed):
+  ### Sequential stack of Dense layers like the networks of nnTrain and kFold (13 -> 30 -> 18 -> 16 -> 1), with random
+  #   weights. A tanh layer is included to cover every activation the trained models can use ###
+  keras.utils.set_random_seed(seed)
+  model = keras.models.Sequential([keras.Input(shape = (13,)), keras.layers.Dense(30, activation = "relu"),
+                                   keras.layers.Dense(18, activation = "tanh"), keras.layers.Dense(16),
+                                   keras.layers.Dense(1, activation = "sigmoid")])
+  model.compile(loss = "binary_crossentropy", optimizer = "adam")
+  return model
+
+def features(n = 1000, seed = 0):
+  # Standardised inputs, as the networks see them after the StandardScaler
+  return np.random.default_rng(seed).normal(size = (n, 13)).astype(np.float32)
+
+def test_h5_model_matches_keras(tmp_path):
+  model = denseModel(0)
+  fileName = str(tmp_path / "model.h5")
+  model.save(fileName)
+  x = features()
+  expected = model.predict(x, verbose = 0)
+  assert loadModel(fileName).predict(x).shape == expected.shape
+  assert np.allclose(loadModel(fileName).predict(x), expected, rtol = 1e-5, atol = 1e-6)
+  # batches do not change the outputs, up to the rounding of the matrix products
+  assert np.allclose(loadModel(fileName).predict(x, batch_size = 7), loadModel(fileName).predict(x), rtol = 1e-6)
+
+def test_exported_npz_matches_keras(tmp_path):
+  model = denseModel(1)
+  model.save(str(tmp_path / "model.h5"))
+  x = features()
+  expected = model.predict(x, verbose = 0)
+  # from the saved .h5 and from the model in memory
+  exportModel(str(tmp_path / "model.h5"), str(tmp_path / "fromFile.npz"))
+  exportModel(model, str(tmp_path / "fromModel.npz"))
+  for name in ("fromFile.npz", "fromModel.npz"):
+    assert np.allclose(loadModel(str(tmp_path / name)).predict(x), expected, rtol = 1e-5, atol = 1e-6)
+
+def test_fold_ensemble_matches_each_fold_model(tmp_path, monkeypatch):
+  from foldEnsemble import N_FOLDS, loadEnsemble, modelPaths
+  monkeypatch.chdir(tmp_path)
+  (tmp_path / "kFoldModels").mkdir()
+  models = [denseModel(seed) for seed in range(N_FOLDS)]
+  for model, path in zip(models, modelPaths("2lep")):
+    model.save(path)
+  x = features()
+  expected = np.stack([model.predict(x, verbose = 0)[:, 0] for model in models])
+  ensemble = loadEnsemble("2lep")
+  # out of fold: every event is scored by the model of its fold, also across batches
+  folds = np.random.default_rng(1).integers(0, N_FOLDS, len(x))
+  assert np.allclose(ensemble.predict(x, folds), expected[folds, np.arange(len(x))], rtol = 1e-5, atol = 1e-6)
+  assert np.allclose(ensemble.predict(x, folds, batch_size = 7), ensemble.predict(x, folds), rtol = 1e-6)
+  # new events: the mean of the folds
+  assert np.allclose(ensemble.predict(x), expected.mean(axis = 0), rtol = 1e-5, atol = 1e-6)
@@ -0,0 +1,230 @@
+import os
+import queue
+import shutil
+import hashlib
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+import uproot
+from sklearn.preprocessing import StandardScaler
+from fileUtils import findAllFilesInPath
+from metadataIndex import loadMetadata
+
+# Input variables of the networks, in the column order of the training matrix
+VARIABLES = ("tauPtSum", "zMassSum", "metPt", "deltaRll", "deltaRtt", "deltaRttll", "deltaEtall", "deltaEtatt",
+             "nJets", "deltaPhill", "deltaPhitt", "deltaPhilltt", "mmc")
+
+# Group number of each nTupleGroups file, used by kFoldCutting to split the background. The signal group is labelled 1,
+# every other file 0. An event is identified by its group and its entry in the nominal<cut> tree of the group file
+GROUPS = {"signalGroup.root": 0, "llllGroup.root": 1, "backgroundGroup.root": 2, "jetsGroup.root": 3}
+SIGNAL_GROUP = "signalGroup.root"
+
+# Arrays of the cache, with their types
+COLUMNS = {"x": np.float32, "y": np.float32, "weight": np.float32, "group": np.int32, "entry": np.int64}
+
+def fileGroups(fileNames):
+  # Group number of every file, the files of no group are numbered after the groups in file order
+  groups = {}
+  others = 0
+  for fileName in fileNames:
+    name = os.path.basename(fileName)
+    if name in GROUPS:
+      groups[fileName] = GROUPS[name]
+    else:
+      groups[fileName] = len(GROUPS) + others
+      others += 1
+  return groups
+
+def cacheKey(cut, fileNames, metadata, variables):
+  # Name of the cached matrix: changes with the content and order of the input files, the region, the variables and
+  # the cached columns
+  key = "%s:%s:%s:%s" % (cut, ",".join(variables), ",".join(COLUMNS),
+                         ",".join(fileName + "=" + metadata[fileName]["contentHash"] for fileName in fileNames))
+  return hashlib.sha1(key.encode()).hexdigest()
+
+def buildTrainingData(path, cut, fileNames, variables):
+  ### Writes the features, labels, weights and group numbers of tree nominal<cut> of every file to path/<column>.npy.
+  #   The arrays are allocated once on disk with the total number of events and filled file by file in chunks ###
+  entries = []
+  for fileName in fileNames:
+    with uproot.open(fileName + ":nominal" + cut) as tree:
+      entries.append(tree.num_entries)
+  nEvents = sum(entries)
+
+  # written to a temporary directory first so an interrupted build never leaves a truncated matrix in the cache
+  os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+  temporary = tempfile.mkdtemp(prefix = os.path.basename(path) + ".", dir = os.path.dirname(path) or ".")
+  arrays = {}
+  for column, dtype in COLUMNS.items():
+    shape = (nEvents, len(variables)) if column == "x" else (nEvents,)
+    arrays[column] = np.lib.format.open_memmap(os.path.join(temporary, column + ".npy"), mode = "w+", dtype = dtype,
+                                               shape = shape)
+
+  start = 0
+  groups = fileGroups(fileNames)
+  for fileName, nEntries in zip(fileNames, entries):
+    arrays["y"][start:start + nEntries] = 1 if os.path.basename(fileName) == SIGNAL_GROUP else 0
+    arrays["group"][start:start + nEntries] = groups[fileName]
+    arrays["entry"][start:start + nEntries] = np.arange(nEntries)
+    with uproot.open(fileName + ":nominal" + cut) as tree:
+      for chunk in tree.iterate([*variables, "weight"], library = "np", step_size = "100 MB"):
+        stop = start + len(chunk["weight"])
+        for i, variable in enumerate(variables):
+          arrays["x"][start:stop, i] = chunk[variable]
+        arrays["weight"][start:stop] = chunk["weight"]
+        start = stop
+
+  for array in arrays.values():
+    array.flush()
+  del arrays
+  try:
+    os.replace(temporary, path)
+  except OSError:
+    # the same matrix was built at the same time by another process
+    shutil.rmtree(temporary)
+
+def loadTrainingData(cut, directory = "nTupleGroups/", cacheDirectory = "trainingCache", variables = VARIABLES):
+  ### Returns (x, y, weight, group, entry) of every event of tree nominal<cut> in the directory's ntuples, in file
+  #   order. The arrays are cached in cacheDirectory, keyed by the content hashes of the files (from the metadata
+  #   index, so unchanged files are not hashed again), the region and the variables, and are returned memory mapped
+  #   (read only), so only the first run after an ntuple changes reads the ROOT files ###
+  fileNames = findAllFilesInPath("*.root", directory)
+  metadata = loadMetadata(fileNames, os.path.join(cacheDirectory, "index.json"), hashes = True)
+  path = os.path.join(cacheDirectory, cacheKey(cut, fileNames, metadata, variables))
+  if not os.path.exists(path):
+    print("Building the " + cut + " training matrix of", len(fileNames), "files in", path)
+    buildTrainingData(path, cut, fileNames, variables)
+  return tuple(np.load(os.path.join(path, column + ".npy"), mmap_mode = "r") for column in COLUMNS)
+
+def eventColumns(cut, columns, directory = "nTupleGroups/"):
+  ### DataFrame of columns of tree nominal<cut> of every ntuple, with the event key (group, entry) of the training
+  #   matrix, to be joined to results stored by key such as the kFold predictions. Only columns are read ###
+  parts = []
+  for fileName, group in fileGroups(findAllFilesInPath("*.root", directory)).items():
+    with uproot.open(fileName + ":nominal" + cut) as tree:
+      part = pd.DataFrame(tree.arrays(list(columns), library = "np"))
+    part.insert(0, "group", np.int32(group))
+    part.insert(1, "entry", np.arange(len(part), dtype = np.int64))
+    parts.append(part)
+  return pd.concat(parts, ignore_index = True)
+
+def eventUniform(indices, seed):
+  ### Number in [0, 1) per event from its index in the training matrix and seed (splitmix64 hash). An event is put in
+  #   a split or fold from its own number, so the split of a chunk does not need the rest of the data ###
+  z = np.array([seed], np.uint64) * np.uint64(0xD1B54A32D192ED03)
+  z = indices.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15) + z
+  z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+  z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+  z = z ^ (z >> np.uint64(31))
+  return (z >> np.uint64(11)).astype(np.float64) * 2.**-53
+
+class TrainingStream:
+  ### Out of core training input of a region: the memory mapped training matrix is read chunk by chunk, so the memory
+  #   used does not depend on the number of events. Every event is in one of nFolds folds (from eventUniform), e.g.
+  #   the test set of nnTrain is fold 0 of 5 (20% of the events, as train_test_split(test_size = 0.2)) and kFold tests
+  #   each fold in turn. The scaler is fitted on every event in a first streaming pass, as StandardScaler.fit_transform
+  #   on the whole matrix ###
+  def __init__(self, cut, seed, nFolds = 5, chunkSize = 1 << 18):
+    self.x, self.y, self.weight, self.group, self.entry = loadTrainingData(cut)
+    self.cut = cut
+    self.seed = seed
+    self.nFolds = nFolds
+    self.chunks = [(start, min(start + chunkSize, len(self.y))) for start in range(0, len(self.y), chunkSize)]
+    self.scaler = StandardScaler()
+    self.counts = np.zeros(nFolds, dtype = np.int64)
+    for start, stop in self.chunks:
+      self.scaler.partial_fit(self.x[start:stop])
+      self.counts += np.bincount(self.folds(start, stop), minlength = nFolds)
+
+  def __getstate__(self):
+    # pickled (e.g. for a worker process) without the memory mapped arrays, which would be copied, they are mapped again
+    return {key: value for key, value in self.__dict__.items() if key not in COLUMNS}
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.x, self.y, self.weight, self.group, self.entry = loadTrainingData(self.cut)
+
+  def folds(self, start, stop):
+    return (eventUniform(np.arange(start, stop), self.seed) * self.nFolds).astype(np.int64)
+
+  def selection(self, start, stop, folds):
+    # indices (relative to start) of the events of the chunk in folds
+    return np.flatnonzero(np.isin(self.folds(start, stop), folds))
+
+  def count(self, folds):
+    return int(self.counts[list(folds)].sum())
+
+  def steps(self, folds, batchSize):
+    # batches per epoch, the last one can be smaller
+    return -(-self.count(folds)//batchSize)
+
+  def column(self, name, folds):
+    # y, weight, group or entry of the events of folds, in the order of the unshuffled batches
+    values = getattr(self, name)
+    return np.concatenate([values[start:stop][self.selection(start, stop, folds)] for start, stop in self.chunks])
+
+  def batches(self, folds, batchSize, shuffle = True, labels = True, epochs = None):
+    ### Generator of (scaled features, labels) batches of the events of folds, steps(folds, batchSize) per epoch, for
+    #   epochs epochs (endless by default, for model.fit). With shuffle, the order of the chunks and of the events in
+    #   each chunk changes every epoch ###
+    rng = np.random.default_rng(self.seed)
+    epoch = 0
+    while epochs is None or epoch < epochs:
+      epoch += 1
+      order = rng.permutation(len(self.chunks)) if shuffle else range(len(self.chunks))
+      xLeft, yLeft = np.empty((0, self.x.shape[1]), np.float32), np.empty(0, np.float32)
+      for chunk in order:
+        start, stop = self.chunks[chunk]
+        selection = self.selection(start, stop, folds)
+        if shuffle:
+          selection = rng.permutation(selection)
+        x = np.concatenate((xLeft, self.scaler.transform(self.x[start:stop][selection]).astype(np.float32)))
+        y = np.concatenate((yLeft, self.y[start:stop][selection]))
+        nFull = len(y)//batchSize*batchSize
+        for i in range(0, nFull, batchSize):
+          yield (x[i:i + batchSize], y[i:i + batchSize]) if labels else x[i:i + batchSize]
+        xLeft, yLeft = x[nFull:], y[nFull:]
+      if len(yLeft):
+        yield (xLeft, yLeft) if labels else xLeft
+
+  def predict(self, model, folds, batchSize = 1024):
+    # predictions of the model for the events of folds, in the order of column(name, folds)
+    return model.predict(prefetch(self.batches(folds, batchSize, shuffle = False, labels = False, epochs = 1)),
+                         steps = self.steps(folds, batchSize), verbose = 0)
+
+def prefetch(iterable, size = 16):
+  ### Yields the items of iterable, produced ahead by a background thread (e.g. the batches of a TrainingStream while
+  #   the model trains on the previous ones). When the consumer stops early (the generator is closed or garbage
+  #   collected, e.g. at the end of model.fit), the thread is told to stop and releases its queued items ###
+  items = queue.Queue(size)
+  done = object()
+  stop = threading.Event()
+
+  def put(item):
+    # waits for a free slot, unless the consumer has stopped. Returns whether the item was queued
+    while not stop.is_set():
+      try:
+        items.put(item, timeout = 0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def produce():
+    try:
+      for item in iterable:
+        if not put(item):
+          return
+      put(done)
+    except Exception as error:
+      put(error)
+
+  threading.Thread(target = produce, daemon = True).start()
+  try:
+    while (item := items.get()) is not done:
+      if isinstance(item, Exception):
+        raise item
+      yield item
+  finally:
+    stop.set()
@@ -0,0 +1,43 @@
+import re
+
+class WeightVariation:
+  ### Alternative event weight given as NAME=EXPRESSION on the command line. The expression replaces the product
+  #   cross_section * pu_NOMINAL_pileup_combined_weight * weight_mc of the nominal weight with any arithmetic of scalar
+  #   branches of the NOMINAL tree, and is multiplied by the luminosity and divided by the nominal sumAllMC.
+  #   It is evaluated with python by the event and columnar engines (on numbers or whole numpy arrays) and with C++
+  #   by the rdf engine, so it has to be valid in both ###
+  def __init__(self, spec):
+    name, separator, self.expression = spec.partition("=")
+    self.name = name.strip()
+    if not separator or not re.fullmatch(r"[A-Za-z_]\w*", self.name) or not self.expression.strip():
+      raise ValueError("weight variation %r is not of the form NAME=EXPRESSION" % spec)
+    self.code = compile(self.expression.strip(), "<weight " + self.name + ">", "eval")
+    self.branches = self.code.co_names
+    self.column = "weight_" + self.name # column of the selected events and branch of the output ntuples
+
+  def __reduce__(self):
+    # code objects can not be pickled, the worker processes of the sharded engines compile the expression again
+    return (WeightVariation, (self.name + "=" + self.expression,))
+
+  def evaluate(self, values, luminosity, sumAllMC):
+    # values maps every branch of the expression to its value, a number or an array of the whole chunk
+    return eval(self.code, {"__builtins__": {}}, values) * luminosity/sumAllMC
+
+  def rdfExpression(self, luminosity, sumAllMC):
+    # every branch is cast to double, the python engines compute the weights in double precision too
+    expression = self.expression
+    if self.branches:
+      expression = re.sub(r"\b(%s)\b" % "|".join(self.branches), r"((double) \1)", expression)
+    return "(%s) * %r/%r" % (expression, float(luminosity), float(sumAllMC))
+
+def parseVariations(specs):
+  ### WeightVariation per NAME=EXPRESSION, in command line order. Names have to be unique ###
+  variations = [WeightVariation(spec) for spec in (specs or [])]
+  names = [variation.name for variation in variations]
+  if len(set(names)) != len(names):
+    raise ValueError("weight variation names are not unique: " + ", ".join(names))
+  return variations
+
+def variationBranches(variations, branches = ()):
+  # branches followed by the other branches read by the variations, in first use order
+  return tuple(dict.fromkeys((*branches, *(branch for variation in variations for branch in variation.branches))))